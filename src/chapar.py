@@ -1,19 +1,42 @@
 import os
+import re
+import sys
+import base64
+import bisect
+import random
 import smtplib
+import ssl
 import csv
+import hashlib
+import itertools
 import html
 import time
 import configparser
 import logging
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from email.mime.text import MIMEText
 from email.header import Header
 from email.mime.multipart import MIMEMultipart
+from email.message import Message
+from email.policy import compat32
 from email.utils import formataddr
 from datetime import datetime
-from typing import Dict, List, Optional
+from typing import Dict, Iterable, List, Optional, Tuple, Union
+
+import deduplicator
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
+RELAY_SECTION_PREFIX = 'SMTP:'
+SMTP_REQUIRED_KEYS = ('Host', 'Port', 'Email', 'Password', 'Subject')
+
+def relay_sections(config) -> List[str]:
+    """Returns the names of the ``[SMTP:name]`` relay sections, in file order."""
+    return [section for section in config if section.startswith(RELAY_SECTION_PREFIX)]
+
 def load_config(folder: str) -> configparser.ConfigParser:
     """Loads and validates the configuration file.
 
@@ -36,14 +59,76 @@ def load_config(folder: str) -> configparser.ConfigParser:
     except configparser.Error as e:
         raise ValueError(f"Error parsing config file: {e}")
 
-    required_sections = ['SMTP', 'Settings']
+    relays = relay_sections(config)
+    required_sections = ['Settings'] if relays else ['SMTP', 'Settings']
     for section in required_sections:
         if not config.has_section(section):
             raise ValueError(f"Missing section in config: {section}")
 
     try:
-        interval = int(config['Settings'].get('Interval', '0'))
+        for section in ['SMTP'] + relays:
+            if section not in config or (section != 'SMTP' and 'Security' not in config[section]):
+                continue
+            security = config[section].get('Security', 'auto').lower()
+            if security not in SMTP_SECURITY_MODES:
+                raise ValueError(f"Invalid Security in [{section}]. Must be 'auto', 'ssl', or 'starttls'.")
+            config[section]['Security'] = security
+        for section in ['SMTP'] + relays:
+            if section in config and config[section].get('CAFile', '').strip():
+                config[section]['CAFile'] = job_file_path(folder, config[section]['CAFile'].strip(), 'CAFile')
+        for section in relays:
+            if not section[len(RELAY_SECTION_PREFIX):].strip():
+                raise ValueError(f"Relay section [{section}] needs a name, e.g. [SMTP:primary].")
+            for key in SMTP_REQUIRED_KEYS:
+                if not config[section].get(key) and not (config.has_section('SMTP') and config['SMTP'].get(key)):
+                    raise ValueError(f"Missing {key} in [{section}].")
+            if float(config[section].get('Weight', '1')) <= 0:
+                raise ValueError(f"Weight in [{section}] must be positive.")
+            if config[section].get('Rate', '').strip():
+                parse_rate(config[section]['Rate'])
+            if float(config[section].get('Burst', '1')) < 1:
+                raise ValueError(f"Burst in [{section}] must be at least 1.")
+            if int(config[section].get('Concurrency', '1')) < 1:
+                raise ValueError(f"Concurrency in [{section}] must be at least 1.")
+        interval = float(config['Settings'].get('Interval', '0'))
+        if interval < 0:
+            raise ValueError("Interval cannot be negative.")
         config['Settings']['Interval'] = str(interval)
+        for key in ('Rate', 'DomainRate', 'MinRate', 'MaxRate'):
+            if config['Settings'].get(key, '').strip():
+                parse_rate(config['Settings'][key])
+        for key in ('Burst', 'DomainBurst'):
+            if float(config['Settings'].get(key, '1')) < 1:
+                raise ValueError(f"{key} must be at least 1.")
+        if not 0 < float(config['Settings'].get('RateDecrease', '0.5')) < 1:
+            raise ValueError("RateDecrease must be between 0 and 1.")
+        if float(config['Settings'].get('RateIncrease', '1')) < 0:
+            raise ValueError("RateIncrease cannot be negative.")
+        if int(config['Settings'].get('MaxDeferrals', '').strip() or '0') < 0:
+            raise ValueError("MaxDeferrals cannot be negative.")
+        for key, default in (('MaxRetries', '3'), ('MaxReconnects', '5')):
+            if int(config['Settings'].get(key, default)) < 0:
+                raise ValueError(f"{key} cannot be negative.")
+        for key, default in (('RetryBackoff', '1'), ('MaxBackoff', '60')):
+            if float(config['Settings'].get(key, default)) < 0:
+                raise ValueError(f"{key} cannot be negative.")
+        if int(config['Settings'].get('JournalSyncEvery', '100')) < 1:
+            raise ValueError("JournalSyncEvery must be at least 1.")
+        if int(config['Settings'].get('BatchSize', '1')) < 1:
+            raise ValueError("BatchSize must be at least 1.")
+        concurrency = int(config['Settings'].get('Concurrency', '1'))
+        if concurrency < 1:
+            raise ValueError("Concurrency must be at least 1.")
+        config['Settings']['Concurrency'] = str(concurrency)
+        job_suppression_list_path(folder, config['Settings'])
+        if int(config['Settings'].get('Processes', '1')) < 1:
+            raise ValueError("Processes must be at least 1.")
+        engine = config['Settings'].get('Engine', 'threads').lower()
+        if engine not in ['threads', 'asyncio']:
+            raise ValueError("Invalid Engine. Must be 'threads' or 'asyncio'.")
+        config['Settings']['Engine'] = engine
+        if relays and engine == 'asyncio':
+            raise ValueError("Engine = asyncio does not support [SMTP:name] relay sections; use threads.")
         log_level = config['Settings'].get('LogLevel', 'none').lower()
         if log_level not in ['none', 'job', 'detailed']:
             raise ValueError("Invalid LogLevel. Must be 'none', 'job', or 'detailed'.")
@@ -58,10 +143,11 @@ def load_config(folder: str) -> configparser.ConfigParser:
         'Password': 'SMTP_PASSWORD',
         'Subject': 'SMTP_SUBJECT',
         'DisplayName': 'SMTP_DISPLAY_NAME',
+        'Security': 'SMTP_SECURITY',
     }
     for key, env_var in env_overrides.items():
         value = os.environ.get(env_var)
-        if value is not None:
+        if value is not None and config.has_section('SMTP'):
             config['SMTP'][key] = value
 
     return config
@@ -84,9 +170,227 @@ def read_html(folder: str) -> str:
     with open(html_file, 'r', encoding='utf-8') as file:
         return file.read()
 
+_PLACEHOLDER_RE = re.compile(r'\{\{\s*([^{}]+?)\s*\}\}')
+
+class CompiledTemplate:
+    """An HTML template parsed once into static segments and placeholder slots.
+
+    A placeholder is written ``{{column}}`` and is filled with the HTML-escaped value
+    of that column from recipients.csv. Placeholders that do not name a known column
+    are kept as literal text.
+    """
+
+    def __init__(self, html_content: str, columns: Optional[Iterable[str]] = None):
+        known = set(columns) if columns is not None else None
+        self._parts: List[str] = []
+        self._slots: List[Tuple[int, str]] = []
+        position = 0
+        for match in _PLACEHOLDER_RE.finditer(html_content):
+            column = match.group(1)
+            if known is not None and column not in known:
+                continue
+            self._parts.append(html_content[position:match.start()])
+            self._slots.append((len(self._parts), column))
+            self._parts.append('')
+            position = match.end()
+        self._parts.append(html_content[position:])
+        self._byte_parts: List[bytes] = [part.encode('utf-8') for part in self._parts]
+
+    @property
+    def placeholders(self) -> List[str]:
+        """The column names filled in for each recipient, in template order."""
+        return [column for _, column in self._slots]
+
+    def render(self, recipient: Dict[str, str]) -> str:
+        """Fills the placeholder slots with the recipient's escaped column values.
+
+        Args:
+            recipient: A row from recipients.csv.
+
+        Returns:
+            The personalized HTML.
+        """
+        parts = self._parts.copy()
+        for index, column in self._slots:
+            parts[index] = html.escape(recipient.get(column) or '')
+        return ''.join(parts)
+
+    def render_bytes(self, recipient: Dict[str, str]) -> bytes:
+        """Like ``render``, but returns UTF-8 and only encodes the filled slots."""
+        parts = self._byte_parts.copy()
+        for index, column in self._slots:
+            parts[index] = html.escape(recipient.get(column) or '').encode('utf-8')
+        return b''.join(parts)
+
+def compile_template(html_content: str, columns: Optional[Iterable[str]] = None) -> CompiledTemplate:
+    """Compiles an HTML template for the given recipients.csv columns.
+
+    Args:
+        html_content: The HTML content of the email.
+        columns: The recipients.csv header. If omitted, every placeholder is a slot.
+
+    Returns:
+        A CompiledTemplate.
+    """
+    return CompiledTemplate(html_content, columns)
+
+BATCH_TO_HEADER = b'undisclosed-recipients:;'
+
+class MessageBuilder:
+    """Builds per-recipient messages from a MIME skeleton serialized once per job.
+
+    The From and Subject headers, the MIME boundaries and the static template
+    segments are encoded up front. Each message then only splices in the To header
+    and the base64 body of the personalized HTML. The result parses to the same
+    message ``build_message`` produces and uses CRLF line endings, so it can be passed
+    to ``sendmail`` as is.
+    """
+
+    def __init__(self, smtp_settings: Dict[str, str], html_content: Union[str, CompiledTemplate]):
+        if not isinstance(html_content, CompiledTemplate):
+            html_content = compile_template(html_content, ['name'])
+        self.template = html_content
+        self._smtp_settings = smtp_settings
+
+        boundary = ('=' * 15 + f'{random.randrange(sys.maxsize):019d}' + '==').encode('ascii')
+        headers = Message()
+        display_name = smtp_settings.get('DisplayName', 'TechAfternoon')
+        headers["From"] = formataddr((str(Header(display_name, "utf-8")), smtp_settings['email']))
+        headers["Subject"] = Header(smtp_settings['subject'], "utf-8")
+        fixed_headers = headers.as_bytes(policy=compat32.clone(linesep='\r\n'))[:-2]
+
+        self._head = (b'Content-Type: multipart/alternative; boundary="' + boundary + b'"\r\n'
+                      b'MIME-Version: 1.0\r\n' + fixed_headers + b'To: ')
+        self._middle = (b'\r\n\r\n--' + boundary + b'\r\n'
+                        b'Content-Type: text/html; charset="utf-8"\r\n'
+                        b'MIME-Version: 1.0\r\n'
+                        b'Content-Transfer-Encoding: base64\r\n\r\n')
+        self._tail = b'\r\n--' + boundary + b'--\r\n'
+        self._shared: Optional[bytes] = None
+
+    def build(self, recipient_email: str, recipient: Dict[str, str], stats: Optional['DispatchStats'] = None) -> Union[bytes, str]:
+        """Serializes the message for one recipient.
+
+        Addresses that cannot be spliced in verbatim (non-ASCII or containing line
+        breaks) go through ``build_message`` instead.
+
+        Args:
+            recipient_email: The recipient's email address.
+            recipient: The recipient's CSV row.
+            stats: Stage timers to record rendering and serialization in, or None.
+
+        Returns:
+            The serialized message.
+        """
+        if not recipient_email.isascii() or '\n' in recipient_email or '\r' in recipient_email:
+            if stats is None:
+                return build_message(self._smtp_settings, recipient_email, recipient.get('name') or '', self.template, recipient)
+            with stats.timer('mime'):
+                return build_message(self._smtp_settings, recipient_email, recipient.get('name') or '', self.template, recipient)
+        if stats is None:
+            body = base64.encodebytes(self.template.render_bytes(recipient)).replace(b'\n', b'\r\n')
+            return b''.join((self._head, recipient_email.encode('ascii'), self._middle, body, self._tail))
+        started = time.perf_counter()
+        rendered = self.template.render_bytes(recipient)
+        rendered_at = time.perf_counter()
+        body = base64.encodebytes(rendered).replace(b'\n', b'\r\n')
+        message = b''.join((self._head, recipient_email.encode('ascii'), self._middle, body, self._tail))
+        stats.record('render', rendered_at - started)
+        stats.record('mime', time.perf_counter() - rendered_at)
+        return message
+
+    def build_shared(self, stats: Optional['DispatchStats'] = None) -> bytes:
+        """Serializes one message to send to a whole batch of recipients.
+
+        Only meant for templates without placeholders. The To header reads
+        ``undisclosed-recipients:;`` so recipients do not see each other; their
+        addresses only go in the SMTP envelope. The message is built on the first call
+        and reused after that.
+
+        Args:
+            stats: Stage timers to record building the message in, or None.
+
+        Returns:
+            The serialized message.
+        """
+        if self._shared is None:
+            started = time.perf_counter()
+            body = base64.encodebytes(self.template.render_bytes({})).replace(b'\n', b'\r\n')
+            self._shared = b''.join((self._head, BATCH_TO_HEADER, self._middle, body, self._tail))
+            if stats:
+                stats.record('mime', time.perf_counter() - started)
+        return self._shared
+
+class RecipientReader:
+    """Streams rows from a recipients CSV file without loading the whole file.
+
+    The header is checked when the reader is created, rows are read lazily as the
+    reader is iterated, and ``count`` holds the number of rows read so far. Given
+    ``start`` and ``end``, only the rows in that byte range are read; both must be
+    row boundaries after the header.
+    """
+
+    def __init__(self, csv_file: str, start: Optional[int] = None, end: Optional[int] = None):
+        if not os.path.exists(csv_file):
+            raise FileNotFoundError(f"Recipients CSV not found: {csv_file}")
+        self._file = open(csv_file, 'r', encoding='utf-8', newline='')
+        self._reader = csv.DictReader(self._file)
+        required_columns = {'email', 'name'}
+        if not required_columns.issubset(self._reader.fieldnames or []):
+            self._file.close()
+            raise ValueError("CSV missing required columns: email/name")
+        self.fieldnames: List[str] = list(self._reader.fieldnames)
+        self.count = 0
+        if start is not None:
+            self._file.close()
+            self._file = open(csv_file, 'rb')
+            self._file.seek(start)
+            self._reader = csv.DictReader(self._lines(end), fieldnames=self.fieldnames)
+
+    def _lines(self, end: Optional[int]) -> Iterable[str]:
+        position = self._file.tell()
+        for line in self._file:
+            if end is not None and position >= end:
+                break
+            position += len(line)
+            yield line.decode('utf-8')
+
+    def __iter__(self):
+        for row in self._reader:
+            self.count += 1
+            yield row
+
+    def close(self) -> None:
+        self._file.close()
+
+    def __enter__(self) -> 'RecipientReader':
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+def open_recipients(csv_file: str, start: Optional[int] = None, end: Optional[int] = None) -> RecipientReader:
+    """Opens a recipients CSV file for streaming.
+
+    Args:
+        csv_file: Path to the recipients.csv file.
+        start: Byte offset of the first row to read, or None to read from the top.
+        end: Byte offset to stop reading at, or None to read to the end.
+
+    Returns:
+        A RecipientReader, to be closed (or used as a context manager) when done.
+
+    Raises:
+        FileNotFoundError: If the file is not found.
+        ValueError: If the CSV file is missing required columns.
+    """
+    return RecipientReader(csv_file, start, end)
+
 def read_csv(folder: str) -> List[Dict[str, str]]:
     """Reads the recipients CSV file.
 
+    Prefer ``open_recipients`` for large files; this loads every row.
+
     Args:
         folder: The folder containing the recipients.csv file.
 
@@ -100,14 +404,300 @@ def read_csv(folder: str) -> List[Dict[str, str]]:
     csv_file = os.path.join(folder, "recipients.csv")
     if not os.path.exists(csv_file):
         raise FileNotFoundError(f"Recipients CSV file not found in {folder}")
-    with open(csv_file, 'r', encoding='utf-8') as file:
-        reader = csv.DictReader(file)
-        required_columns = {'email', 'name'}
-        if not required_columns.issubset(reader.fieldnames):
-            raise ValueError("CSV missing required columns: email/name")
-        return [row for row in reader]
+    with open_recipients(csv_file) as recipients:
+        return list(recipients)
+
+class DispatchProgress:
+    """Live counters for a running dispatch, safe to read from other threads.
+
+    ``on_update`` is called with the progress object after every change, from the
+    thread that made it. The addresses of failed recipients are kept in ``failures``.
+    Recipients left out are counted as 'skipped' when the send journal shows they
+    were already sent and as 'suppressed' when they are on the suppression list.
+    """
+
+    def __init__(self, on_update=None, clock=time.monotonic):
+        self.total: Optional[int] = None
+        self.sent = 0
+        self.failed = 0
+        self.skipped = 0
+        self.suppressed = 0
+        self.failures: List[str] = []
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+        self._on_update = on_update
+        self._clock = clock
+        self._lock = threading.Lock()
+
+    def start(self, total: Optional[int] = None) -> None:
+        self.total = total
+        self.started_at = self._clock()
+        self._notify()
+
+    def finish(self) -> None:
+        self.finished_at = self._clock()
+        self._notify()
+
+    def add(self, status: str, email: Optional[str] = None) -> None:
+        """Counts one recipient as SEND_OK, SEND_FAILED, 'skipped' or 'suppressed'."""
+        with self._lock:
+            if status == SEND_OK:
+                self.sent += 1
+            elif status == 'skipped':
+                self.skipped += 1
+            elif status == 'suppressed':
+                self.suppressed += 1
+            else:
+                self.failed += 1
+                if email is not None:
+                    self.failures.append(email)
+        self._notify()
+
+    def snapshot(self) -> Dict[str, Optional[float]]:
+        """Returns the counters, the remaining recipients and the throughput in messages per second."""
+        with self._lock:
+            done = self.sent + self.failed + self.skipped + self.suppressed
+            end = self.finished_at if self.finished_at is not None else self._clock()
+            elapsed = end - self.started_at if self.started_at is not None else 0.0
+            return {
+                'sent': self.sent,
+                'failed': self.failed,
+                'skipped': self.skipped,
+                'suppressed': self.suppressed,
+                'total': self.total,
+                'remaining': max(self.total - done, 0) if self.total is not None else None,
+                'elapsed': round(elapsed, 3),
+                'throughput': round((self.sent + self.failed) / elapsed, 3) if elapsed > 0 else 0.0,
+            }
+
+    def _notify(self) -> None:
+        if self._on_update:
+            self._on_update(self)
+
+def count_recipients(csv_file: str) -> int:
+    """Counts the data rows of a recipients CSV file without keeping them.
+
+    Args:
+        csv_file: Path to the recipients.csv file.
+
+    Returns:
+        The number of recipients. Blank lines are not counted, as DictReader skips them.
+    """
+    with open(csv_file, 'r', encoding='utf-8', newline='') as f:
+        reader = csv.reader(f)
+        next(reader, None)
+        return sum(1 for row in reader if row)
+
+STAGES = ('connect', 'login', 'csv', 'render', 'mime', 'throttle', 'smtp')
+# The stages whose every call is also counted in a latency histogram, and the
+# attribute holding it on DispatchStats and chapar_metrics.MetricsRegistry.
+LATENCY_STAGES = {'connect': 'connect_latency', 'login': 'login_latency', 'smtp': 'send_latency'}
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+class LatencyHistogram:
+    """Counts latencies, in seconds, into fixed buckets. Safe to update from several threads."""
+
+    def __init__(self, buckets: Iterable[float] = LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, seconds: float) -> None:
+        index = bisect.bisect_left(self.buckets, seconds)
+        with self._lock:
+            self.counts[index] += 1
+            self.count += 1
+            self.sum += seconds
+
+    def merge(self, other: 'LatencyHistogram') -> None:
+        """Adds the latencies counted by another histogram with the same buckets."""
+        with self._lock:
+            self.counts = [a + b for a, b in zip(self.counts, other.counts)]
+            self.count += other.count
+            self.sum += other.sum
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def cumulative(self) -> List[Tuple[float, int]]:
+        """Returns (upper_bound, count) pairs with running totals, ending with infinity."""
+        total = 0
+        pairs = []
+        for bound, count in zip(self.buckets + (float('inf'),), list(self.counts)):
+            total += count
+            pairs.append((bound, total))
+        return pairs
+
+    def snapshot(self) -> Tuple[List[Tuple[float, int]], int, float]:
+        """Returns the cumulative buckets, the count and the sum, read consistently."""
+        with self._lock:
+            return self.cumulative(), self.count, self.sum
+
+    def quantile(self, fraction: float) -> Optional[float]:
+        """Returns the upper bound of the bucket holding the given quantile, or None if empty.
+
+        Latencies beyond the last bucket are reported as the last bucket's bound.
+        """
+        if not self.count:
+            return None
+        rank = fraction * self.count
+        for bound, total in self.cumulative():
+            if total >= rank:
+                return min(bound, self.buckets[-1])
+        return self.buckets[-1]
+
+class DispatchStats:
+    """Time spent in each stage of a dispatch, measured with a monotonic clock.
+
+    The stages are opening SMTP connections ('connect'), authenticating ('login'),
+    reading recipients ('csv'), filling the template ('render'), serializing the
+    message ('mime'), waiting for the rate limiter ('throttle') and the ``sendmail``
+    round trip ('smtp'). Stages that run on several connections at once are summed
+    across them, so their total can exceed the wall time. Every connect, login and
+    ``sendmail`` latency also goes into a histogram, and ``count`` tallies the final
+    outcome of each recipient.
+    """
+
+    def __init__(self):
+        self.seconds = dict.fromkeys(STAGES, 0.0)
+        self.calls = dict.fromkeys(STAGES, 0)
+        self.outcomes = {SEND_OK: 0, SEND_FAILED: 0}
+        self.connect_latency = LatencyHistogram()
+        self.login_latency = LatencyHistogram()
+        self.send_latency = LatencyHistogram()
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+        self._lock = threading.Lock()
+
+    def start(self) -> None:
+        self.started_at = time.perf_counter()
+
+    def finish(self) -> None:
+        self.finished_at = time.perf_counter()
+
+    def record(self, stage: str, seconds: float) -> None:
+        with self._lock:
+            self.seconds[stage] += seconds
+            self.calls[stage] += 1
+        if stage in LATENCY_STAGES:
+            getattr(self, LATENCY_STAGES[stage]).observe(seconds)
+
+    def count(self, status: str) -> None:
+        """Counts the final outcome of one recipient; anything but SEND_OK is a failure."""
+        with self._lock:
+            self.outcomes[SEND_OK if status == SEND_OK else SEND_FAILED] += 1
+
+    def merge(self, other: 'DispatchStats') -> None:
+        """Adds the stage times and latencies of another dispatch, such as a shard.
+
+        Outcomes are not merged; they are counted as they arrive.
+        """
+        for stage in STAGES:
+            if other.calls[stage]:
+                with self._lock:
+                    self.seconds[stage] += other.seconds[stage]
+                    self.calls[stage] += other.calls[stage]
+        for name in LATENCY_STAGES.values():
+            getattr(self, name).merge(getattr(other, name))
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def timer(self, stage: str):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(stage, time.perf_counter() - started)
+
+    def timed(self, stage: str, iterable: Iterable):
+        """Yields from ``iterable``, counting the time spent producing each item as ``stage``."""
+        iterator = iter(iterable)
+        while True:
+            started = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                self.record(stage, time.perf_counter() - started)
+            yield item
+
+    def report(self) -> Dict:
+        """Returns the stage totals, the wall time and the send latency quantiles."""
+        end = self.finished_at if self.finished_at is not None else time.perf_counter()
+        quantiles = {f'p{int(q * 100)}': self.send_latency.quantile(q) for q in (0.5, 0.9, 0.99)}
+        return {
+            'wall': end - self.started_at if self.started_at is not None else None,
+            'stages': {stage: {'seconds': self.seconds[stage], 'calls': self.calls[stage]} for stage in STAGES},
+            'outcomes': dict(self.outcomes),
+            'send_latency': quantiles,
+        }
+
+    def summary(self) -> str:
+        """Returns the report on one line, for logging."""
+        report = self.report()
+        parts = [f"{stage} {values['seconds']:.3f}s" for stage, values in report['stages'].items()]
+        parts += [f"smtp {name} <= {value * 1000:g} ms" for name, value in report['send_latency'].items() if value is not None]
+        return ', '.join(parts)
+
+    def format_report(self) -> str:
+        """Returns the report as a table."""
+        report = self.report()
+        busy = sum(values['seconds'] for values in report['stages'].values()) or 1.0
+        lines = [f"{'Stage':<10}{'Total (s)':>12}{'Calls':>10}{'Mean (ms)':>12}{'Share':>8}"]
+        for stage, values in report['stages'].items():
+            mean = values['seconds'] / values['calls'] * 1000 if values['calls'] else 0.0
+            lines.append(f"{stage:<10}{values['seconds']:>12.3f}{values['calls']:>10}{mean:>12.3f}{values['seconds'] / busy:>8.1%}")
+        if report['wall'] is not None:
+            lines.append(f"Wall time: {report['wall']:.3f} s")
+        latency = ', '.join(f"{name} <= {value * 1000:g} ms" for name, value in report['send_latency'].items() if value is not None)
+        if latency:
+            lines.append(f"sendmail latency ({self.send_latency.count} calls): {latency}")
+        return '\n'.join(lines)
+
+SMTP_SECURITY_MODES = ('auto', 'ssl', 'starttls')
 
-def _create_smtp_server(host: str, port: int, email: str, password: str) -> smtplib.SMTP:
+def resolve_security(port: int, security: str = 'auto') -> str:
+    """Returns how to secure a connection to ``port``.
+
+    Args:
+        port: The SMTP port.
+        security: One of SMTP_SECURITY_MODES. 'auto' picks 'ssl' for port 465 and
+            'starttls' for port 587.
+
+    Returns:
+        'ssl' or 'starttls'.
+
+    Raises:
+        ValueError: If the mode is unknown, or the port is not supported in 'auto' mode.
+    """
+    if security in ('ssl', 'starttls'):
+        return security
+    if security != 'auto':
+        raise ValueError(f"Unsupported security mode: {security}")
+    if port == 465:
+        return 'ssl'
+    if port == 587:
+        return 'starttls'
+    raise ValueError("Unsupported port")
+
+def _create_smtp_server(host: str, port: int, email: str, password: str, security: str = 'auto', stats: Optional['DispatchStats'] = None, ca_file: str = '') -> smtplib.SMTP:
     """Creates and logs in to an SMTP server.
 
     Args:
@@ -115,6 +705,10 @@ def _create_smtp_server(host: str, port: int, email: str, password: str) -> smtp
         port: The SMTP port.
         email: The email address to log in with.
         password: The password to log in with.
+        security: How to secure the connection, one of SMTP_SECURITY_MODES.
+        stats: Stage timers to record the connect and login times in, or None.
+        ca_file: A PEM file of certificates to verify the server against, or ''
+            for smtplib's default context.
 
     Returns:
         An SMTP server object.
@@ -124,21 +718,1051 @@ def _create_smtp_server(host: str, port: int, email: str, password: str) -> smtp
         smtplib.SMTPException: If there is an error connecting to the SMTP server.
     """
     try:
-        if port == 465:
-            server = smtplib.SMTP_SSL(host, port, timeout=10)
+        started = time.perf_counter()
+        mode = resolve_security(port, security)
+        tls = {'context': ssl.create_default_context(cafile=ca_file)} if ca_file else {}
+        if mode == 'ssl':
+            server = smtplib.SMTP_SSL(host, port, timeout=10, **tls)
             logging.info("SSL connection established")
-        elif port == 587:
+        else:
             server = smtplib.SMTP(host, port, timeout=10)
-            server.starttls()
+            server.starttls(**tls)
             logging.info("TLS connection established")
-        else:
-            raise ValueError("Unsupported port")
+        connected_at = time.perf_counter()
         server.login(email, password)
+        if stats:
+            stats.record('connect', connected_at - started)
+            stats.record('login', time.perf_counter() - connected_at)
         return server
     except smtplib.SMTPException as e:
         raise smtplib.SMTPException(f"SMTP authentication error: {e}")
 
-def send_emails_from_files(config_path: str, recipients_path: str, template_path: str) -> None:
+def _close_quietly(server: smtplib.SMTP) -> None:
+    try:
+        server.quit()
+    except Exception:
+        try:
+            server.close()
+        except Exception:
+            pass
+
+class SMTPSessionCache:
+    """Keeps authenticated SMTP sessions open between jobs so they can be reused.
+
+    Sessions are keyed by host, port, security mode, CA file, account and a digest
+    of the password, so a session is only handed out to a job with the same credentials
+    that opened it. A cached session is checked with NOOP before it is reused, and
+    sessions idle for longer than ``idle_timeout`` seconds are closed. At most
+    ``max_size`` idle sessions are kept; sessions in use by a job do not count. All
+    methods are thread-safe.
+    """
+
+    def __init__(self, max_size: int = 8, idle_timeout: float = 60.0, clock=time.monotonic):
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self._clock = clock
+        self._idle: Dict[Tuple, List[Tuple[smtplib.SMTP, float]]] = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(smtp_settings: Dict[str, str]) -> Tuple:
+        password = hashlib.sha256(smtp_settings['password'].encode('utf-8')).hexdigest()
+        return (smtp_settings['host'], int(smtp_settings['port']), smtp_settings.get('security', 'auto'),
+                smtp_settings.get('ca_file', ''), smtp_settings['email'].lower(), password)
+
+    def __len__(self) -> int:
+        with self._lock:
+            return sum(len(sessions) for sessions in self._idle.values())
+
+    def acquire(self, smtp_settings: Dict[str, str], stats: Optional[DispatchStats] = None) -> smtplib.SMTP:
+        """Returns a live cached session for the settings, or opens a new one.
+
+        Raises:
+            ValueError: If the port is not supported.
+            smtplib.SMTPException: If a new connection cannot be established.
+        """
+        key = self._key(smtp_settings)
+        self.prune()
+        while True:
+            with self._lock:
+                sessions = self._idle.get(key)
+                if not sessions:
+                    break
+                server, _ = sessions.pop()
+            try:
+                if server.noop()[0] == 250:
+                    return server
+            except Exception:
+                pass
+            _close_quietly(server)
+        return _create_smtp_server(
+            smtp_settings['host'],
+            int(smtp_settings['port']),
+            smtp_settings['email'],
+            smtp_settings['password'],
+            smtp_settings.get('security', 'auto'),
+            stats,
+            smtp_settings.get('ca_file', ''),
+        )
+
+    def release(self, server: smtplib.SMTP, smtp_settings: Dict[str, str]) -> None:
+        """Returns a session to the cache, or closes it if the cache is full."""
+        key = self._key(smtp_settings)
+        with self._lock:
+            if sum(len(sessions) for sessions in self._idle.values()) < self.max_size:
+                self._idle.setdefault(key, []).append((server, self._clock()))
+                return
+        _close_quietly(server)
+
+    @contextmanager
+    def session(self, smtp_settings: Dict[str, str], stats: Optional[DispatchStats] = None):
+        """Lends a session for the duration of a ``with`` block.
+
+        The session goes back to the cache when the block ends, or is closed if the
+        block raised.
+        """
+        server = self.acquire(smtp_settings, stats)
+        try:
+            yield server
+        except BaseException:
+            _close_quietly(server)
+            raise
+        self.release(server, smtp_settings)
+
+    def prune(self) -> None:
+        """Closes the sessions that have been idle for longer than the idle timeout."""
+        now = self._clock()
+        expired = []
+        with self._lock:
+            for key in list(self._idle):
+                fresh = [(server, used) for server, used in self._idle[key] if now - used <= self.idle_timeout]
+                expired += [server for server, used in self._idle[key] if now - used > self.idle_timeout]
+                if fresh:
+                    self._idle[key] = fresh
+                else:
+                    del self._idle[key]
+        for server in expired:
+            _close_quietly(server)
+
+    def close(self) -> None:
+        """Closes every idle session."""
+        with self._lock:
+            servers = [server for sessions in self._idle.values() for server, _ in sessions]
+            self._idle.clear()
+        for server in servers:
+            _close_quietly(server)
+
+_RATE_UNITS = {'s': 1.0, 'm': 60.0, 'h': 3600.0}
+
+SEND_OK = 'sent'
+SEND_DEFERRED = 'deferred'
+SEND_DISCONNECTED = 'disconnected'
+SEND_FAILED = 'failed'
+TRANSIENT_STATUSES = (SEND_DEFERRED, SEND_DISCONNECTED)
+
+def _is_true(value) -> bool:
+    return str(value).strip().lower() in ('1', 'true', 'yes', 'on')
+
+def parse_rate(value: str) -> float:
+    """Parses a rate such as '10/s', '600/m', '0.5/s' or '1000/h'.
+
+    A bare number is read as messages per second.
+
+    Args:
+        value: The rate as written in config.ini.
+
+    Returns:
+        The rate in messages per second.
+
+    Raises:
+        ValueError: If the rate is malformed or not positive.
+    """
+    amount, _, unit = value.strip().partition('/')
+    unit = unit.strip().lower()[:1] or 's'
+    if unit not in _RATE_UNITS:
+        raise ValueError(f"Invalid rate unit in {value!r}. Use /s, /m or /h.")
+    rate = float(amount) / _RATE_UNITS[unit]
+    if rate <= 0:
+        raise ValueError(f"Rate must be positive: {value!r}")
+    return rate
+
+class _TokenBucket:
+    """A token bucket that hands out reservations instead of blocking."""
+
+    def __init__(self, rate: float, burst: float, now: float):
+        self.rate = rate
+        self.capacity = burst
+        self.tokens = burst
+        self.updated = now
+
+    def refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self, now: float) -> float:
+        self.refill(now)
+        self.tokens -= 1
+        return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+class RateLimiter:
+    """Thread-safe token bucket limiter for outgoing messages.
+
+    A global bucket caps the overall send rate, and optional per-domain buckets cap
+    the rate towards each recipient domain. Tokens refill continuously, so time spent
+    building and sending a message counts towards the wait for the next one.
+    """
+
+    def __init__(self, rate: Optional[float], burst: float = 1, domain_rate: Optional[float] = None, domain_burst: float = 1, clock=time.monotonic, sleep=time.sleep):
+        self._clock = clock
+        self._sleep = sleep
+        self._lock = threading.Lock()
+        now = clock()
+        self._global = _TokenBucket(rate, burst, now) if rate else None
+        self._domain_rate = domain_rate
+        self._domain_burst = domain_burst
+        self._domains: Dict[str, _TokenBucket] = {}
+
+    def reserve(self, recipient_email: str = '') -> float:
+        """Takes a token for one message and returns how many seconds to wait before sending it."""
+        with self._lock:
+            now = self._clock()
+            delay = self._global.reserve(now) if self._global else 0.0
+            if self._domain_rate:
+                domain = recipient_email.rpartition('@')[2].lower()
+                bucket = self._domains.get(domain)
+                if bucket is None:
+                    bucket = self._domains[domain] = _TokenBucket(self._domain_rate, self._domain_burst, now)
+                delay = max(delay, bucket.reserve(now))
+            return delay
+
+    @property
+    def rate(self) -> Optional[float]:
+        """The global rate in messages per second, or None if only domains are limited."""
+        return self._global.rate if self._global else None
+
+    def set_rate(self, rate: float) -> None:
+        """Changes the global rate, keeping the tokens already in the bucket."""
+        with self._lock:
+            if self._global is None:
+                self._global = _TokenBucket(rate, 1, self._clock())
+            else:
+                self._global.refill(self._clock())
+                self._global.rate = rate
+
+    def acquire(self, recipient_email: str = '') -> None:
+        """Blocks until a message to ``recipient_email`` may be sent."""
+        delay = self.reserve(recipient_email)
+        if delay > 0:
+            self._sleep(delay)
+
+def create_rate_limiter(settings) -> Optional[RateLimiter]:
+    """Builds the rate limiter described by the [Settings] section.
+
+    ``Rate`` and ``Burst`` set the global limit and ``DomainRate`` and ``DomainBurst``
+    the per-domain limit. Without ``Rate``, a non-zero ``Interval`` is read as one
+    message every ``Interval`` seconds. In adaptive mode the global rate starts at
+    one message per second if neither is set.
+
+    Args:
+        settings: The [Settings] section of the configuration.
+
+    Returns:
+        A RateLimiter, or None if sending is unthrottled.
+    """
+    rate = settings.get('Rate', '').strip()
+    domain_rate = settings.get('DomainRate', '').strip()
+    interval = float(settings.get('Interval', '0'))
+    global_rate = parse_rate(rate) if rate else (1.0 / interval if interval > 0 else None)
+    if global_rate is None and _is_true(settings.get('Adaptive', 'false')):
+        global_rate = 1.0
+    per_domain = parse_rate(domain_rate) if domain_rate else None
+    if global_rate is None and per_domain is None:
+        return None
+    return RateLimiter(
+        global_rate,
+        float(settings.get('Burst', '1')),
+        per_domain,
+        float(settings.get('DomainBurst', '1')),
+    )
+
+class AdaptiveThrottle:
+    """Additive-increase/multiplicative-decrease control of a limiter's global rate.
+
+    Each delivered message raises the rate by ``increase / rate``, which adds about
+    ``increase`` messages per second for every second of successful sending. A
+    temporary (4xx) failure multiplies the rate by ``decrease``. Decreases are applied
+    at most once per second, so a burst of deferrals from messages that were already
+    in flight counts as one congestion signal.
+
+    ``max_deferrals`` is how many times a recipient that failed temporarily is sent
+    again, or None to leave that to the retry policy.
+    """
+
+    def __init__(self, limiter: RateLimiter, min_rate: float, max_rate: float, increase: float, decrease: float, max_deferrals: Optional[int], clock=time.monotonic):
+        self.limiter = limiter
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.increase = increase
+        self.decrease = decrease
+        self.max_deferrals = max_deferrals
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._last_decrease = float('-inf')
+
+    def record(self, status: str) -> None:
+        """Adjusts the send rate after a message finished with ``status``."""
+        with self._lock:
+            rate = self.limiter.rate
+            if status == SEND_OK:
+                self.limiter.set_rate(min(self.max_rate, rate + self.increase / rate))
+            elif status == SEND_DEFERRED:
+                now = self._clock()
+                if now - self._last_decrease >= 1.0:
+                    self._last_decrease = now
+                    new_rate = max(self.min_rate, rate * self.decrease)
+                    self.limiter.set_rate(new_rate)
+                    logging.warning(f"SMTP server deferred a message; send rate lowered to {new_rate:.2f}/s")
+
+def create_adaptive_throttle(settings, limiter: Optional[RateLimiter]) -> Optional[AdaptiveThrottle]:
+    """Builds the adaptive throttle described by the [Settings] section.
+
+    Args:
+        settings: The [Settings] section of the configuration.
+        limiter: The limiter the throttle drives, as built by ``create_rate_limiter``.
+
+    Returns:
+        An AdaptiveThrottle, or None unless ``Adaptive`` is enabled.
+    """
+    if not _is_true(settings.get('Adaptive', 'false')) or limiter is None:
+        return None
+    max_rate = settings.get('MaxRate', '').strip()
+    max_deferrals = settings.get('MaxDeferrals', '').strip()
+    return AdaptiveThrottle(
+        limiter,
+        parse_rate(settings.get('MinRate', '1/m')),
+        parse_rate(max_rate) if max_rate else float('inf'),
+        float(settings.get('RateIncrease', '1')),
+        float(settings.get('RateDecrease', '0.5')),
+        int(max_deferrals) if max_deferrals else None,
+    )
+
+class RetryPolicy:
+    """How a dispatch recovers from dropped connections and temporary failures.
+
+    A connection that drops is reopened up to ``max_reconnects`` times, waiting
+    ``backoff`` seconds before the first attempt and twice as long before each
+    following one, up to ``max_backoff``. Recipients that failed temporarily (a 4xx
+    reply or a dropped connection) are collected in a retry queue and sent again
+    after the current pass, up to ``max_retries`` more times, with the same backoff
+    before each pass.
+    """
+
+    def __init__(self, max_retries: int = 3, backoff: float = 1.0, max_backoff: float = 60.0, max_reconnects: int = 5, sleep=time.sleep):
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.max_reconnects = max_reconnects
+        self.sleep = sleep
+
+    def delay(self, attempt: int) -> float:
+        """Returns the wait before the given attempt, counting from 1."""
+        return min(self.backoff * 2 ** (attempt - 1), self.max_backoff)
+
+def create_retry_policy(settings) -> RetryPolicy:
+    """Builds the retry policy described by the [Settings] section.
+
+    Args:
+        settings: The [Settings] section of the configuration.
+
+    Returns:
+        A RetryPolicy.
+    """
+    return RetryPolicy(
+        int(settings.get('MaxRetries', '3')),
+        float(settings.get('RetryBackoff', '1')),
+        float(settings.get('MaxBackoff', '60')),
+        int(settings.get('MaxReconnects', '5')),
+    )
+
+def max_send_attempts(retry: Optional[RetryPolicy], throttle: Optional[AdaptiveThrottle]) -> int:
+    """Returns how many times a recipient that keeps failing temporarily is sent.
+
+    The throttle's ``max_deferrals`` applies when it is set, even if it is lower than
+    the retry policy's ``max_retries``; otherwise ``max_retries`` does.
+    """
+    if throttle is not None and throttle.max_deferrals is not None:
+        return 1 + throttle.max_deferrals
+    return 1 + (retry.max_retries if retry else 0)
+
+JOURNAL_FILE = "sent.journal"
+
+def read_journal(path: str) -> Tuple[set, int]:
+    """Reads the addresses recorded in a send journal without opening it for writing.
+
+    Args:
+        path: Path to the journal file. A missing file reads as empty.
+
+    Returns:
+        The set of journalled addresses and the length in bytes of the complete
+        lines. A last line without a newline was torn mid-write and is left out.
+    """
+    sent = set()
+    complete = 0
+    if os.path.exists(path):
+        with open(path, 'rb') as f:
+            for line in f:
+                if line.endswith(b'\n'):
+                    sent.add(line[:-1].decode('utf-8'))
+                    complete += len(line)
+    return sent, complete
+
+class SendJournal:
+    """An append-only record of the recipients a job has already delivered to.
+
+    Delivered addresses are appended one per line and flushed to disk with fsync
+    every ``sync_every`` records or ``sync_interval`` seconds, whichever comes first,
+    so a crash loses at most one batch (those recipients are sent again on resume).
+    Addresses journalled by earlier runs are loaded into a set for O(1) lookups.
+    """
+
+    def __init__(self, path: str, sync_every: int = 100, sync_interval: float = 1.0, clock=time.monotonic):
+        self.path = path
+        self.sync_every = sync_every
+        self.sync_interval = sync_interval
+        self.skipped = 0
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._sent, complete = read_journal(path)
+        if os.path.exists(path) and complete != os.path.getsize(path):
+            os.truncate(path, complete)
+        self._file = open(path, 'a', encoding='utf-8')
+        self._pending = 0
+        self._last_sync = clock()
+
+    def __len__(self) -> int:
+        return len(self._sent)
+
+    def __contains__(self, email: str) -> bool:
+        return email.strip().lower() in self._sent
+
+    def filter(self, recipients: Iterable[Dict[str, str]], on_skip=None) -> Iterable[Dict[str, str]]:
+        """Yields the recipients not yet journalled, counting the others in ``skipped``.
+
+        ``on_skip`` is called with 'skipped' for every recipient left out.
+        """
+        for recipient in recipients:
+            if recipient['email'].strip().lower() in self._sent:
+                self.skipped += 1
+                if on_skip:
+                    on_skip('skipped')
+            else:
+                yield recipient
+
+    def record(self, email: str) -> None:
+        """Appends a delivered address, syncing to disk when a batch is due."""
+        with self._lock:
+            self._file.write(email.strip().lower() + '\n')
+            self._pending += 1
+            if self._pending >= self.sync_every or self._clock() - self._last_sync >= self.sync_interval:
+                self._sync()
+
+    def _sync(self) -> None:
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._pending = 0
+        self._last_sync = self._clock()
+
+    def close(self) -> None:
+        """Syncs any pending records and closes the journal file."""
+        with self._lock:
+            if not self._file.closed:
+                self._sync()
+                self._file.close()
+
+    def discard(self) -> None:
+        """Closes and deletes the journal once the job no longer needs resuming."""
+        self.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+def open_journal(folder: str, settings) -> Optional[SendJournal]:
+    """Opens the send journal for a job folder if ``Journal`` is enabled.
+
+    Args:
+        folder: The job folder.
+        settings: The [Settings] section of the configuration.
+
+    Returns:
+        A SendJournal, or None if journalling is disabled.
+    """
+    if not _is_true(settings.get('Journal', 'false')):
+        return None
+    journal = SendJournal(os.path.join(folder, JOURNAL_FILE), int(settings.get('JournalSyncEvery', '100')))
+    if len(journal):
+        logging.info(f"Resuming from {journal.path}: {len(journal)} recipients already sent")
+    return journal
+
+SUPPRESSION_LIST_ENV = 'CHAPAR_SUPPRESSION_LIST'
+# The list applied to every job, resolved once against the working directory the
+# process started in.
+GLOBAL_SUPPRESSION_LIST = os.path.abspath(os.environ[SUPPRESSION_LIST_ENV].strip()) if os.getenv(SUPPRESSION_LIST_ENV, '').strip() else None
+# Addresses appended since the index was built are kept in a set until they reach
+# this many bytes or a tenth of the list, whichever is more; then the index is rebuilt.
+SUPPRESSION_REBUILD_BYTES = 1024 * 1024
+
+class _Suppression:
+    """Filters recipients through ``__contains__``, counting those left out in ``suppressed``."""
+
+    suppressed = 0
+
+    def filter(self, recipients: Iterable[Dict[str, str]], on_suppress=None) -> Iterable[Dict[str, str]]:
+        """Yields the recipients not on the list, counting the others in ``suppressed``.
+
+        ``on_suppress`` is called with 'suppressed' for every recipient left out.
+        """
+        for recipient in recipients:
+            if recipient['email'] in self:
+                self.suppressed += 1
+                if on_suppress:
+                    on_suppress('suppressed')
+            else:
+                yield recipient
+
+class SuppressionList(_Suppression):
+    """Addresses that must never be mailed, such as unsubscribes and hard bounces.
+
+    The list is a text file with one address per line. It is looked up through a
+    memory-mapped hash index kept next to it as ``<path>.idx`` (see
+    ``deduplicator.build_index``), so opening it costs about the same however many
+    addresses it holds and each lookup is O(1). Addresses appended to the file after
+    the index was built are read into a set when it is opened. The index is rebuilt
+    if the part of the file it covers no longer has the fingerprint it was built
+    from. A missing file reads as an empty list.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.index_path = path + '.idx'
+        self.suppressed = 0
+        self._index: Optional[deduplicator.HashIndex] = None
+        self._recent = set()
+        if not os.path.exists(path):
+            return
+        self._index = self._open_index()
+        with open(path, 'rb') as f:
+            f.seek(self._index.source[0])
+            for line in f:
+                email = deduplicator.normalize(line.decode('utf-8', 'replace'))
+                if email:
+                    self._recent.add(email)
+
+    def _open_index(self) -> deduplicator.HashIndex:
+        size = os.path.getsize(self.path)
+        try:
+            index = deduplicator.HashIndex(self.index_path)
+        except (OSError, ValueError):
+            index = None
+        if index is not None:
+            indexed = index.source[0]
+            if (indexed <= size and size - indexed <= max(SUPPRESSION_REBUILD_BYTES, indexed // 10)
+                    and index.fingerprint == deduplicator.fingerprint(self.path, indexed)):
+                return index
+            index.close()
+        return deduplicator.build_index(self.path, self.index_path)
+
+    def __contains__(self, email: str) -> bool:
+        email = deduplicator.normalize(email)
+        return email in self._recent or (self._index is not None and email in self._index)
+
+    def close(self) -> None:
+        if self._index is not None:
+            self._index.close()
+
+class SuppressionLists(_Suppression):
+    """Several suppression lists checked together: an address on any of them is suppressed."""
+
+    def __init__(self, lists: List[SuppressionList]):
+        self.lists = lists
+        self.path = ', '.join(suppression.path for suppression in lists)
+
+    def __contains__(self, email: str) -> bool:
+        return any(email in suppression for suppression in self.lists)
+
+    def close(self) -> None:
+        for suppression in self.lists:
+            suppression.close()
+
+def job_file_path(folder: str, path: str, setting: str) -> str:
+    """Resolves a file named by the ``setting`` of a job, relative to the job folder.
+
+    Raises:
+        ValueError: If the path is outside the job folder, since job configurations
+            may come from API uploads.
+    """
+    resolved_folder = os.path.realpath(folder)
+    resolved = os.path.realpath(os.path.join(folder, path))
+    if not resolved.startswith(resolved_folder + os.sep):
+        raise ValueError(f"{setting} must be a file inside the template folder.")
+    return resolved
+
+def job_suppression_list_path(folder: str, settings) -> Optional[str]:
+    """Returns the path of a job's own ``SuppressionList``, or None if it has none.
+
+    Raises:
+        ValueError: If the path is outside the job folder.
+    """
+    path = settings.get('SuppressionList', '').strip()
+    if not path:
+        return None
+    return job_file_path(folder, path, 'SuppressionList')
+
+def open_suppression_list(folder: str, settings) -> Optional[SuppressionLists]:
+    """Opens the suppression lists that apply to a job.
+
+    These are the global list named by the CHAPAR_SUPPRESSION_LIST environment
+    variable, which applies to every job, and the job's own ``SuppressionList`` in
+    [Settings], relative to the job folder. A job's own list adds to the global
+    one and never replaces it.
+
+    Args:
+        folder: The job folder.
+        settings: The [Settings] section of the configuration.
+
+    Returns:
+        The lists to check, or None if there are none.
+
+    Raises:
+        ValueError: If the job's list is outside the job folder.
+    """
+    paths = []
+    if GLOBAL_SUPPRESSION_LIST:
+        paths.append(GLOBAL_SUPPRESSION_LIST)
+    job_path = job_suppression_list_path(folder, settings)
+    if job_path:
+        paths.append(job_path)
+    if not paths:
+        return None
+    return SuppressionLists([SuppressionList(path) for path in paths])
+
+def batches(items: Iterable, size: int) -> Iterable[List]:
+    """Yields lists of up to ``size`` consecutive items, reading ``items`` lazily."""
+    iterator = iter(items)
+    while True:
+        batch = list(itertools.islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+def _open_smtp_pool(smtp_settings: Dict[str, str], size: int, stats: Optional[DispatchStats] = None, sessions: Optional[SMTPSessionCache] = None) -> List[smtplib.SMTP]:
+    """Opens several authenticated SMTP connections in parallel.
+
+    Args:
+        smtp_settings: A dictionary containing the SMTP settings.
+        size: The number of connections to open.
+        stats: Stage timers to record the connect and login times in, or None.
+        sessions: The session cache to take connections from, or None to open new ones.
+
+    Returns:
+        A list of open SMTP server objects.
+
+    Raises:
+        smtplib.SMTPException: If any connection cannot be established. The connections
+            that did open are closed before the error is raised.
+    """
+    def connect() -> smtplib.SMTP:
+        if sessions:
+            return sessions.acquire(smtp_settings, stats)
+        return _create_smtp_server(
+            smtp_settings['host'],
+            int(smtp_settings['port']),
+            smtp_settings['email'],
+            smtp_settings['password'],
+            smtp_settings.get('security', 'auto'),
+            stats,
+            smtp_settings.get('ca_file', ''),
+        )
+
+    with ThreadPoolExecutor(max_workers=size) as executor:
+        futures = [executor.submit(connect) for _ in range(size)]
+    servers = [f.result() for f in futures if f.exception() is None]
+    errors = [f.exception() for f in futures if f.exception() is not None]
+    if errors:
+        for server in servers:
+            if sessions:
+                sessions.release(server, smtp_settings)
+            else:
+                _close_quietly(server)
+        raise errors[0]
+    return servers
+
+def _dispatch(smtp_settings: Dict[str, str], recipients: Iterable[Dict[str, str]], html_content: Union[str, CompiledTemplate, MessageBuilder], limiter: Optional[RateLimiter], log_level: str, template_name: str, concurrency: int = 1, engine: str = 'threads', throttle: Optional[AdaptiveThrottle] = None, journal: Optional[SendJournal] = None, progress: Optional[DispatchProgress] = None, stats: Optional[DispatchStats] = None, batch_size: int = 1, sessions: Optional[SMTPSessionCache] = None, retry: Optional[RetryPolicy] = None) -> Tuple[int, int]:
+    """Sends the email to every recipient and counts the outcomes.
+
+    With the 'asyncio' engine the work is handed to ``chapar_async``. Otherwise, with a
+    concurrency of 1 the recipients are sent one after another over a single
+    connection, and with a higher concurrency ``concurrency`` worker threads, each
+    holding its own authenticated connection, pull recipients from a shared bounded
+    queue. Every message takes a token from ``limiter`` before it is sent.
+
+    With a ``throttle``, every outcome adjusts the send rate. Recipients that fail
+    temporarily, with a 4xx reply or a dropped connection, go into a retry queue that
+    is sent again after the current pass, up to the throttle's ``max_deferrals`` more
+    times if it is set, and ``retry.max_retries`` otherwise. With a ``retry`` policy, a connection
+    that drops is reopened with exponential backoff; if it cannot be reopened the
+    dispatch stops and the error is raised.
+
+    With a ``batch_size`` above 1 and a template without placeholders, every message
+    is the same, so up to ``batch_size`` recipients share one SMTP transaction: one
+    MAIL FROM, a RCPT TO per recipient, and one DATA. Recipients the server refuses
+    are counted one by one, like single sends.
+
+    Args:
+        smtp_settings: A dictionary containing the SMTP settings.
+        recipients: The recipients, each a dictionary with 'email' and 'name' keys. Any
+            iterable works; it is consumed lazily.
+        html_content: The HTML content of the email, as text, compiled, or wrapped in
+            a MessageBuilder. A MessageBuilder is made for it if needed.
+        limiter: The rate limiter shared by all connections, or None for no limit.
+        log_level: The logging level.
+        template_name: The name of the email template.
+        concurrency: The number of SMTP connections to send over.
+        engine: Either 'threads' or 'asyncio'.
+        throttle: The adaptive throttle driving ``limiter``, or None for a fixed rate.
+        journal: The send journal to record delivered recipients in, or None.
+        progress: Live counters to update as recipients finish, or None.
+        stats: Stage timers to record the time spent in each step in, or None.
+        batch_size: The most recipients to send one message to in a transaction.
+        sessions: A session cache to borrow connections from and return them to, or
+            None to open new connections and close them at the end. The asyncio
+            engine always opens its own sessions.
+        retry: How to reconnect and retry temporary failures, or None to count them
+            as failures unless the throttle requeues them.
+
+    Returns:
+        A tuple of (success_count, failure_count).
+
+    Raises:
+        smtplib.SMTPException: If the first connection cannot be opened, or a dropped
+            connection cannot be reopened.
+    """
+    if not isinstance(html_content, MessageBuilder):
+        html_content = MessageBuilder(smtp_settings, html_content)
+    if batch_size > 1 and html_content.template.placeholders:
+        logging.info(f"Template {template_name} has placeholders; sending one message per recipient")
+        batch_size = 1
+
+    if engine == 'asyncio':
+        import chapar_async
+        return chapar_async.dispatch(smtp_settings, recipients, html_content, limiter, log_level, template_name, concurrency, throttle, journal, progress, stats, batch_size, retry)
+
+    max_attempts = max_send_attempts(retry, throttle)
+    counts = {SEND_OK: 0, SEND_FAILED: 0}
+    retry_queue: List[Dict[str, str]] = []
+    state = {'final': max_attempts == 1, 'error': None}
+    state_lock = threading.Lock()
+    servers: List[Optional[smtplib.SMTP]] = []
+
+    def connect() -> smtplib.SMTP:
+        if sessions:
+            return sessions.acquire(smtp_settings, stats)
+        return _create_smtp_server(
+            smtp_settings['host'],
+            int(smtp_settings['port']),
+            smtp_settings['email'],
+            smtp_settings['password'],
+            smtp_settings.get('security', 'auto'),
+            stats,
+            smtp_settings.get('ca_file', ''),
+        )
+
+    def reconnect(slot: int) -> None:
+        _close_quietly(servers[slot])
+        servers[slot] = None
+        error: Exception = smtplib.SMTPServerDisconnected("SMTP connection lost")
+        for attempt in range(1, retry.max_reconnects + 1):
+            delay = retry.delay(attempt)
+            logging.warning(f"SMTP connection lost while sending template {template_name}; reconnecting in {delay:g}s (attempt {attempt} of {retry.max_reconnects})")
+            retry.sleep(delay)
+            try:
+                servers[slot] = connect()
+                logging.info(f"Reconnected to {smtp_settings['host']} for template {template_name}")
+                return
+            except (smtplib.SMTPException, OSError) as e:
+                error = e
+        raise error
+
+    def close_servers(reuse: bool) -> None:
+        for server in servers:
+            if server is None:
+                continue
+            if sessions and reuse:
+                sessions.release(server, smtp_settings)
+            else:
+                _close_quietly(server)
+
+    def wait_for_token(email: str) -> None:
+        if stats:
+            with stats.timer('throttle'):
+                limiter.acquire(email)
+        else:
+            limiter.acquire(email)
+
+    def send_one(server: smtplib.SMTP, recipient: Dict[str, str]) -> List[str]:
+        if limiter:
+            wait_for_token(recipient['email'])
+        status = deliver_email(smtp_settings, server, recipient['email'], recipient['name'], html_content, log_level, template_name, recipient, stats)
+        settle(recipient, status)
+        return [status]
+
+    def send_batch(server: smtplib.SMTP, batch: List[Dict[str, str]]) -> List[str]:
+        if limiter:
+            for recipient in batch:
+                wait_for_token(recipient['email'])
+        statuses = deliver_batch(smtp_settings, server, [recipient['email'] for recipient in batch], html_content, log_level, template_name, stats)
+        for recipient, status in zip(batch, statuses):
+            settle(recipient, status)
+        return statuses
+
+    def settle(recipient: Dict[str, str], status: str) -> None:
+        if throttle:
+            throttle.record(status)
+        if journal is not None and status == SEND_OK:
+            journal.record(recipient['email'])
+        with state_lock:
+            if status in TRANSIENT_STATUSES and not state['final']:
+                retry_queue.append(recipient)
+                return
+            counts[SEND_OK if status == SEND_OK else SEND_FAILED] += 1
+        if progress:
+            progress.add(status, recipient['email'])
+        if stats:
+            stats.count(status)
+
+    send = send_batch if batch_size > 1 else send_one
+
+    def process(slot: int, item) -> None:
+        if state['error']:
+            return
+        statuses = send(servers[slot], item)
+        if retry and SEND_DISCONNECTED in statuses:
+            try:
+                reconnect(slot)
+            except Exception as e:
+                with state_lock:
+                    if state['error'] is None:
+                        state['error'] = e
+
+    def rounds():
+        pending = recipients
+        for attempt in range(1, max_attempts + 1):
+            state['final'] = attempt == max_attempts
+            yield batches(pending, batch_size) if batch_size > 1 else pending
+            if not retry_queue or state['error']:
+                return
+            pending = list(retry_queue)
+            retry_queue.clear()
+            delay = retry.delay(attempt) if retry else 0
+            logging.info(f"Retrying {len(pending)} recipients with temporary failures for template {template_name} in {delay:g}s")
+            if delay:
+                retry.sleep(delay)
+
+    if concurrency <= 1:
+        servers.append(connect())
+        finished = False
+        try:
+            for pending in rounds():
+                for item in pending:
+                    process(0, item)
+                    if state['error']:
+                        raise state['error']
+            finished = True
+        finally:
+            close_servers(finished)
+        return counts[SEND_OK], counts[SEND_FAILED]
+
+    servers.extend(_open_smtp_pool(smtp_settings, concurrency, stats, sessions))
+    logging.info(f"Opened {len(servers)} SMTP connections for template {template_name}")
+    work: queue.Queue = queue.Queue(maxsize=concurrency * 2)
+
+    def worker(slot: int) -> None:
+        while True:
+            item = work.get()
+            try:
+                if item is None:
+                    return
+                process(slot, item)
+            finally:
+                work.task_done()
+
+    threads = [threading.Thread(target=worker, args=(slot,), daemon=True) for slot in range(len(servers))]
+    for thread in threads:
+        thread.start()
+    finished = False
+    try:
+        for pending in rounds():
+            for item in pending:
+                if state['error']:
+                    break
+                work.put(item)
+            work.join()
+            if state['error']:
+                raise state['error']
+        finished = True
+    finally:
+        for _ in threads:
+            work.put(None)
+        for thread in threads:
+            thread.join()
+        close_servers(finished)
+
+    return counts[SEND_OK], counts[SEND_FAILED]
+
+def smtp_settings_from(section, defaults=None) -> Dict[str, str]:
+    """Reads the SMTP settings dictionary used for sending from a config section.
+
+    Args:
+        section: An [SMTP] or [SMTP:name] section.
+        defaults: The [SMTP] section that a relay section falls back to for the keys
+            it does not set, or None.
+
+    Returns:
+        A dictionary with the 'host', 'port', 'email', 'password', 'subject',
+        'DisplayName', 'security' and 'ca_file' settings.
+    """
+    def get(key: str, default: Optional[str] = None) -> Optional[str]:
+        if key in section:
+            return section[key]
+        if defaults is not None and key in defaults:
+            return defaults[key]
+        if default is None:
+            raise KeyError(key)
+        return default
+
+    return {
+        'host': get('Host'),
+        'port': get('Port'),
+        'email': get('Email'),
+        'password': get('Password'),
+        'subject': get('Subject'),
+        'DisplayName': get('DisplayName', ''),
+        'security': get('Security', 'auto'),
+        'ca_file': get('CAFile', ''),
+    }
+
+def _send_rows(config, rows: Iterable[Dict[str, str]], template: CompiledTemplate, template_name: str, journal: Optional[SendJournal] = None, progress: Optional[DispatchProgress] = None, stats: Optional[DispatchStats] = None, sessions: Optional[SMTPSessionCache] = None) -> Tuple[int, int, Optional[List[Dict]]]:
+    """Sends the email to ``rows`` with the engine, relays and limits in the configuration.
+
+    Returns:
+        The success and failure counts, and the per-relay report when the
+        configuration has [SMTP:name] relay sections, otherwise None.
+    """
+    settings = config['Settings']
+    limiter = create_rate_limiter(settings)
+    throttle = create_adaptive_throttle(settings, limiter)
+    retry = create_retry_policy(settings)
+    batch_size = int(settings.get('BatchSize', '1'))
+    log_level = settings['LogLevel']
+    if relay_sections(config):
+        import chapar_relays
+        relays = chapar_relays.load_relays(config)
+        success_count, failure_count = chapar_relays.dispatch(
+            relays, rows, template, limiter, log_level, template_name, throttle, journal, progress, stats, batch_size, sessions, retry
+        )
+        return success_count, failure_count, relays.report()
+    success_count, failure_count = _dispatch(
+        smtp_settings_from(config['SMTP']), rows, template, limiter, log_level, template_name,
+        int(settings.get('Concurrency', '1')), settings.get('Engine', 'threads'), throttle, journal, progress, stats, batch_size, sessions, retry
+    )
+    return success_count, failure_count, None
+
+def log_relay_report(report: List[Dict], template_name: str) -> None:
+    """Logs the counts and throughput of each relay after a dispatch."""
+    for relay in report:
+        logging.info(f"Relay {relay['name']} for template {template_name}: {relay['sent']} sent, {relay['failed']} failed, "
+                     f"{relay['deferred']} deferred, {relay['throughput']:.2f} msg/s" + (f", down: {relay['error']}" if relay['error'] else ''))
+
+def _run_job(config, folder: str, html_content: str, recipients_path: str, progress: Optional[DispatchProgress] = None, stats: Optional[DispatchStats] = None, sessions: Optional[SMTPSessionCache] = None, recipient_count: Optional[int] = None) -> Dict:
+    """Runs one dispatch job as configured and returns its totals.
+
+    With ``Settings.Processes`` above 1 the job is split over that many worker
+    processes by ``chapar_shards``.
+
+    Args:
+        config: The loaded configuration.
+        folder: The job folder. Its name is the template name, and it holds the send
+            journal when ``Settings.Journal`` is enabled.
+        html_content: The HTML content of the email.
+        recipients_path: Path to the recipients.csv file.
+        progress: Live counters to update during the job, or None. When given, the
+            recipients are counted up front so the remaining count is known.
+        stats: Stage timers to fill in. A new one is used if None; either way the
+            stage breakdown is logged at the end.
+        sessions: A session cache to reuse SMTP connections from, or None.
+        recipient_count: The number of recipients if the caller already counted
+            them, so the list is not read an extra time for ``progress``.
+
+    Returns:
+        A dictionary with the 'total' recipients read, and how many were 'sent',
+        'failed', 'skipped' because the journal shows they were already sent, or
+        'suppressed' because they are on the suppression list.
+        'failures' lists the addresses that failed. With [SMTP:name] relay sections
+        it also holds the per-relay counts and throughput under 'relays'.
+    """
+    if stats is None:
+        stats = DispatchStats()
+    processes = int(config['Settings'].get('Processes', '1'))
+    if processes > 1:
+        import chapar_shards
+        return chapar_shards.run_job(config, folder, html_content, recipients_path, processes, progress, stats, recipient_count)
+
+    template_name = os.path.basename(folder)
+    suppression = open_suppression_list(folder, config['Settings'])
+    journal = open_journal(folder, config['Settings'])
+    counted = progress is not None
+    if progress is None:
+        progress = DispatchProgress()
+
+    stats.start()
+    try:
+        with open_recipients(recipients_path) as recipients:
+            if counted and recipient_count is None:
+                recipient_count = count_recipients(recipients_path)
+            progress.start(recipient_count if counted else None)
+            template = compile_template(html_content, recipients.fieldnames)
+            rows = stats.timed('csv', recipients)
+            if suppression is not None:
+                rows = suppression.filter(rows, progress.add)
+            pending = journal.filter(rows, progress.add) if journal is not None else rows
+            success_count, failure_count, relays = _send_rows(config, pending, template, template_name, journal, progress, stats, sessions)
+    finally:
+        stats.finish()
+        if journal is not None:
+            journal.close()
+        if suppression is not None:
+            suppression.close()
+        progress.finish()
+    logging.info(f"Found {recipients.count} recipients in the list.")
+    if progress.suppressed:
+        logging.info(f"Suppressed {progress.suppressed} recipients on the suppression list {suppression.path}")
+    logging.info(f"Stage times for template {template_name}: {stats.summary()}")
+    if relays:
+        log_relay_report(relays, template_name)
+
+    skipped = journal.skipped if journal is not None else 0
+    if journal is not None:
+        if skipped:
+            logging.info(f"Skipped {skipped} recipients already recorded in {journal.path}")
+        if failure_count == 0:
+            journal.discard()
+        else:
+            logging.info(f"Kept send journal {journal.path}; rerun to retry the {failure_count} failed recipients")
+    result = {'total': recipients.count, 'sent': success_count, 'failed': failure_count, 'skipped': skipped,
+              'suppressed': progress.suppressed, 'failures': list(progress.failures)}
+    if relays:
+        result['relays'] = relays
+    return result
+
+def send_emails_from_files(config_path: str, recipients_path: str, template_path: str, progress: Optional[DispatchProgress] = None, stats: Optional[DispatchStats] = None, sessions: Optional[SMTPSessionCache] = None, recipient_count: Optional[int] = None) -> None:
     """
     Sends emails using the specified configuration, recipients, and template files.
 
@@ -146,6 +1770,10 @@ def send_emails_from_files(config_path: str, recipients_path: str, template_path
         config_path: Path to the config.ini file.
         recipients_path: Path to the recipients.csv file.
         template_path: Path to the email_template.html file.
+        progress: Live counters to update during the dispatch, or None.
+        stats: Stage timers to fill in during the dispatch, or None.
+        sessions: A session cache to reuse SMTP connections from, or None.
+        recipient_count: The number of recipients if already counted, or None.
     """
     start_time = time.time()
     folder = os.path.dirname(config_path)
@@ -153,147 +1781,215 @@ def send_emails_from_files(config_path: str, recipients_path: str, template_path
 
     try:
         config = load_config(folder)
-        smtp_settings = {
-            'host': config['SMTP']['Host'],
-            'port': config['SMTP']['Port'],
-            'email': config['SMTP']['Email'],
-            'password': config['SMTP']['Password'],
-            'subject': config['SMTP']['Subject'],
-            'DisplayName': config['SMTP'].get('DisplayName', ''),
-        }
-        interval = int(config['Settings']['Interval'])
-        log_level = config['Settings']['LogLevel']
-        template_name = os.path.basename(folder)
-
         if not os.path.exists(template_path):
             raise FileNotFoundError(f"HTML template not found: {template_path}")
         with open(template_path, 'r', encoding='utf-8') as f:
             html_content = f.read()
 
-        if not os.path.exists(recipients_path):
-            raise FileNotFoundError(f"Recipients CSV not found: {recipients_path}")
-        with open(recipients_path, 'r', encoding='utf-8') as f:
-            reader = csv.DictReader(f)
-            required_columns = {'email', 'name'}
-            if not required_columns.issubset(reader.fieldnames):
-                raise ValueError("CSV missing required columns: email/name")
-            recipients = [row for row in reader]
-
-        total_recipients = len(recipients)
-        success_count = 0
-        failure_count = 0
-        logging.info(f"Found {total_recipients} recipients in the list.")
-
-        with _create_smtp_server(
-            smtp_settings['host'],
-            int(smtp_settings['port']),
-            smtp_settings['email'],
-            smtp_settings['password'],
-        ) as server:
-            for recipient in recipients:
-                email = recipient['email']
-                name = recipient['name']
-                if send_email(smtp_settings, server, email, name, html_content, log_level, template_name):
-                    success_count += 1
-                else:
-                    failure_count += 1
-                time.sleep(interval)
+        result = _run_job(config, folder, html_content, recipients_path, progress, stats, sessions, recipient_count)
 
         elapsed_time = time.time() - start_time
-        logging.info(f"Email dispatch completed: {success_count} sent, {failure_count} failed. Total time: {elapsed_time:.2f} seconds.")
+        logging.info(f"Email dispatch completed: {result['sent']} sent, {result['failed']} failed. Total time: {elapsed_time:.2f} seconds.")
 
     except Exception as e:
         logging.exception(f"Error during email dispatch: {e}")
         raise
 
-def send_email(smtp_settings: Dict[str, str], server: smtplib.SMTP, recipient_email: str, recipient_name: str, html_content: str, log_level: str, template_name: str) -> bool:
-    """Sends a personalized email to a recipient.
+def build_message(smtp_settings: Dict[str, str], recipient_email: str, recipient_name: str, html_content: Union[str, CompiledTemplate], recipient: Optional[Dict[str, str]] = None) -> str:
+    """Builds the personalized MIME message for a recipient.
 
     Args:
         smtp_settings: A dictionary containing the SMTP settings.
-        server: An already-open and authenticated SMTP server object.
         recipient_email: The recipient's email address.
         recipient_name: The recipient's name.
-        html_content: The HTML content of the email.
-        log_level: The logging level.
-        template_name: The name of the email template.
+        html_content: The HTML content of the email, as text or compiled. Only
+            ``{{name}}`` is filled in a plain text template.
+        recipient: The recipient's full CSV row used to fill a compiled template.
 
     Returns:
-        True if the email was sent successfully, False otherwise.
+        The serialized message.
     """
-    try:
-        message = MIMEMultipart("alternative")
-        display_name = smtp_settings.get('DisplayName', 'TechAfternoon')
-        message["From"] = formataddr((str(Header(display_name, "utf-8")), smtp_settings['email']))
-        message["To"] = recipient_email
-        message["Subject"] = Header(smtp_settings['subject'], "utf-8")
+    message = MIMEMultipart("alternative")
+    display_name = smtp_settings.get('DisplayName', 'TechAfternoon')
+    message["From"] = formataddr((str(Header(display_name, "utf-8")), smtp_settings['email']))
+    message["To"] = recipient_email
+    message["Subject"] = Header(smtp_settings['subject'], "utf-8")
 
+    if isinstance(html_content, CompiledTemplate):
+        if recipient is None:
+            recipient = {'email': recipient_email, 'name': recipient_name}
+        personalized_html = html_content.render(recipient)
+    else:
         personalized_html = html_content.replace("{{name}}", html.escape(recipient_name))
-        part = MIMEText(personalized_html, "html", "utf-8")
-        message.attach(part)
+    part = MIMEText(personalized_html, "html", "utf-8")
+    message.attach(part)
+    return message.as_string()
+
+def classify_send_error(error: Exception) -> str:
+    """Classifies a failed send by its SMTP reply code.
+
+    Args:
+        error: The exception raised while sending.
+
+    Returns:
+        SEND_DEFERRED if the server answered with a temporary (4xx) reply,
+        SEND_DISCONNECTED if the connection dropped, or SEND_FAILED.
+    """
+    if isinstance(error, smtplib.SMTPServerDisconnected):
+        return SEND_DISCONNECTED
+    if isinstance(error, OSError) and not isinstance(error, smtplib.SMTPException):
+        return SEND_DISCONNECTED
+    if isinstance(error, smtplib.SMTPRecipientsRefused):
+        codes = [code for code, _ in error.recipients.values()]
+    elif isinstance(error, smtplib.SMTPResponseException):
+        codes = [error.smtp_code]
+    else:
+        codes = []
+    if codes and all(400 <= code < 500 for code in codes):
+        return SEND_DEFERRED
+    return SEND_FAILED
 
-        server.sendmail(smtp_settings['email'], recipient_email, message.as_string())
+def deliver_email(smtp_settings: Dict[str, str], server: smtplib.SMTP, recipient_email: str, recipient_name: str, html_content: Union[str, CompiledTemplate, MessageBuilder], log_level: str, template_name: str, recipient: Optional[Dict[str, str]] = None, stats: Optional[DispatchStats] = None) -> str:
+    """Sends a personalized email to a recipient and reports how it went.
+
+    Takes the same arguments as ``send_email``, plus the recipient's full CSV row
+    for filling a compiled template and optional stage timers to record building
+    and sending in. ``html_content`` may also be a MessageBuilder.
+
+    Returns:
+        SEND_OK if the email was accepted, SEND_DEFERRED if the server answered with a
+        temporary failure, or SEND_FAILED.
+    """
+    try:
+        if recipient is None:
+            recipient = {'email': recipient_email, 'name': recipient_name}
+        if isinstance(html_content, MessageBuilder):
+            message = html_content.build(recipient_email, recipient, stats)
+        else:
+            message = build_message(smtp_settings, recipient_email, recipient_name, html_content, recipient)
+        if stats:
+            with stats.timer('smtp'):
+                server.sendmail(smtp_settings['email'], recipient_email, message)
+        else:
+            server.sendmail(smtp_settings['email'], recipient_email, message)
 
         if log_level == 'detailed':
             logging.info(f"Sent template {template_name} to {recipient_email} succeeded")
-        return True
+        return SEND_OK
 
     except Exception as e:
         logging.error(f"Failed to send email to {recipient_email} from template {template_name}: {e}")
-        return False
+        return classify_send_error(e)
+
+def deliver_batch(smtp_settings: Dict[str, str], server: smtplib.SMTP, recipient_emails: List[str], html_content: MessageBuilder, log_level: str, template_name: str, stats: Optional[DispatchStats] = None) -> List[str]:
+    """Sends one message to several recipients in a single SMTP transaction.
+
+    Args:
+        smtp_settings: A dictionary containing the SMTP settings.
+        server: The SMTP server object.
+        recipient_emails: The recipients' email addresses.
+        html_content: The message builder for a template without placeholders.
+        log_level: The logging level.
+        template_name: The name of the email template.
+        stats: Stage timers to record building and sending in, or None.
 
-def main(folder: str) -> None:
+    Returns:
+        The outcome for each address, in order: SEND_OK, SEND_DEFERRED or SEND_FAILED.
+        A refused recipient gets its own reply's classification; an error that ends
+        the whole transaction applies to every recipient.
+    """
+    try:
+        message = html_content.build_shared(stats)
+        if stats:
+            with stats.timer('smtp'):
+                refused = server.sendmail(smtp_settings['email'], recipient_emails, message)
+        else:
+            refused = server.sendmail(smtp_settings['email'], recipient_emails, message)
+    except smtplib.SMTPRecipientsRefused as e:
+        refused = e.recipients
+    except Exception as e:
+        logging.error(f"Failed to send email to {len(recipient_emails)} recipients from template {template_name}: {e}")
+        return [classify_send_error(e)] * len(recipient_emails)
+    return classify_refusals(recipient_emails, refused, log_level, template_name)
+
+def classify_refusals(recipient_emails: List[str], refused: Dict[str, Tuple[int, bytes]], log_level: str, template_name: str) -> List[str]:
+    """Maps the refused recipients of a multi-recipient ``sendmail`` to per-recipient outcomes.
+
+    Args:
+        recipient_emails: The addresses the message was sent to.
+        refused: The refused addresses mapped to their (code, message) reply, as
+            returned by ``sendmail`` or carried by ``SMTPRecipientsRefused``.
+        log_level: The logging level.
+        template_name: The name of the email template.
+
+    Returns:
+        The outcome for each address, in order.
+    """
+    statuses = []
+    for email in recipient_emails:
+        if email in refused:
+            code, reply = refused[email]
+            logging.error(f"Failed to send email to {email} from template {template_name}: {code} {reply}")
+            statuses.append(SEND_DEFERRED if 400 <= code < 500 else SEND_FAILED)
+        else:
+            if log_level == 'detailed':
+                logging.info(f"Sent template {template_name} to {email} succeeded")
+            statuses.append(SEND_OK)
+    return statuses
+
+def send_email(smtp_settings: Dict[str, str], server: smtplib.SMTP, recipient_email: str, recipient_name: str, html_content: str, log_level: str, template_name: str) -> bool:
+    """Sends a personalized email to a recipient.
+
+    Args:
+        smtp_settings: A dictionary containing the SMTP settings.
+        server: An already-open and authenticated SMTP server object.
+        recipient_email: The recipient's email address.
+        recipient_name: The recipient's name.
+        html_content: The HTML content of the email.
+        log_level: The logging level.
+        template_name: The name of the email template.
+
+    Returns:
+        True if the email was sent successfully, False otherwise.
+    """
+    return deliver_email(smtp_settings, server, recipient_email, recipient_name, html_content, log_level, template_name) == SEND_OK
+
+def dispatch_folder(folder: str, progress: Optional[DispatchProgress] = None, stats: Optional[DispatchStats] = None, sessions: Optional[SMTPSessionCache] = None) -> Dict:
     """Dispatches emails to recipients based on the configuration and data in the specified folder.
 
+    Unlike ``main``, errors are raised to the caller.
+
     Args:
         folder: The folder containing the configuration file, HTML template, and recipient list.
+        progress: Live counters to update during the dispatch, or None.
+        stats: Stage timers to fill in during the dispatch, or None.
+        sessions: A session cache to reuse SMTP connections from, or None.
+
+    Returns:
+        The job totals, as returned by ``_run_job``.
     """
     start_time = time.time()
     logging.info(f"Starting email dispatch for folder: {folder}")
 
-    try:
-        config = load_config(folder)
-        smtp_settings = {
-            'host': config['SMTP']['Host'],
-            'port': config['SMTP']['Port'],
-            'email': config['SMTP']['Email'],
-            'password': config['SMTP']['Password'],
-            'subject': config['SMTP']['Subject'],
-            'DisplayName': config['SMTP'].get('DisplayName', ''),
-        }
-        interval = int(config['Settings']['Interval'])
-        log_level = config['Settings']['LogLevel']
-        template_name = os.path.basename(folder)
-
-        html_content = read_html(folder)
-        recipients = read_csv(folder)
-
-        total_recipients = len(recipients)
-        success_count = 0
-        failure_count = 0
+    config = load_config(folder)
+    html_content = read_html(folder)
+    result = _run_job(config, folder, html_content, os.path.join(folder, "recipients.csv"), progress, stats, sessions)
 
-        logging.info(f"Found {total_recipients} recipients in the list.")
+    elapsed_time = time.time() - start_time
+    if config['Settings']['LogLevel'] == 'job':
+        logging.info(f"Sent {result['sent']} successful emails from {result['total']} total recipients with template {os.path.basename(folder)}")
+    logging.info(f"Email dispatch completed: {result['sent']} sent, {result['failed']} failed. Total time: {elapsed_time:.2f} seconds.")
+    return result
 
-        with _create_smtp_server(
-            smtp_settings['host'],
-            int(smtp_settings['port']),
-            smtp_settings['email'],
-            smtp_settings['password'],
-        ) as server:
-            for recipient in recipients:
-                email = recipient['email']
-                name = recipient['name']
-                if send_email(smtp_settings, server, email, name, html_content, log_level, template_name):
-                    success_count += 1
-                else:
-                    failure_count += 1
-                time.sleep(interval)
-
-        elapsed_time = time.time() - start_time
-        if log_level == 'job':
-            logging.info(f"Sent {success_count} successful emails from {total_recipients} total recipients with template {template_name}")
-        logging.info(f"Email dispatch completed: {success_count} sent, {failure_count} failed. Total time: {elapsed_time:.2f} seconds.")
+def main(folder: str, stats: Optional[DispatchStats] = None) -> None:
+    """Dispatches emails to recipients based on the configuration and data in the specified folder.
 
+    Args:
+        folder: The folder containing the configuration file, HTML template, and recipient list.
+        stats: Stage timers to fill in during the dispatch, or None.
+    """
+    try:
+        dispatch_folder(folder, stats=stats)
     except Exception as e:
         logging.exception(f"Error during email dispatch in folder {folder}: {e}")
 
@@ -301,5 +1997,18 @@ if __name__ == "__main__":
     import argparse
     parser = argparse.ArgumentParser(description="Chapar Email Dispatcher")
     parser.add_argument("folder", help="Folder containing the email template and recipients CSV file")
+    parser.add_argument("--profile", action="store_true", help="Print the time spent in each dispatch stage when the run ends")
+    parser.add_argument("--profile-dump", metavar="FILE", help="Also write cProfile statistics for the run to FILE, for use with pstats")
     args = parser.parse_args()
-    main(args.folder)
\ No newline at end of file
+
+    stats = DispatchStats() if args.profile or args.profile_dump else None
+    if args.profile_dump:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.runcall(main, args.folder, stats)
+        profiler.dump_stats(args.profile_dump)
+        logging.info(f"Wrote profile statistics to {args.profile_dump}")
+    else:
+        main(args.folder, stats)
+    if stats:
+        print(stats.format_report())
\ No newline at end of file
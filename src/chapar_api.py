@@ -1,14 +1,19 @@
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify
 from werkzeug.utils import secure_filename
 import os
 import re
 import io
+import gzip
 import smtplib
 import chapar
+import chapar_jobs
+import chapar_metrics
+import chapar_templates
 import configparser
 import tempfile
 import shutil
 import logging
+import threading
 import magic
 from flask import send_from_directory, render_template
 import csv
@@ -24,6 +29,15 @@ GENERIC_CONFIG_ERROR = 'Invalid configuration file'
 GENERIC_SMTP_ERROR = 'Email delivery failed'
 GENERIC_VALIDATION_ERROR = 'Validation failed'
 GENERIC_INTERNAL_ERROR = 'Internal server error'
+GENERIC_JOB_NOT_FOUND_ERROR = 'Job not found'
+
+# Template previews: HTML beyond this many characters is cut off, and recipients
+# are sent in pages of RECIPIENTS_PAGE_SIZE rows unless the client asks for more.
+TEMPLATE_PREVIEW_CHARS = 200 * 1024
+RECIPIENTS_PAGE_SIZE = 100
+MAX_RECIPIENTS_PAGE_SIZE = 1000
+CURSOR_ETAG_CHARS = 16
+GZIP_LEVEL = 6
 
 
 def _safe_template_path(base_dir: str, template_name: str) -> str:
@@ -40,62 +54,207 @@ ALLOWED_EXTENSIONS = {'html', 'csv', 'ini'}
 MAX_FILE_SIZE = 10 * 1024 * 1024  # 10MB
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 
+JOB_WORKERS = int(os.getenv('JOB_WORKERS', '4'))
+MAX_PENDING_JOBS = int(os.getenv('MAX_PENDING_JOBS', '100'))
+MAX_JOB_CONCURRENCY = int(os.getenv('MAX_JOB_CONCURRENCY', '10'))
+MAX_JOB_PROCESSES = int(os.getenv('MAX_JOB_PROCESSES', '1'))
+JOB_STATE_FOLDER = os.getenv('JOB_STATE_FOLDER', os.path.join(tempfile.gettempdir(), 'chapar-jobs'))
+JOBS = chapar_jobs.JobManager(JOB_WORKERS, MAX_PENDING_JOBS, JOB_STATE_FOLDER)
+SMTP_SESSIONS = chapar.SMTPSessionCache(
+    max_size=int(os.getenv('SMTP_POOL_SIZE', '8')),
+    idle_timeout=float(os.getenv('SMTP_IDLE_TIMEOUT', '60')),
+)
+METRICS = chapar_metrics.MetricsRegistry()
+METRICS.add_gauge('chapar_jobs_active', 'Dispatch jobs currently sending.', JOBS.running_count)
+METRICS.add_gauge('chapar_jobs_queued', 'Dispatch jobs waiting for a free worker.', JOBS.queued_count)
+METRICS.add_gauge('chapar_smtp_sessions_idle', 'Authenticated SMTP sessions cached for reuse.', lambda: len(SMTP_SESSIONS))
+# Uploaded templates have no stable name, so their metrics share one label.
+UPLOAD_TEMPLATE_LABEL = 'upload'
+GENERIC_JOB_QUEUE_FULL_ERROR = 'Too many dispatch jobs in progress, try again later'
+
+EMAIL_PATTERN = re.compile(r'^[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}$')
+UPLOAD_CHUNK_SIZE = 64 * 1024
+# libmagic identifies text formats from the start of the file.
+MAGIC_SNIFF_BYTES = 2048
+UPLOAD_MIME_TYPES = {
+    'template': ['text/html'],
+    'recipients': ['text/csv', 'text/plain'],
+    'config': ['text/plain', 'text/x-ini'],
+}
+_MAGIC = None
+_MAGIC_LOCK = threading.Lock()
+
+
+class RecipientsError(ValueError):
+    """Raised when an uploaded recipients file cannot be read or holds invalid addresses."""
+
+
+class JobLimitError(ValueError):
+    """Raised when an uploaded configuration asks for more than the server allows API jobs."""
+
+
 def validate_email(email):
     """Validates an email address format."""
-    pattern = r'^[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}$'
-    return re.match(pattern, email) is not None
+    return EMAIL_PATTERN.match(email) is not None
 
-def validate_recipients_file(filepath):
-    """Validates email addresses in the recipients file."""
+def check_recipients(rows):
+    """Validates the email addresses in parsed recipients CSV rows and counts the recipients.
+
+    Returns:
+        The number of non-blank rows after the header, as ``chapar.count_recipients`` counts them.
+    """
+    header = next(rows, None) or []
+    column = header.index('email') if 'email' in header else None
     invalid_emails = []
-    with open(filepath, 'r', encoding='utf-8') as file:
-        reader = csv.DictReader(file)
-        for row in reader:
-            email = row.get('email', '').strip()
-            if email and not validate_email(email):
-                invalid_emails.append(email)
-    
+    count = 0
+    for row in rows:
+        if not row:
+            continue
+        count += 1
+        email = row[column].strip() if column is not None and column < len(row) else ''
+        if email and not validate_email(email):
+            invalid_emails.append(email)
+
     if invalid_emails:
-        raise ValueError(f"Invalid email addresses found: {', '.join(invalid_emails[:5])}" +
-                        (f" and {len(invalid_emails)-5} more" if len(invalid_emails) > 5 else ""))
+        raise RecipientsError(f"Invalid email addresses found: {', '.join(invalid_emails[:5])}" +
+                              (f" and {len(invalid_emails)-5} more" if len(invalid_emails) > 5 else ""))
+    return count
 
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
-def validate_file_content(filepath, expected_mime_types):
-    """Validates the file content type using python-magic."""
-    mime = magic.Magic(mime=True).from_file(filepath)
+def sniff_mime_type(head):
+    """Returns the MIME type libmagic detects for the first bytes of a file.
+
+    One libmagic handle is shared by all requests, since opening one loads the
+    whole magic database.
+    """
+    global _MAGIC
+    with _MAGIC_LOCK:
+        if _MAGIC is None:
+            _MAGIC = magic.Magic(mime=True)
+        return _MAGIC.from_buffer(head)
+
+def validate_file_content(head, expected_mime_types):
+    """Validates the content type of a file from its first bytes using python-magic."""
+    mime = sniff_mime_type(head)
     if not any(mime.startswith(expected) for expected in expected_mime_types):
         raise ValueError(f"Invalid file content type. Expected one of {expected_mime_types}, got {mime}")
 
 
+class _UploadReader(io.RawIOBase):
+    """Reads an uploaded file once, copying it to ``target`` as it goes.
+
+    Reading fails as soon as more than MAX_FILE_SIZE bytes come in, and the content
+    type is checked once the first MAGIC_SNIFF_BYTES have been read.
+    """
+
+    def __init__(self, stream, target, filename, expected_mime_types):
+        self._stream = stream
+        self._target = target
+        self._filename = filename
+        self._expected_mime_types = expected_mime_types
+        self._head = b''
+        self._sniffed = False
+        self.size = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        data = self._stream.read(len(buffer))
+        if not data:
+            self._sniff()
+            return 0
+        self.size += len(data)
+        if self.size > MAX_FILE_SIZE:
+            raise ValueError(f"File {self._filename} exceeds maximum size of {MAX_FILE_SIZE} bytes")
+        if not self._sniffed:
+            self._head += data[:MAGIC_SNIFF_BYTES - len(self._head)]
+            if len(self._head) >= MAGIC_SNIFF_BYTES:
+                self._sniff()
+        self._target.write(data)
+        buffer[:len(data)] = data
+        return len(data)
+
+    def _sniff(self):
+        if not self._sniffed:
+            self._sniffed = True
+            validate_file_content(self._head, self._expected_mime_types)
+
+
 def save_uploaded_files(files, temp_dir):
-    """Saves uploaded files to a temporary directory and validates them."""
+    """Saves uploaded files to a temporary directory, validating them as they are read.
+
+    Every file is read once: it is written to disk in chunks while its size is
+    checked, its content type is sniffed from its first bytes, and the recipients
+    list is parsed and its addresses validated on the way through.
+
+    Returns:
+        The saved file paths by form field, and the number of recipients.
+
+    Raises:
+        RecipientsError: If the recipients file is not valid UTF-8 CSV or holds an
+            invalid address.
+        ValueError: If a file is missing, too large, or of the wrong type.
+    """
     file_paths = {}
+    recipient_count = None
     for key, filename in files.items():
         if key not in request.files:
             raise ValueError(f'Missing {key} file')
 
         file = request.files[key]
-
-        file.seek(0, os.SEEK_END)
-        file_length = file.tell()
-        if file_length > MAX_FILE_SIZE:
-            raise ValueError(f"File {filename} exceeds maximum size of {MAX_FILE_SIZE} bytes")
-        file.seek(0)
-
         if not allowed_file(file.filename):
             raise ValueError(f'Invalid file type for {key}')
 
         filepath = os.path.join(temp_dir, filename)
-        file.save(filepath)
+        with open(filepath, 'wb') as target:
+            reader = _UploadReader(file.stream, target, filename, UPLOAD_MIME_TYPES[key])
+            if key == 'recipients':
+                text = io.TextIOWrapper(io.BufferedReader(reader, UPLOAD_CHUNK_SIZE), encoding='utf-8', newline='')
+                try:
+                    recipient_count = check_recipients(csv.reader(text))
+                except (UnicodeDecodeError, csv.Error) as e:
+                    raise RecipientsError(f"Unreadable recipients file: {e}")
+            else:
+                buffer = bytearray(UPLOAD_CHUNK_SIZE)
+                while reader.readinto(buffer):
+                    pass
         file_paths[key] = filepath
 
-    validate_file_content(file_paths['template'], ['text/html'])
-    validate_file_content(file_paths['recipients'], ['text/csv', 'text/plain'])
-    validate_file_content(file_paths['config'], ['text/plain', 'text/x-ini'])
+    return file_paths, recipient_count
 
-    return file_paths
+
+def check_job_limits(config_path):
+    """Checks that an uploaded configuration stays within the limits set for API jobs.
+
+    Settings that cannot be parsed are left for ``chapar.load_config`` to reject
+    when the job starts.
+
+    Raises:
+        JobLimitError: If [Settings] or a relay section asks for more than
+            MAX_JOB_CONCURRENCY connections, or [Settings] for more than
+            MAX_JOB_PROCESSES worker processes.
+    """
+    config = configparser.ConfigParser()
+    try:
+        config.read(config_path, encoding='utf-8')
+    except configparser.Error:
+        return
+    for section in ['Settings'] + chapar.relay_sections(config):
+        try:
+            concurrency = int(config[section].get('Concurrency', '1')) if section in config else 1
+        except ValueError:
+            continue
+        if concurrency > MAX_JOB_CONCURRENCY:
+            raise JobLimitError(f"Concurrency in [{section}] must be at most {MAX_JOB_CONCURRENCY}.")
+    try:
+        processes = int(config['Settings'].get('Processes', '1')) if 'Settings' in config else 1
+    except ValueError:
+        return
+    if processes > MAX_JOB_PROCESSES:
+        raise JobLimitError(f"Processes must be at most {MAX_JOB_PROCESSES}.")
 
 
 @app.route('/')
@@ -107,29 +266,11 @@ def index():
 def list_templates():
     """API endpoint to list available template folders."""
     try:
-        templates = []
-        base_dir = os.path.dirname(os.path.abspath(__file__))
-
-        for item in os.listdir(base_dir):
-            item_path = os.path.join(base_dir, item)
-            if os.path.isdir(item_path):
-                # Check if directory contains required files
-                has_html = os.path.exists(os.path.join(item_path, 'email_template.html'))
-                has_csv = os.path.exists(os.path.join(item_path, 'recipients.csv'))
-                has_ini = os.path.exists(os.path.join(item_path, 'config.ini'))
-
-                if has_html and has_csv and has_ini:
-                    try:
-                        desc = get_template_description(item_path)
-                        templates.append({
-                            'name': item,
-                            'description': desc
-                        })
-                    except Exception:
-                        logging.exception("Error processing template %s", item)
-
-        templates.sort(key=lambda x: x['name'])
-        return jsonify(templates)
+        body, etag = TEMPLATES.listing()
+        etag = _representation_etag(etag)
+        if etag in request.if_none_match:
+            return _not_modified(etag)
+        return _json_response(body, etag)
     except Exception:
         logging.exception("Error listing templates")
         return jsonify({'error': GENERIC_LIST_TEMPLATES_ERROR}), 500
@@ -149,6 +290,12 @@ def get_template_description(folder_path):
         logging.exception("Error getting template description")
         return os.path.basename(folder_path)
 
+TEMPLATES = chapar_templates.TemplateRegistry(
+    os.path.dirname(os.path.abspath(__file__)),
+    get_template_description,
+    check_interval=float(os.getenv('TEMPLATE_CHECK_INTERVAL', '1')),
+)
+
 @app.route('/api/run-template', methods=['POST'])
 def run_template():
     """API endpoint to run an existing template folder."""
@@ -178,65 +325,157 @@ def run_template():
                 return jsonify({'error': f'Missing required file: {name}'}), 400
 
         try:
-            chapar.main(template_path)
-            result = {'status': 'success', 'message': 'Emails sent successfully'}
-        except Exception:
-            logging.exception("Error during email dispatch")
-            return jsonify({'status': 'error', 'message': GENERIC_EMAIL_DISPATCH_ERROR}), 500
-        
-        return jsonify(result)
+            job = JOBS.submit(
+                'run-template',
+                template_folder,
+                lambda progress: chapar.dispatch_folder(
+                    template_path, progress, METRICS.job_stats(template_folder), SMTP_SESSIONS),
+                lambda error: GENERIC_EMAIL_DISPATCH_ERROR,
+            )
+        except RuntimeError:
+            return jsonify({'status': 'error', 'message': GENERIC_JOB_QUEUE_FULL_ERROR}), 503
+
+        return _job_accepted(job)
         
     except Exception:
         logging.exception("Unexpected error")
         return jsonify({'error': GENERIC_INTERNAL_ERROR}), 500
     
-@app.route('/templates/<template_folder>')
-def get_template(template_folder):
-    base_dir = os.path.dirname(os.path.abspath(__file__))
+def _find_template(template_folder):
+    """Looks up a complete template folder, returning it or the error response to send."""
     try:
-        template_path = _safe_template_path(base_dir, template_folder)
+        _safe_template_path(TEMPLATES.base_dir, template_folder)
     except ValueError:
-        return jsonify({'error': 'Invalid template path'}), 400
+        return None, (jsonify({'error': 'Invalid template path'}), 400)
+    template = TEMPLATES.get(template_folder)
+    if template is None:
+        return None, (jsonify({'error': 'Template not found'}), 404)
+    if not template.complete:
+        return None, (jsonify({'error': 'Template files incomplete'}), 404)
+    return template, None
+
+
+def _redacted_config(config_path):
+    cfg_parser = configparser.ConfigParser()
+    cfg_parser.read(config_path, encoding='utf-8')
+    for section in ['SMTP'] + chapar.relay_sections(cfg_parser):
+        if cfg_parser.has_section(section) and cfg_parser.has_option(section, 'Password'):
+            cfg_parser.set(section, 'Password', '***REDACTED***')
+    buf = io.StringIO()
+    cfg_parser.write(buf)
+    return buf.getvalue()
 
-    if not os.path.exists(template_path):
-        return jsonify({'error': 'Template not found'}), 404
 
+@app.route('/templates/<template_folder>')
+def get_template(template_folder):
+    """API endpoint to preview a template: its HTML, redacted config and the shape of its recipient list."""
     try:
-        html_path = os.path.join(template_path, 'email_template.html')
-        config_path = os.path.join(template_path, 'config.ini')
-        csv_path = os.path.join(template_path, 'recipients.csv')
-
-        if not all(os.path.exists(p) for p in [html_path, config_path, csv_path]):
-            return jsonify({'error': 'Template files incomplete'}), 404
-
-        with open(html_path, 'r', encoding='utf-8') as f:
-            html_content = f.read()
-
-        with open(config_path, 'r', encoding='utf-8') as f:
-            raw_config = f.read()
-
-        with open(csv_path, 'r', encoding='utf-8') as f:
-            csv_content = f.read()
-
-        cfg_parser = configparser.ConfigParser()
-        cfg_parser.read_string(raw_config)
-        for sensitive_key in ('password', 'Password'):
-            if cfg_parser.has_section('SMTP') and cfg_parser.has_option('SMTP', sensitive_key):
-                cfg_parser.set('SMTP', sensitive_key, '***REDACTED***')
-        buf = io.StringIO()
-        cfg_parser.write(buf)
-        config_content = buf.getvalue()
-
-        return jsonify({
-            'html': html_content,
-            'config': config_content,
-            'csv': csv_content,
+        template, error = _find_template(template_folder)
+        if error:
+            return error
+        etag = _representation_etag(template.etag)
+        if etag in request.if_none_match:
+            return _not_modified(etag)
+
+        with open(template.file_path('email_template.html'), 'r', encoding='utf-8') as f:
+            html_content = f.read(TEMPLATE_PREVIEW_CHARS + 1)
+        recipients = template.recipients()
+
+        return _json_response({
+            'html': html_content[:TEMPLATE_PREVIEW_CHARS],
+            'html_truncated': len(html_content) > TEMPLATE_PREVIEW_CHARS,
+            'config': _redacted_config(template.file_path('config.ini')),
+            'recipients': {
+                'columns': recipients.columns,
+                'total': recipients.total,
+                'url': f'/templates/{template_folder}/recipients',
+            },
             'name': template_folder
-        })
+        }, etag)
     except Exception:
         logging.exception("Error reading template")
         return jsonify({'error': GENERIC_TEMPLATE_READ_ERROR}), 500
-     
+
+
+@app.route('/templates/<template_folder>/recipients')
+def get_template_recipients(template_folder):
+    """API endpoint to read the recipients of a template a page at a time.
+
+    Takes ``limit`` and either ``offset`` or the ``cursor`` returned with the
+    previous page. A cursor points straight at the next row in the file, so it is
+    the faster way to walk the whole list; it expires when the file changes.
+    """
+    try:
+        template, error = _find_template(template_folder)
+        if error:
+            return error
+        try:
+            limit = int(request.args.get('limit', RECIPIENTS_PAGE_SIZE))
+            if not 1 <= limit <= MAX_RECIPIENTS_PAGE_SIZE:
+                raise ValueError(limit)
+            if 'cursor' in request.args:
+                offset, start = _parse_cursor(request.args['cursor'], template.etag)
+            else:
+                offset, start = int(request.args.get('offset', 0)), None
+                if offset < 0:
+                    raise ValueError(offset)
+        except ValueError:
+            return jsonify({'error': 'Invalid offset, limit or cursor'}), 400
+
+        etag = _representation_etag(f'{template.etag}.{offset}.{limit}')
+        if etag in request.if_none_match:
+            return _not_modified(etag)
+
+        recipients = template.recipients()
+        if start is not None and not recipients.is_row_start(start):
+            return jsonify({'error': 'Invalid offset, limit or cursor'}), 400
+        rows, end = recipients.page(offset, limit, start)
+        next_offset = offset + len(rows)
+        return _json_response({
+            'columns': recipients.columns,
+            'rows': rows,
+            'total': recipients.total,
+            'offset': offset,
+            'limit': limit,
+            'next_cursor': f'{next_offset}.{end}.{template.etag[:CURSOR_ETAG_CHARS]}' if rows and next_offset < recipients.total else None,
+        }, etag)
+    except Exception:
+        logging.exception("Error reading template recipients")
+        return jsonify({'error': GENERIC_TEMPLATE_READ_ERROR}), 500
+
+
+def _parse_cursor(cursor, etag):
+    """Returns the row and byte offsets in a recipients cursor, if it was made for this version of the file."""
+    offset, start, version = cursor.split('.')
+    if version != etag[:CURSOR_ETAG_CHARS] or int(offset) < 0 or int(start) < 0:
+        raise ValueError(cursor)
+    return int(offset), int(start)
+
+
+def _representation_etag(etag):
+    """Returns the ETag of the response to this request, which differs for gzip-compressed bodies."""
+    return etag + '-gzip' if 'gzip' in request.accept_encodings else etag
+
+
+def _not_modified(etag):
+    response = Response(status=304)
+    response.set_etag(etag)
+    response.vary.add('Accept-Encoding')
+    return response
+
+
+def _json_response(payload, etag):
+    """Sends JSON with an ETag, gzip-compressed if the client accepts it."""
+    body = payload if isinstance(payload, bytes) else app.json.dumps(payload).encode('utf-8')
+    if 'gzip' in request.accept_encodings:
+        response = Response(gzip.compress(body, compresslevel=GZIP_LEVEL), mimetype='application/json')
+        response.headers['Content-Encoding'] = 'gzip'
+    else:
+        response = Response(body, mimetype='application/json')
+    response.set_etag(etag)
+    response.vary.add('Accept-Encoding')
+    return response
+
 
 @app.route('/api/send', methods=['POST'])
 def send_emails():
@@ -255,7 +494,9 @@ def send_emails():
         }
 
         try:
-            file_paths = save_uploaded_files(files, temp_dir)
+            file_paths, recipient_count = save_uploaded_files(files, temp_dir)
+        except RecipientsError:
+            return jsonify({'error': GENERIC_RECIPIENTS_ERROR}), 400
         except ValueError:
             return jsonify({'error': GENERIC_FILE_UPLOAD_ERROR}), 400
         except Exception:
@@ -263,32 +504,75 @@ def send_emails():
             return jsonify({'error': GENERIC_FILE_UPLOAD_ERROR}), 500
 
         try:
-            validate_recipients_file(file_paths['recipients'])
-        except ValueError:
-            return jsonify({'error': GENERIC_RECIPIENTS_ERROR}), 400
+            check_job_limits(file_paths['config'])
+        except JobLimitError as e:
+            return jsonify({'error': str(e)}), 400
 
+        job_dir = temp_dir
         try:
-            chapar.send_emails_from_files(file_paths['config'], file_paths['recipients'], file_paths['template'])
-            result = {'status': 'success', 'message': 'Emails sent successfully'}
-        except configparser.Error:
-            return jsonify({'error': GENERIC_CONFIG_ERROR}), 400
-        except smtplib.SMTPException:
-            return jsonify({'error': GENERIC_SMTP_ERROR}), 500
-        except ValueError:
-            return jsonify({'error': GENERIC_VALIDATION_ERROR}), 400
-        except Exception:
-            logging.exception("Error during email dispatch")
-            return jsonify({'status': 'error', 'message': GENERIC_EMAIL_DISPATCH_ERROR}), 500
-
-        return jsonify(result)
+            job = JOBS.submit(
+                'send',
+                os.path.basename(temp_dir),
+                lambda progress: chapar.send_emails_from_files(
+                    file_paths['config'], file_paths['recipients'], file_paths['template'], progress,
+                    METRICS.job_stats(UPLOAD_TEMPLATE_LABEL), SMTP_SESSIONS, recipient_count),
+                _describe_send_error,
+                lambda: _remove_dir(job_dir),
+            )
+        except RuntimeError:
+            return jsonify({'status': 'error', 'message': GENERIC_JOB_QUEUE_FULL_ERROR}), 503
+        # The job owns the uploaded files from here and removes them when it is done.
+        temp_dir = None
+
+        return _job_accepted(job)
 
     except Exception:
         logging.exception("Unexpected error")
         return jsonify({'error': GENERIC_INTERNAL_ERROR}), 500
     
     finally:
-        if temp_dir and os.path.exists(temp_dir):
-            shutil.rmtree(temp_dir)
+        if temp_dir:
+            _remove_dir(temp_dir)
+
+
+def _remove_dir(path):
+    if path and os.path.exists(path):
+        shutil.rmtree(path)
+
+
+def _describe_send_error(error):
+    """Maps an error from an upload dispatch to the generic message reported to clients."""
+    if isinstance(error, configparser.Error):
+        return GENERIC_CONFIG_ERROR
+    if isinstance(error, smtplib.SMTPException):
+        return GENERIC_SMTP_ERROR
+    if isinstance(error, ValueError):
+        return GENERIC_VALIDATION_ERROR
+    return GENERIC_EMAIL_DISPATCH_ERROR
+
+
+def _job_accepted(job):
+    return jsonify({
+        'status': chapar_jobs.QUEUED,
+        'message': 'Email dispatch started',
+        'job_id': job.id,
+        'status_url': f'/api/jobs/{job.id}',
+    }), 202
+
+
+@app.route('/api/jobs', methods=['GET'])
+def list_jobs():
+    """API endpoint to list the dispatch jobs started by this server process."""
+    return jsonify(JOBS.list())
+
+
+@app.route('/api/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    """API endpoint to report the status and progress of a dispatch job."""
+    job = JOBS.get(job_id)
+    if job is None:
+        return jsonify({'error': GENERIC_JOB_NOT_FOUND_ERROR}), 404
+    return jsonify(job)
 
 @app.route('/api/health', methods=['GET'])
 def health_check():
@@ -296,6 +580,12 @@ def health_check():
     return jsonify({'status': 'healthy'})
 
 
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """Prometheus endpoint with the dispatch counters, latencies and job gauges of this process."""
+    return Response(METRICS.render(), mimetype=chapar_metrics.CONTENT_TYPE)
+
+
 if __name__ == '__main__':
     os.makedirs(UPLOAD_FOLDER, exist_ok=True)
     app.run(host='0.0.0.0', port=5000)
\ No newline at end of file
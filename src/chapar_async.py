@@ -0,0 +1,386 @@
+import asyncio
+import base64
+import logging
+import re
+import smtplib
+import ssl
+import time
+from typing import Dict, Iterable, List, Optional, Tuple, Union
+
+import chapar
+
+_EOL_RE = re.compile(r'(?:\r\n|\n|\r(?!\n))')
+_LEADING_DOT_RE = re.compile(br'(?m)^\.')
+
+
+class AsyncSMTP:
+    """A minimal SMTP client built on asyncio streams.
+
+    Only the commands Chapar needs are implemented: EHLO, STARTTLS, AUTH, MAIL, RCPT,
+    DATA, NOOP and QUIT. Errors are raised as the matching ``smtplib`` exceptions so
+    callers can handle both engines the same way.
+    """
+
+    def __init__(self, host: str, port: int, timeout: float = 10, security: str = 'auto', ca_file: str = ''):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.security = security
+        self.ca_file = ca_file
+        self.features: Dict[str, str] = {}
+        self._reader: Optional[asyncio.StreamReader] = None
+        self._writer: Optional[asyncio.StreamWriter] = None
+
+    async def connect(self) -> None:
+        """Opens the connection and negotiates TLS the same way ``_create_smtp_server`` does.
+
+        Raises:
+            ValueError: If the port is not supported.
+            smtplib.SMTPException: If the server rejects the greeting or TLS negotiation.
+        """
+        context = ssl.create_default_context(cafile=self.ca_file or None)
+        mode = chapar.resolve_security(self.port, self.security)
+        if mode == 'ssl':
+            self._reader, self._writer = await asyncio.wait_for(
+                asyncio.open_connection(self.host, self.port, ssl=context), self.timeout)
+        else:
+            self._reader, self._writer = await asyncio.wait_for(
+                asyncio.open_connection(self.host, self.port), self.timeout)
+
+        code, message = await self._read_reply()
+        if code != 220:
+            raise smtplib.SMTPConnectError(code, message)
+        await self.ehlo()
+
+        if mode != 'ssl':
+            await self._command('STARTTLS', 220)
+            await self._writer.start_tls(context, server_hostname=self.host)
+            await self.ehlo()
+
+    async def ehlo(self) -> None:
+        """Sends EHLO and records the extensions the server advertises."""
+        _, message = await self._command('EHLO chapar', 250)
+        self.features = {}
+        for line in message.splitlines()[1:]:
+            keyword, _, params = line.partition(' ')
+            self.features[keyword.lower()] = params
+
+    async def login(self, email: str, password: str) -> None:
+        """Authenticates with AUTH PLAIN, or AUTH LOGIN if PLAIN is not offered.
+
+        Raises:
+            smtplib.SMTPAuthenticationError: If the server rejects the credentials.
+        """
+        mechanisms = self.features.get('auth', '').upper().split()
+        try:
+            if 'PLAIN' in mechanisms or 'LOGIN' not in mechanisms:
+                token = base64.b64encode(f"\0{email}\0{password}".encode('utf-8')).decode('ascii')
+                await self._command(f'AUTH PLAIN {token}', 235)
+            else:
+                await self._command('AUTH LOGIN', 334)
+                await self._command(base64.b64encode(email.encode('utf-8')).decode('ascii'), 334)
+                await self._command(base64.b64encode(password.encode('utf-8')).decode('ascii'), 235)
+        except smtplib.SMTPResponseException as e:
+            raise smtplib.SMTPAuthenticationError(e.smtp_code, e.smtp_error)
+
+    async def sendmail(self, from_addr: str, to_addrs: List[str], msg: Union[bytes, str]) -> Dict[str, Tuple[int, str]]:
+        """Sends one message in a single SMTP transaction.
+
+        Args:
+            from_addr: The envelope sender.
+            to_addrs: The envelope recipients.
+            msg: The serialized message. Bytes must already use CRLF line endings.
+
+        Returns:
+            The recipients the server refused, mapped to their (code, message) reply,
+            like ``smtplib.SMTP.sendmail``.
+
+        Raises:
+            smtplib.SMTPSenderRefused: If MAIL FROM is rejected.
+            smtplib.SMTPRecipientsRefused: If every recipient is rejected.
+            smtplib.SMTPDataError: If the message data is rejected.
+            ValueError: If the sender contains a line break.
+        """
+        code, message = await self._command(f'MAIL FROM:<{from_addr}>')
+        if code != 250:
+            await self._reset()
+            raise smtplib.SMTPSenderRefused(code, message.encode('utf-8'), from_addr)
+
+        refused = {}
+        for address in to_addrs:
+            try:
+                code, message = await self._command(f'RCPT TO:<{address}>')
+            except ValueError as e:
+                # Not sent: an address with a line break would inject commands.
+                code, message = 501, str(e)
+            if code not in (250, 251):
+                refused[address] = (code, message.encode('utf-8'))
+        if len(refused) == len(to_addrs):
+            await self._reset()
+            raise smtplib.SMTPRecipientsRefused(refused)
+
+        code, message = await self._command('DATA')
+        if code != 354:
+            await self._reset()
+            raise smtplib.SMTPDataError(code, message.encode('utf-8'))
+
+        if isinstance(msg, str):
+            msg = _EOL_RE.sub('\r\n', msg).encode('ascii')
+        data = _LEADING_DOT_RE.sub(b'..', msg)
+        if not data.endswith(b'\r\n'):
+            data += b'\r\n'
+        self._writer.write(data + b'.\r\n')
+        await self._writer.drain()
+        code, message = await self._read_reply()
+        if code != 250:
+            await self._reset()
+            raise smtplib.SMTPDataError(code, message.encode('utf-8'))
+        return refused
+
+    async def noop(self) -> int:
+        """Sends NOOP and returns the reply code."""
+        code, _ = await self._command('NOOP')
+        return code
+
+    async def quit(self) -> None:
+        """Sends QUIT and closes the connection, ignoring errors from a dead session."""
+        if self._writer is None:
+            return
+        try:
+            await self._command('QUIT')
+        except (OSError, asyncio.TimeoutError, smtplib.SMTPException):
+            pass
+        self._writer.close()
+        try:
+            await self._writer.wait_closed()
+        except (OSError, ssl.SSLError):
+            pass
+        self._writer = None
+
+    async def _reset(self) -> None:
+        try:
+            await self._command('RSET')
+        except smtplib.SMTPException:
+            pass
+
+    async def _command(self, line: str, expected: Optional[int] = None) -> Tuple[int, str]:
+        if self._writer is None:
+            raise smtplib.SMTPServerDisconnected("please run connect() first")
+        if '\r' in line or '\n' in line:
+            raise ValueError("command and arguments contain prohibited newline characters")
+        self._writer.write(line.encode('utf-8') + b'\r\n')
+        await self._writer.drain()
+        code, message = await self._read_reply()
+        if expected is not None and code != expected:
+            raise smtplib.SMTPResponseException(code, message)
+        return code, message
+
+    async def _read_reply(self) -> Tuple[int, str]:
+        lines = []
+        while True:
+            raw = await asyncio.wait_for(self._reader.readline(), self.timeout)
+            if not raw:
+                raise smtplib.SMTPServerDisconnected("Connection unexpectedly closed")
+            text = raw.decode('utf-8', 'replace').rstrip('\r\n')
+            try:
+                code = int(text[:3])
+            except ValueError:
+                raise smtplib.SMTPResponseException(-1, text)
+            lines.append(text[4:])
+            if text[3:4] != '-':
+                return code, '\n'.join(lines)
+
+
+async def _open_session(smtp_settings: Dict[str, str], stats: Optional[chapar.DispatchStats] = None) -> AsyncSMTP:
+    session = AsyncSMTP(smtp_settings['host'], int(smtp_settings['port']), security=smtp_settings.get('security', 'auto'),
+                        ca_file=smtp_settings.get('ca_file', ''))
+    try:
+        started = time.perf_counter()
+        await session.connect()
+        connected_at = time.perf_counter()
+        await session.login(smtp_settings['email'], smtp_settings['password'])
+        if stats:
+            stats.record('connect', connected_at - started)
+            stats.record('login', time.perf_counter() - connected_at)
+    except smtplib.SMTPException as e:
+        await session.quit()
+        raise smtplib.SMTPException(f"SMTP authentication error: {e}")
+    except BaseException:
+        await session.quit()
+        raise
+    return session
+
+
+async def dispatch_async(smtp_settings: Dict[str, str], recipients: Iterable[Dict[str, str]], html_content: chapar.MessageBuilder, limiter: Optional[chapar.RateLimiter], log_level: str, template_name: str, concurrency: int, throttle: Optional[chapar.AdaptiveThrottle] = None, journal: Optional[chapar.SendJournal] = None, progress: Optional[chapar.DispatchProgress] = None, stats: Optional[chapar.DispatchStats] = None, batch_size: int = 1, retry: Optional[chapar.RetryPolicy] = None) -> Tuple[int, int]:
+    """Sends the email to every recipient over ``concurrency`` SMTP sessions on one event loop.
+
+    Recipients are fed through a bounded queue, so at most one message per session is
+    built and in flight at any time, and the recipient source is only read as fast as
+    the sessions drain it. Temporary failures are retried, dropped sessions are
+    reopened, and recipients of a template without placeholders are batched, as in
+    ``chapar._dispatch``.
+
+    Args:
+        smtp_settings: A dictionary containing the SMTP settings.
+        recipients: The recipients, each a dictionary with 'email' and 'name' keys.
+        html_content: The message builder for the job.
+        limiter: The rate limiter shared by all sessions, or None for no limit.
+        log_level: The logging level.
+        template_name: The name of the email template.
+        concurrency: The number of SMTP sessions to keep open.
+        throttle: The adaptive throttle driving ``limiter``, or None for a fixed rate.
+        journal: The send journal to record delivered recipients in, or None.
+        progress: Live counters to update as recipients finish, or None.
+        stats: Stage timers to record the time spent in each step in, or None.
+        batch_size: The most recipients to send one message to in a transaction. The
+            caller only passes more than 1 for templates without placeholders.
+        retry: How to reconnect and retry temporary failures, or None.
+
+    Returns:
+        A tuple of (success_count, failure_count).
+    """
+    results = await asyncio.gather(
+        *(_open_session(smtp_settings, stats) for _ in range(concurrency)), return_exceptions=True)
+    sessions: List[Optional[AsyncSMTP]] = [r for r in results if isinstance(r, AsyncSMTP)]
+    errors = [r for r in results if not isinstance(r, AsyncSMTP)]
+    if errors:
+        await asyncio.gather(*(session.quit() for session in sessions))
+        raise errors[0]
+    logging.info(f"Opened {len(sessions)} asyncio SMTP sessions for template {template_name}")
+
+    max_attempts = chapar.max_send_attempts(retry, throttle)
+    counts = {chapar.SEND_OK: 0, chapar.SEND_FAILED: 0}
+    retry_queue: List[Dict[str, str]] = []
+    state = {'final': max_attempts == 1, 'error': None}
+    work: asyncio.Queue = asyncio.Queue(maxsize=concurrency * 2)
+
+    async def reconnect(slot: int) -> None:
+        await sessions[slot].quit()
+        sessions[slot] = None
+        error: Exception = smtplib.SMTPServerDisconnected("SMTP connection lost")
+        for attempt in range(1, retry.max_reconnects + 1):
+            delay = retry.delay(attempt)
+            logging.warning(f"SMTP connection lost while sending template {template_name}; reconnecting in {delay:g}s (attempt {attempt} of {retry.max_reconnects})")
+            await asyncio.sleep(delay)
+            try:
+                sessions[slot] = await _open_session(smtp_settings, stats)
+                logging.info(f"Reconnected to {smtp_settings['host']} for template {template_name}")
+                return
+            except (smtplib.SMTPException, OSError) as e:
+                error = e
+        raise error
+
+    async def wait_for_token(email: str) -> None:
+        delay = limiter.reserve(email)
+        if delay > 0:
+            await asyncio.sleep(delay)
+            if stats:
+                stats.record('throttle', delay)
+
+    async def send_one(session: AsyncSMTP, recipient: Dict[str, str]) -> List[str]:
+        email = recipient['email']
+        if limiter:
+            await wait_for_token(email)
+        try:
+            message = html_content.build(email, recipient, stats)
+            started = time.perf_counter()
+            try:
+                await session.sendmail(smtp_settings['email'], [email], message)
+            finally:
+                if stats:
+                    stats.record('smtp', time.perf_counter() - started)
+            if log_level == 'detailed':
+                logging.info(f"Sent template {template_name} to {email} succeeded")
+            return [chapar.SEND_OK]
+        except Exception as e:
+            logging.error(f"Failed to send email to {email} from template {template_name}: {e}")
+            return [chapar.classify_send_error(e)]
+
+    async def send_batch(session: AsyncSMTP, batch: List[Dict[str, str]]) -> List[str]:
+        emails = [recipient['email'] for recipient in batch]
+        if limiter:
+            for email in emails:
+                await wait_for_token(email)
+        try:
+            message = html_content.build_shared(stats)
+            started = time.perf_counter()
+            try:
+                refused = await session.sendmail(smtp_settings['email'], emails, message)
+            finally:
+                if stats:
+                    stats.record('smtp', time.perf_counter() - started)
+        except smtplib.SMTPRecipientsRefused as e:
+            refused = e.recipients
+        except Exception as e:
+            logging.error(f"Failed to send email to {len(emails)} recipients from template {template_name}: {e}")
+            return [chapar.classify_send_error(e)] * len(emails)
+        return chapar.classify_refusals(emails, refused, log_level, template_name)
+
+    def settle(recipient: Dict[str, str], status: str) -> None:
+        if throttle:
+            throttle.record(status)
+        if journal is not None and status == chapar.SEND_OK:
+            journal.record(recipient['email'])
+        if status in chapar.TRANSIENT_STATUSES and not state['final']:
+            retry_queue.append(recipient)
+            return
+        counts[chapar.SEND_OK if status == chapar.SEND_OK else chapar.SEND_FAILED] += 1
+        if progress:
+            progress.add(status, recipient['email'])
+        if stats:
+            stats.count(status)
+
+    async def worker(slot: int) -> None:
+        while True:
+            item = await work.get()
+            try:
+                if item is None:
+                    return
+                if state['error']:
+                    continue
+                batch = item if batch_size > 1 else [item]
+                send = send_batch if batch_size > 1 else send_one
+                statuses = await send(sessions[slot], item)
+                for recipient, status in zip(batch, statuses):
+                    settle(recipient, status)
+                if retry and chapar.SEND_DISCONNECTED in statuses:
+                    try:
+                        await reconnect(slot)
+                    except Exception as e:
+                        state['error'] = state['error'] or e
+            finally:
+                work.task_done()
+
+    tasks = [asyncio.create_task(worker(slot)) for slot in range(len(sessions))]
+    try:
+        pending: Iterable[Dict[str, str]] = recipients
+        for attempt in range(1, max_attempts + 1):
+            state['final'] = attempt == max_attempts
+            for item in chapar.batches(pending, batch_size) if batch_size > 1 else pending:
+                if state['error']:
+                    break
+                await work.put(item)
+            await work.join()
+            if state['error']:
+                raise state['error']
+            if not retry_queue:
+                break
+            pending = list(retry_queue)
+            retry_queue.clear()
+            delay = retry.delay(attempt) if retry else 0
+            logging.info(f"Retrying {len(pending)} recipients with temporary failures for template {template_name} in {delay:g}s")
+            if delay:
+                await asyncio.sleep(delay)
+        for _ in tasks:
+            await work.put(None)
+        await asyncio.gather(*tasks)
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*(session.quit() for session in sessions if session is not None))
+
+    return counts[chapar.SEND_OK], counts[chapar.SEND_FAILED]
+
+def dispatch(smtp_settings: Dict[str, str], recipients: Iterable[Dict[str, str]], html_content: chapar.MessageBuilder, limiter: Optional[chapar.RateLimiter], log_level: str, template_name: str, concurrency: int, throttle: Optional[chapar.AdaptiveThrottle] = None, journal: Optional[chapar.SendJournal] = None, progress: Optional[chapar.DispatchProgress] = None, stats: Optional[chapar.DispatchStats] = None, batch_size: int = 1, retry: Optional[chapar.RetryPolicy] = None) -> Tuple[int, int]:
+    """Runs ``dispatch_async`` on a new event loop. See ``dispatch_async`` for the arguments."""
+    return asyncio.run(dispatch_async(smtp_settings, recipients, html_content, limiter, log_level, template_name, concurrency, throttle, journal, progress, stats, batch_size, retry))
@@ -0,0 +1,452 @@
+import argparse
+import csv
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import random
+import shutil
+import socketserver
+import ssl
+import sys
+import tempfile
+import threading
+import time
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+from typing import Dict, Iterable, List, Optional
+
+import chapar
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+BENCH_TEMPLATE = """<html>
+<body>
+<h1>Hello {{name}}</h1>
+<p>This is the benchmark newsletter for {{ email }} in {{city}}.</p>
+<p>Lorem ipsum dolor sit amet, consectetur adipiscing elit, sed do eiusmod tempor
+incididunt ut labore et dolore magna aliqua. Ut enim ad minim veniam, quis nostrud
+exercitation ullamco laboris nisi ut aliquip ex ea commodo consequat.</p>
+</body>
+</html>
+"""
+
+CASES = ('template', 'send_files', 'main')
+DEFAULT_SIZES = (1000, 10000, 100000)
+
+# A self-signed certificate for localhost and 127.0.0.1, for the sink's STARTTLS.
+# Jobs sending to the sink trust it through CAFile; it is not a secret.
+CERT_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'chapar_bench_cert.pem')
+KEY_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'chapar_bench_key.pem')
+
+
+class _SinkHandler(socketserver.StreamRequestHandler):
+    """Speaks just enough SMTP to accept and discard messages, after STARTTLS."""
+
+    def handle(self) -> None:
+        sink: SMTPSink = self.server.sink
+        self._reply('220 chapar-bench ESMTP')
+        started = None
+        secure = False
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line[:4].upper()
+            if command in (b'EHLO', b'HELO'):
+                self._reply('250-chapar-bench', '250-AUTH PLAIN LOGIN' if secure else '250-STARTTLS', '250 8BITMIME')
+            elif command == b'STAR' and not secure:
+                self._reply('220 2.0.0 Ready to start TLS')
+                try:
+                    self.request = sink.tls_context.wrap_socket(self.request, server_side=True)
+                except (ssl.SSLError, OSError):
+                    return  # the client did not trust the certificate
+                self.rfile = self.request.makefile('rb', self.rbufsize)
+                self.wfile = self.request.makefile('wb')
+                secure = True
+            elif command in (b'AUTH', b'MAIL', b'RCPT', b'DATA') and not secure:
+                self._reply('530 5.7.0 Must issue a STARTTLS command first')
+            elif command == b'AUTH':
+                if line.split()[1].upper() == b'LOGIN':
+                    self._reply('334 VXNlcm5hbWU6')
+                    self.rfile.readline()
+                    self._reply('334 UGFzc3dvcmQ6')
+                    self.rfile.readline()
+                self._reply('235 2.7.0 Authentication successful')
+            elif command == b'MAIL':
+                started = time.perf_counter()
+                self._reply('250 2.1.0 OK')
+            elif command == b'RCPT':
+                sink.add_recipient()
+                self._reply('250 2.1.5 OK')
+            elif command == b'DATA':
+                self._reply('354 End data with <CR><LF>.<CR><LF>')
+                while self.rfile.readline() not in (b'.\r\n', b''):
+                    pass
+                if sink.latency:
+                    time.sleep(sink.latency)
+                failed = sink.failure_rate and random.random() < sink.failure_rate
+                sink.record(time.perf_counter() - started if started else 0.0, not failed)
+                started = None
+                if failed:
+                    self._reply(f'{sink.failure_code} Rejected by benchmark sink')
+                else:
+                    self._reply('250 2.0.0 Queued')
+            elif command == b'RSET':
+                started = None
+                self._reply('250 2.0.0 OK')
+            elif command == b'NOOP':
+                self._reply('250 2.0.0 OK')
+            elif command == b'QUIT':
+                self._reply('221 2.0.0 Bye')
+                return
+            else:
+                self._reply('502 5.5.2 Command not recognized')
+
+    def _reply(self, *lines: str) -> None:
+        self.wfile.write(''.join(f'{line}\r\n' for line in lines).encode('ascii'))
+        self.wfile.flush()
+
+    def finish(self) -> None:
+        super().finish()
+        if isinstance(self.request, ssl.SSLSocket):
+            self.request.close()
+
+
+class _SinkServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class SMTPSink:
+    """A local SMTP server that accepts every message and throws it away.
+
+    It only takes mail over STARTTLS, with the certificate in CERT_FILE, so chapar
+    connects to it the way it connects to a real relay.
+
+    Each connection is served on its own thread. Latency is measured from MAIL FROM
+    to the reply that ends the DATA phase, so it covers the whole SMTP transaction for
+    one message as the relay sees it. Messages are counted before that reply is sent.
+
+    Args:
+        latency: Seconds to wait before answering the end of each message, to model a
+            remote relay.
+        failure_rate: The fraction of messages to reject, between 0 and 1.
+        failure_code: The reply code rejected messages get, e.g. 550 or 451.
+        host: The address to listen on. The port is picked by the OS.
+    """
+
+    def __init__(self, latency: float = 0.0, failure_rate: float = 0.0, failure_code: int = 550, host: str = '127.0.0.1'):
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.failure_code = failure_code
+        self.accepted = 0
+        self.rejected = 0
+        self.recipients = 0
+        self.latencies = array('d')
+        self._lock = threading.Lock()
+        self.tls_context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+        self.tls_context.load_cert_chain(CERT_FILE, KEY_FILE)
+        self._server = _SinkServer((host, 0), _SinkHandler)
+        self._server.sink = self
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def host(self) -> str:
+        return self._server.server_address[0]
+
+    @property
+    def port(self) -> int:
+        return self._server.server_address[1]
+
+    def add_recipient(self) -> None:
+        with self._lock:
+            self.recipients += 1
+
+    def record(self, latency: float, accepted: bool) -> None:
+        with self._lock:
+            self.latencies.append(latency)
+            if accepted:
+                self.accepted += 1
+            else:
+                self.rejected += 1
+
+    def smtp_settings(self) -> Dict[str, str]:
+        """Returns the settings ``chapar._dispatch`` needs to send to the sink."""
+        return {'host': self.host, 'port': str(self.port), 'security': 'starttls', 'ca_file': CERT_FILE,
+                'email': 'bench@example.com', 'password': 'bench', 'subject': 'Chapar benchmark',
+                'DisplayName': 'Chapar Bench'}
+
+    def start(self) -> 'SMTPSink':
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self) -> 'SMTPSink':
+        return self.start()
+
+    def __exit__(self, *exc_info) -> None:
+        self.stop()
+
+
+def write_recipients(path: str, rows: int) -> None:
+    """Writes a recipients.csv with ``rows`` generated recipients, one row at a time."""
+    cities = ('Tehran', 'Berlin', 'Lisbon', 'Osaka', 'Lima')
+    with open(path, 'w', encoding='utf-8', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['email', 'name', 'city'])
+        for i in range(rows):
+            writer.writerow([f'user{i}@example{i % 97}.com', f'User {i}', cities[i % len(cities)]])
+
+
+def write_job_folder(folder: str, rows: int, sink: SMTPSink, concurrency: int = 1, engine: str = 'threads', processes: int = 1) -> None:
+    """Writes a complete template folder that sends to ``sink``."""
+    os.makedirs(folder, exist_ok=True)
+    write_recipients(os.path.join(folder, 'recipients.csv'), rows)
+    with open(os.path.join(folder, 'email_template.html'), 'w', encoding='utf-8') as f:
+        f.write(BENCH_TEMPLATE)
+    shutil.copyfile(CERT_FILE, os.path.join(folder, 'sink_cert.pem'))
+    with open(os.path.join(folder, 'config.ini'), 'w', encoding='utf-8') as f:
+        f.write(
+            "[SMTP]\n"
+            f"Host = {sink.host}\n"
+            f"Port = {sink.port}\n"
+            "Security = starttls\n"
+            "CAFile = sink_cert.pem\n"
+            "Email = bench@example.com\n"
+            "Password = bench\n"
+            "Subject = Chapar benchmark\n"
+            "DisplayName = Chapar Bench\n"
+            "\n"
+            "[Settings]\n"
+            "Interval = 0\n"
+            "LogLevel = none\n"
+            f"Concurrency = {concurrency}\n"
+            f"Engine = {engine}\n"
+            f"Processes = {processes}\n"
+        )
+
+
+def percentile(values: Iterable[float], fraction: float) -> Optional[float]:
+    """Returns the nearest-rank percentile of ``values``, or None if there are none."""
+    ordered = sorted(values)
+    if not ordered:
+        return None
+    rank = max(int(round(fraction * len(ordered) + 0.5)) - 1, 0)
+    return ordered[min(rank, len(ordered) - 1)]
+
+
+def peak_rss_kb() -> Optional[int]:
+    """Returns the peak resident set size of this process in KiB, where available."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak // 1024 if sys.platform == 'darwin' else peak
+
+
+def _bench_template(folder: str) -> Dict:
+    """Reads the recipients and builds every message without sending it."""
+    with open(os.path.join(folder, 'email_template.html'), 'r', encoding='utf-8') as f:
+        html_content = f.read()
+    smtp_settings = {'email': 'bench@example.com', 'subject': 'Chapar benchmark', 'DisplayName': 'Chapar Bench'}
+    latencies = array('d')
+    start = time.perf_counter()
+    with chapar.open_recipients(os.path.join(folder, 'recipients.csv')) as recipients:
+        builder = chapar.MessageBuilder(smtp_settings, chapar.compile_template(html_content, recipients.fieldnames))
+        for recipient in recipients:
+            started = time.perf_counter()
+            builder.build(recipient['email'], recipient)
+            latencies.append(time.perf_counter() - started)
+    return {'seconds': time.perf_counter() - start, 'sent': len(latencies), 'failed': 0, 'latencies': latencies}
+
+
+def _bench_send(case: str, folder: str, sink: SMTPSink) -> Dict:
+    start = time.perf_counter()
+    if case == 'main':
+        chapar.main(folder)
+    else:
+        chapar.send_emails_from_files(
+            os.path.join(folder, 'config.ini'),
+            os.path.join(folder, 'recipients.csv'),
+            os.path.join(folder, 'email_template.html'),
+        )
+    return {'seconds': time.perf_counter() - start, 'sent': sink.accepted, 'failed': sink.rejected, 'latencies': sink.latencies}
+
+
+def run_case(case: str, rows: int, latency: float = 0.0, failure_rate: float = 0.0, failure_code: int = 550, concurrency: int = 1, engine: str = 'threads', processes: int = 1) -> Dict:
+    """Runs one benchmark case in the current process and returns its result.
+
+    Args:
+        case: One of CASES. 'template' only reads the recipients and builds the
+            messages; 'send_files' and 'main' send them to a local SMTP sink through
+            ``send_emails_from_files`` and ``main``.
+        rows: The number of generated recipients.
+        latency: The sink's per-message latency, in seconds.
+        failure_rate: The fraction of messages the sink rejects.
+        failure_code: The reply code for rejected messages.
+        concurrency: The Concurrency setting for the send cases.
+        engine: The Engine setting for the send cases.
+        processes: The Processes setting for the send cases.
+
+    Returns:
+        A JSON-serializable dictionary with the case parameters, messages/sec, p50 and
+        p99 per-message latency in milliseconds, and the peak RSS of the process.
+    """
+    if case not in CASES:
+        raise ValueError(f"Unknown benchmark case: {case}")
+    with tempfile.TemporaryDirectory(prefix='chapar-bench-') as temp_dir:
+        folder = os.path.join(temp_dir, 'bench')
+        with SMTPSink(latency, failure_rate, failure_code) as sink:
+            write_job_folder(folder, rows, sink, concurrency, engine, processes)
+            if case == 'template':
+                outcome = _bench_template(folder)
+            else:
+                outcome = _bench_send(case, folder, sink)
+
+    latencies = outcome['latencies']
+    p50 = percentile(latencies, 0.50)
+    p99 = percentile(latencies, 0.99)
+    messages = outcome['sent'] + outcome['failed']
+    return {
+        'case': case,
+        'rows': rows,
+        'engine': engine if case != 'template' else None,
+        'concurrency': concurrency if case != 'template' else None,
+        'processes': processes if case != 'template' else None,
+        'sink_latency_ms': latency * 1000,
+        'sink_failure_rate': failure_rate,
+        'sent': outcome['sent'],
+        'failed': outcome['failed'],
+        'seconds': round(outcome['seconds'], 6),
+        'messages_per_sec': round(messages / outcome['seconds'], 2) if outcome['seconds'] > 0 else None,
+        'p50_ms': round(p50 * 1000, 4) if p50 is not None else None,
+        'p99_ms': round(p99 * 1000, 4) if p99 is not None else None,
+        'peak_rss_kb': peak_rss_kb(),
+    }
+
+
+def _run_case_quietly(kwargs: Dict) -> Dict:
+    logging.disable(logging.CRITICAL)
+    return run_case(**kwargs)
+
+
+def run_suite(cases: Iterable[str], sizes: Iterable[int], isolate: bool = True, **options) -> List[Dict]:
+    """Runs every case at every size.
+
+    Args:
+        cases: The cases to run, from CASES.
+        sizes: The recipient counts to run each case with.
+        isolate: Run each case in a fresh process so its peak RSS is its own.
+        **options: Passed on to ``run_case``.
+
+    Returns:
+        The list of results, in the order they ran.
+    """
+    results = []
+    for rows in sizes:
+        for case in cases:
+            kwargs = dict(options, case=case, rows=rows)
+            if isolate:
+                with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as executor:
+                    result = executor.submit(_run_case_quietly, kwargs).result()
+            else:
+                result = _run_case_quietly(kwargs)
+            logging.info(
+                f"{case} x {rows}: {result['messages_per_sec']} msg/s, p50 {result['p50_ms']} ms, "
+                f"p99 {result['p99_ms']} ms, peak RSS {result['peak_rss_kb']} KiB")
+            results.append(result)
+    return results
+
+
+def compare(results: List[Dict], baseline: List[Dict], tolerance: float) -> List[str]:
+    """Lists the cases whose throughput dropped more than ``tolerance`` below the baseline."""
+    def key(result: Dict):
+        return result['case'], result['rows'], result['engine'], result['concurrency'], result.get('processes')
+
+    previous = {key(result): result for result in baseline}
+    regressions = []
+    for result in results:
+        before = previous.get(key(result))
+        if not before or not before.get('messages_per_sec') or result['messages_per_sec'] is None:
+            continue
+        if result['messages_per_sec'] < before['messages_per_sec'] * (1 - tolerance):
+            regressions.append(
+                f"{result['case']} x {result['rows']}: {result['messages_per_sec']} msg/s, "
+                f"baseline {before['messages_per_sec']} msg/s")
+    return regressions
+
+
+def _parse_sizes(value: str) -> List[int]:
+    sizes = []
+    for part in value.split(','):
+        part = part.strip().lower()
+        multiplier = 1
+        if part.endswith('k'):
+            part, multiplier = part[:-1], 1000
+        elif part.endswith('m'):
+            part, multiplier = part[:-1], 1000000
+        sizes.append(int(float(part) * multiplier))
+    return sizes
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Chapar throughput benchmark against a local SMTP sink")
+    parser.add_argument("--cases", default=','.join(CASES), help=f"Comma-separated cases to run (default: {','.join(CASES)})")
+    parser.add_argument("--sizes", default=','.join(str(size) for size in DEFAULT_SIZES), help="Comma-separated recipient counts, e.g. 1k,10k,100k,1m")
+    parser.add_argument("--latency", type=float, default=0.0, help="Sink latency per message, in milliseconds")
+    parser.add_argument("--failure-rate", type=float, default=0.0, help="Fraction of messages the sink rejects")
+    parser.add_argument("--failure-code", type=int, default=550, help="Reply code for rejected messages (default: 550)")
+    parser.add_argument("--concurrency", type=int, default=1, help="Concurrency setting for the send cases")
+    parser.add_argument("--engine", choices=['threads', 'asyncio'], default='threads', help="Engine setting for the send cases")
+    parser.add_argument("--processes", type=int, default=1, help="Processes setting for the send cases")
+    parser.add_argument("--output", help="Write the JSON results to this file instead of stdout")
+    parser.add_argument("--baseline", help="JSON results of an earlier run to compare throughput against")
+    parser.add_argument("--tolerance", type=float, default=0.10, help="Allowed throughput drop against the baseline (default: 0.10)")
+    parser.add_argument("--no-isolate", action="store_true", help="Run all cases in this process; peak RSS is then cumulative")
+    args = parser.parse_args()
+
+    cases = [case.strip() for case in args.cases.split(',') if case.strip()]
+    unknown = [case for case in cases if case not in CASES]
+    if unknown:
+        parser.error(f"Unknown cases: {', '.join(unknown)}")
+
+    results = run_suite(
+        cases,
+        _parse_sizes(args.sizes),
+        isolate=not args.no_isolate,
+        latency=args.latency / 1000,
+        failure_rate=args.failure_rate,
+        failure_code=args.failure_code,
+        concurrency=args.concurrency,
+        engine=args.engine,
+        processes=args.processes,
+    )
+    report = {
+        'timestamp': datetime.now(timezone.utc).isoformat(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'results': results,
+    }
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+    if args.baseline:
+        with open(args.baseline, 'r', encoding='utf-8') as f:
+            regressions = compare(results, json.load(f)['results'], args.tolerance)
+        for regression in regressions:
+            logging.error(f"Throughput regression: {regression}")
+        sys.exit(1 if regressions else 0)
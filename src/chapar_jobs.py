@@ -0,0 +1,185 @@
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional
+
+import chapar
+
+QUEUED = 'queued'
+RUNNING = 'running'
+COMPLETED = 'completed'
+FAILED = 'failed'
+
+JOB_STATE_SAVE_INTERVAL = 1.0
+
+
+class Job:
+    """A dispatch running in the background, with its status and live progress."""
+
+    def __init__(self, kind: str, template: str, state_folder: Optional[str] = None):
+        self.id = uuid.uuid4().hex
+        self.kind = kind
+        self.template = template
+        self.status = QUEUED
+        self.error: Optional[str] = None
+        self.created_at = time.time()
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+        self.progress = chapar.DispatchProgress(on_update=self._on_progress)
+        self._state_folder = state_folder
+        self._last_save = 0.0
+        self._done = threading.Event()
+
+    def to_dict(self) -> Dict:
+        """Returns the job as a JSON-serializable dictionary."""
+        return {
+            'id': self.id,
+            'kind': self.kind,
+            'template': self.template,
+            'status': self.status,
+            'error': self.error,
+            'created_at': self.created_at,
+            'started_at': self.started_at,
+            'finished_at': self.finished_at,
+            'progress': self.progress.snapshot(),
+        }
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        """Blocks until the job has finished. Returns False on timeout."""
+        return self._done.wait(timeout)
+
+    def save(self) -> None:
+        """Writes the job state to the state folder so other processes can report it."""
+        if not self._state_folder:
+            return
+        self._last_save = time.monotonic()
+        try:
+            fd, tmp_path = tempfile.mkstemp(dir=self._state_folder, suffix='.tmp')
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                json.dump(self.to_dict(), f)
+            os.replace(tmp_path, os.path.join(self._state_folder, f"{self.id}.json"))
+        except OSError:
+            logging.exception("Error saving state of job %s", self.id)
+
+    def _on_progress(self, _progress: chapar.DispatchProgress) -> None:
+        if time.monotonic() - self._last_save >= JOB_STATE_SAVE_INTERVAL:
+            self.save()
+
+
+class JobManager:
+    """Runs dispatch jobs on a bounded pool of worker threads.
+
+    At most ``max_workers`` jobs send at the same time, and at most ``max_pending``
+    jobs may be queued or running before new submissions are refused. When a
+    ``state_folder`` is given, job state is also written there as JSON so that any
+    process sharing the folder (for example, another gunicorn worker) can report it.
+    """
+
+    def __init__(self, max_workers: int = 4, max_pending: int = 100, state_folder: Optional[str] = None, max_history: int = 1000):
+        self.max_pending = max_pending
+        self.max_history = max_history
+        self.state_folder = state_folder
+        if state_folder:
+            os.makedirs(state_folder, exist_ok=True)
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='chapar-job')
+        self._jobs: Dict[str, Job] = {}
+        self._lock = threading.Lock()
+
+    def submit(self, kind: str, template: str, target: Callable[[chapar.DispatchProgress], object], describe_error: Callable[[Exception], str], cleanup: Optional[Callable[[], None]] = None) -> Job:
+        """Queues a dispatch.
+
+        Args:
+            kind: What started the job, e.g. 'run-template' or 'send'.
+            template: The template name shown in the job status.
+            target: Runs the dispatch, given the job's progress object.
+            describe_error: Maps an exception raised by ``target`` to the message
+                reported to clients.
+            cleanup: Called after the job finishes, whatever the outcome.
+
+        Returns:
+            The queued job.
+
+        Raises:
+            RuntimeError: If too many jobs are already pending.
+        """
+        job = Job(kind, template, self.state_folder)
+        with self._lock:
+            if self.active_count() >= self.max_pending:
+                raise RuntimeError("Too many pending jobs")
+            self._jobs[job.id] = job
+            self._prune()
+        job.save()
+        self._executor.submit(self._run, job, target, describe_error, cleanup)
+        return job
+
+    def get(self, job_id: str) -> Optional[Dict]:
+        """Returns the status of a job started by this or another process, or None."""
+        job = self._jobs.get(job_id)
+        if job is not None:
+            return job.to_dict()
+        if self.state_folder and all(c in '0123456789abcdef' for c in job_id):
+            path = os.path.join(self.state_folder, f"{job_id}.json")
+            try:
+                with open(path, 'r', encoding='utf-8') as f:
+                    return json.load(f)
+            except (OSError, ValueError):
+                return None
+        return None
+
+    def get_job(self, job_id: str) -> Optional[Job]:
+        """Returns a job started by this process, or None."""
+        return self._jobs.get(job_id)
+
+    def list(self) -> List[Dict]:
+        """Returns the status of the jobs started by this process, newest first."""
+        jobs = sorted(self._jobs.values(), key=lambda j: j.created_at, reverse=True)
+        return [job.to_dict() for job in jobs]
+
+    def active_count(self) -> int:
+        """Returns the number of jobs queued or running in this process."""
+        return sum(1 for job in list(self._jobs.values()) if job.status in (QUEUED, RUNNING))
+
+    def running_count(self) -> int:
+        """Returns the number of jobs sending in this process."""
+        return sum(1 for job in list(self._jobs.values()) if job.status == RUNNING)
+
+    def queued_count(self) -> int:
+        """Returns the number of jobs in this process waiting for a free worker."""
+        return sum(1 for job in list(self._jobs.values()) if job.status == QUEUED)
+
+    def _run(self, job: Job, target, describe_error, cleanup) -> None:
+        job.status = RUNNING
+        job.started_at = time.time()
+        job.save()
+        try:
+            target(job.progress)
+            job.status = COMPLETED
+        except Exception as e:
+            logging.exception("Error during email dispatch in job %s", job.id)
+            job.status = FAILED
+            job.error = describe_error(e)
+        finally:
+            job.finished_at = time.time()
+            if cleanup:
+                try:
+                    cleanup()
+                except Exception:
+                    logging.exception("Error cleaning up job %s", job.id)
+            job.save()
+            job._done.set()
+
+    def _prune(self) -> None:
+        finished = [job for job in self._jobs.values() if job.status in (COMPLETED, FAILED)]
+        finished.sort(key=lambda j: j.created_at)
+        for job in finished[:max(len(self._jobs) - self.max_history, 0)]:
+            del self._jobs[job.id]
+            if self.state_folder:
+                try:
+                    os.remove(os.path.join(self.state_folder, f"{job.id}.json"))
+                except OSError:
+                    pass
@@ -0,0 +1,126 @@
+import threading
+from typing import Callable, Dict, List, Tuple
+
+import chapar
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class JobStats(chapar.DispatchStats):
+    """Stage timers for one dispatch that also feed a process-wide MetricsRegistry."""
+
+    def __init__(self, registry: 'MetricsRegistry', template: str):
+        super().__init__()
+        self.registry = registry
+        self.template = template
+
+    def record(self, stage: str, seconds: float) -> None:
+        super().record(stage, seconds)
+        self.registry.observe(stage, seconds)
+
+    def count(self, status: str) -> None:
+        super().count(status)
+        self.registry.count(self.template, status)
+
+    def merge(self, other: chapar.DispatchStats) -> None:
+        super().merge(other)
+        self.registry.merge(other)
+
+
+class MetricsRegistry:
+    """Process-wide dispatch metrics, rendered in the Prometheus text format.
+
+    Dispatches report to it through a ``JobStats`` made by ``job_stats``. Gauges are
+    read from callables when the metrics are rendered.
+    """
+
+    def __init__(self):
+        self.sent: Dict[str, int] = {}
+        self.failed: Dict[str, int] = {}
+        self.stage_seconds = dict.fromkeys(chapar.STAGES, 0.0)
+        self.connect_latency = chapar.LatencyHistogram()
+        self.login_latency = chapar.LatencyHistogram()
+        self.send_latency = chapar.LatencyHistogram()
+        self._gauges: List[Tuple[str, str, Callable[[], float]]] = []
+        self._lock = threading.Lock()
+
+    def job_stats(self, template: str) -> JobStats:
+        """Returns stage timers for a dispatch of ``template`` that report to this registry."""
+        return JobStats(self, template)
+
+    def add_gauge(self, name: str, help_text: str, read: Callable[[], float]) -> None:
+        self._gauges.append((name, help_text, read))
+
+    def observe(self, stage: str, seconds: float) -> None:
+        with self._lock:
+            self.stage_seconds[stage] += seconds
+        if stage in chapar.LATENCY_STAGES:
+            getattr(self, chapar.LATENCY_STAGES[stage]).observe(seconds)
+
+    def merge(self, stats: chapar.DispatchStats) -> None:
+        """Adds the stage times and latency histograms of a dispatch that ran in another process.
+
+        The sent and failed counters are not merged; the outcomes of a sharded
+        dispatch are counted as they arrive.
+        """
+        with self._lock:
+            for stage in chapar.STAGES:
+                self.stage_seconds[stage] += stats.seconds[stage]
+        for name in chapar.LATENCY_STAGES.values():
+            getattr(self, name).merge(getattr(stats, name))
+
+    def count(self, template: str, status: str) -> None:
+        counters = self.sent if status == chapar.SEND_OK else self.failed
+        with self._lock:
+            counters[template] = counters.get(template, 0) + 1
+
+    def render(self) -> str:
+        """Returns every metric in the Prometheus text exposition format."""
+        lines: List[str] = []
+        with self._lock:
+            sent = dict(self.sent)
+            failed = dict(self.failed)
+            stage_seconds = dict(self.stage_seconds)
+
+        for name, help_text, counters in (
+            ('chapar_messages_sent_total', 'Messages accepted by the SMTP server.', sent),
+            ('chapar_messages_failed_total', 'Messages that could not be delivered.', failed),
+        ):
+            lines += [f'# HELP {name} {help_text}', f'# TYPE {name} counter']
+            for template, value in sorted(counters.items()):
+                lines.append(f'{name}{{template="{_escape(template)}"}} {value}')
+
+        name = 'chapar_stage_seconds_total'
+        lines += [f'# HELP {name} Time spent in each dispatch stage, summed across connections.', f'# TYPE {name} counter']
+        for stage, seconds in stage_seconds.items():
+            lines.append(f'{name}{{stage="{stage}"}} {_format_value(seconds)}')
+
+        for name, help_text, histogram in (
+            ('chapar_smtp_connect_seconds', 'Time to open and secure an SMTP connection.', self.connect_latency),
+            ('chapar_smtp_login_seconds', 'Time to authenticate an SMTP connection.', self.login_latency),
+            ('chapar_send_seconds', 'Time for the SMTP transaction of one message.', self.send_latency),
+        ):
+            lines += self._render_histogram(name, help_text, histogram)
+
+        for name, help_text, read in self._gauges:
+            lines += [f'# HELP {name} {help_text}', f'# TYPE {name} gauge', f'{name} {_format_value(read())}']
+        return '\n'.join(lines) + '\n'
+
+    @staticmethod
+    def _render_histogram(name: str, help_text: str, histogram: chapar.LatencyHistogram) -> List[str]:
+        buckets, count, total = histogram.snapshot()
+        lines = [f'# HELP {name} {help_text}', f'# TYPE {name} histogram']
+        for bound, value in buckets:
+            lines.append(f'{name}_bucket{{le="{_format_value(bound)}"}} {value}')
+        lines += [f'{name}_sum {_format_value(total)}', f'{name}_count {count}']
+        return lines
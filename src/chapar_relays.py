@@ -0,0 +1,367 @@
+import logging
+import queue
+import smtplib
+import threading
+import time
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import chapar
+
+
+class Relay:
+    """One SMTP account or relay a dispatch can send through, with its own counters."""
+
+    def __init__(self, name: str, smtp_settings: Dict[str, str], weight: float = 1.0, limiter: Optional[chapar.RateLimiter] = None, concurrency: int = 1):
+        self.name = name
+        self.smtp_settings = smtp_settings
+        self.weight = weight
+        self.limiter = limiter
+        self.concurrency = concurrency
+        self.sent = 0
+        self.failed = 0
+        self.deferred = 0
+        self.error: Optional[str] = None
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+
+    @property
+    def down(self) -> bool:
+        return self.error is not None
+
+    def snapshot(self, now: float) -> Dict:
+        """Returns the relay's counters and its throughput in messages per second."""
+        end = self.finished_at if self.finished_at is not None else now
+        elapsed = end - self.started_at if self.started_at is not None else 0.0
+        return {
+            'name': self.name,
+            'weight': self.weight,
+            'sent': self.sent,
+            'failed': self.failed,
+            'deferred': self.deferred,
+            'elapsed': round(elapsed, 3),
+            'throughput': round((self.sent + self.failed) / elapsed, 3) if elapsed > 0 else 0.0,
+            'error': self.error,
+        }
+
+
+class RelayPool:
+    """Spreads messages over several relays in proportion to their weights.
+
+    Relays are picked by smooth weighted round-robin, so a relay with weight 3 next
+    to one with weight 1 gets three messages out of every four, interleaved rather
+    than in runs. A relay that goes down is skipped from then on.
+    """
+
+    def __init__(self, relays: List[Relay], clock=time.monotonic):
+        self.relays = relays
+        self._clock = clock
+        self._current = {relay.name: 0.0 for relay in relays}
+        self._lock = threading.Lock()
+
+    def choose(self, exclude: Optional[Relay] = None) -> Optional[Relay]:
+        """Returns the next relay to send through, or None if every relay is down.
+
+        ``exclude`` is skipped as long as another relay is up, so a recipient that
+        failed on one relay is tried on a different one.
+        """
+        with self._lock:
+            candidates = [relay for relay in self.relays if not relay.down and relay is not exclude]
+            if not candidates and exclude is not None and not exclude.down:
+                candidates = [exclude]
+            if not candidates:
+                return None
+            total = sum(relay.weight for relay in candidates)
+            for relay in candidates:
+                self._current[relay.name] += relay.weight
+            chosen = max(candidates, key=lambda relay: self._current[relay.name])
+            self._current[chosen.name] -= total
+            return chosen
+
+    def mark_down(self, relay: Relay, error: Exception) -> None:
+        """Takes a relay out of rotation after ``error``."""
+        with self._lock:
+            if relay.down:
+                return
+            relay.error = str(error) or type(error).__name__
+            relay.finished_at = self._clock()
+        logging.warning(f"SMTP relay {relay.name} taken out of rotation: {relay.error}")
+
+    def record(self, relay: Relay, status: str) -> None:
+        """Counts a message that finished on ``relay`` with ``status``."""
+        with self._lock:
+            if status == chapar.SEND_OK:
+                relay.sent += 1
+            elif status in chapar.TRANSIENT_STATUSES:
+                relay.deferred += 1
+            else:
+                relay.failed += 1
+
+    def start(self) -> None:
+        now = self._clock()
+        for relay in self.relays:
+            relay.started_at = now
+
+    def finish(self) -> None:
+        now = self._clock()
+        with self._lock:
+            for relay in self.relays:
+                if relay.finished_at is None:
+                    relay.finished_at = now
+
+    def report(self) -> List[Dict]:
+        """Returns a snapshot of every relay, in config order."""
+        now = self._clock()
+        with self._lock:
+            return [relay.snapshot(now) for relay in self.relays]
+
+
+def load_relays(config) -> RelayPool:
+    """Builds the relays described by the ``[SMTP:name]`` sections of the configuration.
+
+    Each relay section takes the same keys as [SMTP], falling back to [SMTP] for the
+    ones it does not set, plus ``Weight``, and ``Rate``, ``Burst`` and ``Concurrency``
+    for that relay alone. ``Concurrency`` defaults to the one in [Settings].
+
+    Args:
+        config: The loaded configuration.
+
+    Returns:
+        A RelayPool with one relay per section.
+    """
+    defaults = config['SMTP'] if 'SMTP' in config else None
+    concurrency = config['Settings'].get('Concurrency', '1')
+    relays = []
+    for section in chapar.relay_sections(config):
+        options = config[section]
+        relays.append(Relay(
+            section[len(chapar.RELAY_SECTION_PREFIX):].strip(),
+            chapar.smtp_settings_from(options, defaults),
+            float(options.get('Weight', '1')),
+            chapar.create_rate_limiter({key: options[key] for key in ('Rate', 'Burst') if key in options}),
+            int(options.get('Concurrency', concurrency)),
+        ))
+    return RelayPool(relays)
+
+
+def dispatch(pool: RelayPool, recipients: Iterable[Dict[str, str]], template: chapar.CompiledTemplate, limiter: Optional[chapar.RateLimiter], log_level: str, template_name: str, throttle: Optional[chapar.AdaptiveThrottle] = None, journal: Optional[chapar.SendJournal] = None, progress: Optional[chapar.DispatchProgress] = None, stats: Optional[chapar.DispatchStats] = None, batch_size: int = 1, sessions: Optional[chapar.SMTPSessionCache] = None, retry: Optional[chapar.RetryPolicy] = None) -> Tuple[int, int]:
+    """Sends the email to every recipient over the relays of ``pool``.
+
+    Each relay opens its ``concurrency`` connections, and its worker threads pull from
+    a queue of their own that ``pool.choose`` routes recipients to. Every message takes
+    a token from the shared ``limiter`` and then from the relay's own limiter.
+
+    A relay that cannot be connected to, or whose dropped connection cannot be
+    reopened, is taken out of rotation and the recipients queued for it are routed to
+    the others. Recipients that fail temporarily on a relay are retried, as in
+    ``chapar._dispatch``, on a different relay when one is up.
+
+    Args:
+        pool: The relays to send through.
+        recipients: The recipients, each a dictionary with 'email' and 'name' keys. Any
+            iterable works; it is consumed lazily.
+        template: The compiled HTML template.
+        limiter: The rate limiter shared by all relays, or None for no overall limit.
+        log_level: The logging level.
+        template_name: The name of the email template.
+        throttle: The adaptive throttle driving ``limiter``, or None for a fixed rate.
+        journal: The send journal to record delivered recipients in, or None.
+        progress: Live counters to update as recipients finish, or None.
+        stats: Stage timers to record the time spent in each step in, or None.
+        batch_size: The most recipients to send one message to in a transaction.
+        sessions: A session cache to borrow connections from and return them to, or None.
+        retry: How to reconnect and retry temporary failures, or None.
+
+    Returns:
+        A tuple of (success_count, failure_count).
+
+    Raises:
+        smtplib.SMTPException: If every relay is down. The error of the last relay
+            that went down is raised.
+    """
+    builders = {relay.name: chapar.MessageBuilder(relay.smtp_settings, template) for relay in pool.relays}
+    if batch_size > 1 and template.placeholders:
+        logging.info(f"Template {template_name} has placeholders; sending one message per recipient")
+        batch_size = 1
+
+    max_attempts = chapar.max_send_attempts(retry, throttle)
+    counts = {chapar.SEND_OK: 0, chapar.SEND_FAILED: 0}
+    retry_queue: List[Tuple[Dict[str, str], Relay]] = []
+    rerouted: List[Tuple[object, Relay]] = []
+    state = {'final': max_attempts == 1, 'error': None}
+    state_lock = threading.Lock()
+    servers: Dict[str, List[Optional[smtplib.SMTP]]] = {}
+    queues: Dict[str, queue.Queue] = {}
+
+    def connect(relay: Relay) -> smtplib.SMTP:
+        if sessions:
+            return sessions.acquire(relay.smtp_settings, stats)
+        settings = relay.smtp_settings
+        return chapar._create_smtp_server(settings['host'], int(settings['port']), settings['email'], settings['password'], settings.get('security', 'auto'), stats, settings.get('ca_file', ''))
+
+    def take_down(relay: Relay, error: Exception) -> None:
+        with state_lock:
+            state['error'] = error
+        pool.mark_down(relay, error)
+
+    def reconnect(relay: Relay, slot: int) -> None:
+        chapar._close_quietly(servers[relay.name][slot])
+        servers[relay.name][slot] = None
+        error: Exception = smtplib.SMTPServerDisconnected("SMTP connection lost")
+        for attempt in range(1, retry.max_reconnects + 1):
+            if relay.down:
+                return
+            delay = retry.delay(attempt)
+            logging.warning(f"Connection to relay {relay.name} lost while sending template {template_name}; reconnecting in {delay:g}s (attempt {attempt} of {retry.max_reconnects})")
+            retry.sleep(delay)
+            try:
+                servers[relay.name][slot] = connect(relay)
+                return
+            except (smtplib.SMTPException, OSError) as e:
+                error = e
+        take_down(relay, error)
+
+    def wait_for_token(relay: Relay, email: str) -> None:
+        for bucket in (limiter, relay.limiter):
+            if bucket is None:
+                continue
+            if stats:
+                with stats.timer('throttle'):
+                    bucket.acquire(email)
+            else:
+                bucket.acquire(email)
+
+    def settle(relay: Relay, recipient: Dict[str, str], status: str) -> None:
+        pool.record(relay, status)
+        if throttle:
+            throttle.record(status)
+        if journal is not None and status == chapar.SEND_OK:
+            journal.record(recipient['email'])
+        with state_lock:
+            if status in chapar.TRANSIENT_STATUSES and not state['final']:
+                retry_queue.append((recipient, relay))
+                return
+            counts[chapar.SEND_OK if status == chapar.SEND_OK else chapar.SEND_FAILED] += 1
+        if progress:
+            progress.add(status, recipient['email'])
+        if stats:
+            stats.count(status)
+
+    def process(relay: Relay, slot: int, item) -> None:
+        batch = item if batch_size > 1 else [item]
+        if relay.down or servers[relay.name][slot] is None:
+            with state_lock:
+                rerouted.append((item, relay))
+            return
+        server = servers[relay.name][slot]
+        emails = [recipient['email'] for recipient in batch]
+        for email in emails:
+            wait_for_token(relay, email)
+        if batch_size > 1:
+            statuses = chapar.deliver_batch(relay.smtp_settings, server, emails, builders[relay.name], log_level, template_name, stats)
+        else:
+            statuses = [chapar.deliver_email(relay.smtp_settings, server, item['email'], item['name'], builders[relay.name], log_level, template_name, item, stats)]
+        for recipient, status in zip(batch, statuses):
+            settle(relay, recipient, status)
+        if chapar.SEND_DISCONNECTED in statuses:
+            if retry:
+                reconnect(relay, slot)
+            else:
+                take_down(relay, smtplib.SMTPServerDisconnected(f"Connection to relay {relay.name} lost"))
+
+    def worker(relay: Relay, slot: int) -> None:
+        work = queues[relay.name]
+        while True:
+            item = work.get()
+            try:
+                if item is None:
+                    return
+                process(relay, slot, item)
+            except Exception:
+                logging.exception(f"Error sending template {template_name} through relay {relay.name}")
+                for recipient in (item if batch_size > 1 else [item]):
+                    settle(relay, recipient, chapar.SEND_FAILED)
+            finally:
+                work.task_done()
+
+    def route(item, exclude: Optional[Relay] = None) -> None:
+        relay = pool.choose(exclude)
+        if relay is None:
+            raise state['error'] or RuntimeError("No SMTP relay is available")
+        queues[relay.name].put(item)
+
+    def drain() -> None:
+        while True:
+            for work in queues.values():
+                work.join()
+            with state_lock:
+                pending = list(rerouted)
+                rerouted.clear()
+            if not pending:
+                return
+            for item, relay in pending:
+                route(item, relay)
+
+    def passes():
+        yield ((item, None) for item in (chapar.batches(recipients, batch_size) if batch_size > 1 else recipients))
+        for attempt in range(1, max_attempts):
+            if not retry_queue:
+                return
+            with state_lock:
+                pending = list(retry_queue)
+                retry_queue.clear()
+            delay = retry.delay(attempt) if retry else 0
+            logging.info(f"Retrying {len(pending)} recipients with temporary failures for template {template_name} in {delay:g}s")
+            if delay:
+                retry.sleep(delay)
+            state['final'] = attempt + 1 == max_attempts
+            by_relay: Dict[str, List[Dict[str, str]]] = {}
+            failed_on = {}
+            for recipient, relay in pending:
+                by_relay.setdefault(relay.name, []).append(recipient)
+                failed_on[relay.name] = relay
+            yield [(item, failed_on[name]) for name, group in by_relay.items()
+                   for item in (chapar.batches(group, batch_size) if batch_size > 1 else group)]
+
+    pool.start()
+    for relay in pool.relays:
+        try:
+            servers[relay.name] = list(chapar._open_smtp_pool(relay.smtp_settings, relay.concurrency, stats, sessions))
+        except (smtplib.SMTPException, OSError) as e:
+            servers[relay.name] = []
+            take_down(relay, e)
+            continue
+        queues[relay.name] = queue.Queue(maxsize=relay.concurrency * 2)
+        logging.info(f"Opened {relay.concurrency} connections to relay {relay.name} for template {template_name}")
+    if all(relay.down for relay in pool.relays):
+        pool.finish()
+        raise state['error']
+
+    threads = [threading.Thread(target=worker, args=(relay, slot), daemon=True)
+               for relay in pool.relays if relay.name in queues for slot in range(len(servers[relay.name]))]
+    for thread in threads:
+        thread.start()
+    finished = False
+    try:
+        for items in passes():
+            for item, exclude in items:
+                route(item, exclude)
+            drain()
+        finished = True
+    finally:
+        for relay in pool.relays:
+            if relay.name in queues:
+                for _ in servers[relay.name]:
+                    queues[relay.name].put(None)
+        for thread in threads:
+            thread.join()
+        for relay in pool.relays:
+            for server in servers[relay.name]:
+                if server is None:
+                    continue
+                if sessions and finished and not relay.down:
+                    sessions.release(server, relay.smtp_settings)
+                else:
+                    chapar._close_quietly(server)
+        pool.finish()
+
+    return counts[chapar.SEND_OK], counts[chapar.SEND_FAILED]
@@ -0,0 +1,288 @@
+import configparser
+import logging
+import multiprocessing
+import os
+import pickle
+import queue
+import threading
+import time
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import chapar
+
+RATE_SETTINGS = ('Rate', 'DomainRate', 'MinRate', 'MaxRate')
+
+
+class _ShardProgress:
+    """Forwards the outcome of each recipient from a shard to the parent process.
+
+    Outcomes are sent in batches of ``flush_every`` or every ``flush_interval``
+    seconds, whichever comes first, so the queue is not hit once per message.
+    """
+
+    def __init__(self, events, flush_every: int = 100, flush_interval: float = 0.5, clock=time.monotonic):
+        self._events = events
+        self._flush_every = flush_every
+        self._flush_interval = flush_interval
+        self._clock = clock
+        self._buffer: List[tuple] = []
+        self._last_flush = clock()
+        self._lock = threading.Lock()
+
+    def add(self, status: str, email: Optional[str] = None) -> None:
+        with self._lock:
+            self._buffer.append((status, email))
+            if len(self._buffer) >= self._flush_every or self._clock() - self._last_flush >= self._flush_interval:
+                self._flush()
+
+    def flush(self) -> None:
+        with self._lock:
+            self._flush()
+
+    def _flush(self) -> None:
+        if self._buffer:
+            self._events.put(('progress', None, self._buffer))
+            self._buffer = []
+        self._last_flush = self._clock()
+
+
+def share_rates(config: configparser.ConfigParser, shards: int) -> None:
+    """Divides the configured send rates evenly between ``shards`` processes.
+
+    Every rate in [Settings] and in the relay sections is divided by ``shards`` and an
+    ``Interval`` is multiplied by it, so the shards together keep to the configured
+    limits.
+    """
+    settings = config['Settings']
+    for section in ['Settings'] + chapar.relay_sections(config):
+        for key in RATE_SETTINGS:
+            if config[section].get(key, '').strip():
+                config[section][key] = f"{chapar.parse_rate(config[section][key]) / shards!r}/s"
+    if float(settings.get('Interval', '0')) > 0 and not settings.get('Rate', '').strip():
+        settings['Interval'] = repr(float(settings['Interval']) * shards)
+
+
+SCAN_BLOCK = 1 << 20
+
+
+def _count_quotes(f, start: int, end: int) -> int:
+    f.seek(start)
+    quotes = 0
+    while start < end:
+        block = f.read(min(SCAN_BLOCK, end - start))
+        if not block:
+            break
+        quotes += block.count(b'"')
+        start += len(block)
+    return quotes
+
+
+def _next_row(f, position: int, quotes: int):
+    """Returns the first row boundary at or after ``position`` and the quotes before it.
+
+    ``quotes`` is the number of quote characters before ``position``. A newline
+    ends a row only when an even number of quotes precede it, so newlines inside
+    quoted fields are passed over; a doubled quote within a field counts twice and
+    leaves the parity unchanged.
+    """
+    f.seek(position)
+    for line in f:
+        position += len(line)
+        quotes += line.count(b'"')
+        if quotes % 2 == 0:
+            break
+    return position, quotes
+
+
+def row_ranges(csv_file: str, parts: int) -> List[Tuple[int, int]]:
+    """Splits the rows of a recipients CSV file into ``parts`` byte ranges.
+
+    The rows after the header are divided into ranges of about equal size, each
+    starting and ending at a row boundary, so every shard reads and parses only its
+    own part of the file. Finding the boundaries scans the bytes for quotes and
+    newlines without parsing the CSV. A range may be empty when rows are long.
+    """
+    size = os.path.getsize(csv_file)
+    with open(csv_file, 'rb') as f:
+        header_end, quotes = _next_row(f, 0, 0)
+        boundaries = [header_end]
+        for part in range(1, parts):
+            target = max(header_end + (size - header_end) * part // parts, boundaries[-1])
+            quotes += _count_quotes(f, boundaries[-1], target)
+            boundary, quotes = _next_row(f, target, quotes)
+            boundaries.append(boundary)
+    boundaries.append(size)
+    return list(zip(boundaries, boundaries[1:]))
+
+
+def _unsent(rows: Iterable[Dict[str, str]], journalled: set, progress: _ShardProgress) -> Iterable[Dict[str, str]]:
+    for row in rows:
+        if row['email'].strip().lower() in journalled:
+            progress.add('skipped')
+        else:
+            yield row
+
+
+def _run_shard(sections: Dict[str, Dict[str, str]], folder: str, html_content: str, recipients_path: str, rows_range: Tuple[int, int], shard: int, shards: int, events) -> None:
+    """Sends one shard of a job. Runs in a worker process started by ``run_job``."""
+    progress = _ShardProgress(events)
+    try:
+        config = configparser.ConfigParser()
+        config.read_dict(sections)
+        share_rates(config, shards)
+        template_name = os.path.basename(folder)
+        journalled = set()
+        if chapar._is_true(config['Settings'].get('Journal', 'false')):
+            journalled, _ = chapar.read_journal(os.path.join(folder, chapar.JOURNAL_FILE))
+        suppression = chapar.open_suppression_list(folder, config['Settings'])
+        try:
+            stats = chapar.DispatchStats()
+            stats.start()
+            with chapar.open_recipients(recipients_path, *rows_range) as recipients:
+                template = chapar.compile_template(html_content, recipients.fieldnames)
+                rows = stats.timed('csv', recipients)
+                if suppression is not None:
+                    rows = suppression.filter(rows, progress.add)
+                pending = _unsent(rows, journalled, progress) if journalled else rows
+                sent, failed, relays = chapar._send_rows(config, pending, template, template_name, None, progress, stats)
+            stats.finish()
+        finally:
+            if suppression is not None:
+                suppression.close()
+        progress.flush()
+        events.put(('done', shard, {'total': recipients.count, 'sent': sent, 'failed': failed, 'relays': relays, 'stats': stats}))
+    except Exception as e:
+        progress.flush()
+        try:
+            pickle.dumps(e)
+        except Exception:
+            e = RuntimeError(f"{type(e).__name__}: {e}")
+        events.put(('error', shard, e))
+
+
+def merge_relay_reports(reports: List[List[Dict]]) -> List[Dict]:
+    """Adds up the per-relay reports of several shards, keeping the first error seen."""
+    merged: Dict[str, Dict] = {}
+    for report in reports:
+        for relay in report:
+            total = merged.setdefault(relay['name'], dict(relay, sent=0, failed=0, deferred=0, elapsed=0.0, throughput=0.0, error=None))
+            for key in ('sent', 'failed', 'deferred', 'throughput'):
+                total[key] += relay[key]
+            total['elapsed'] = max(total['elapsed'], relay['elapsed'])
+            total['error'] = total['error'] or relay['error']
+    return list(merged.values())
+
+
+def run_job(config, folder: str, html_content: str, recipients_path: str, processes: int, progress: Optional[chapar.DispatchProgress] = None, stats: Optional[chapar.DispatchStats] = None, recipient_count: Optional[int] = None) -> Dict:
+    """Runs a dispatch job split over ``processes`` worker processes.
+
+    The recipient list is split into ``processes`` byte ranges at row boundaries and
+    every worker reads only its own range, so the CPU-bound work of filling the template and serializing each message is spread
+    over that many cores. Each worker opens its own SMTP connections, ``Concurrency``
+    of them per relay, and gets an equal share of the configured send rates. The
+    workers report each recipient's outcome back to this process, which updates
+    ``progress`` and ``stats``, keeps the send journal and merges the totals.
+
+    Args:
+        config: The loaded configuration.
+        folder: The job folder.
+        html_content: The HTML content of the email.
+        recipients_path: Path to the recipients.csv file.
+        processes: The number of worker processes.
+        progress: Live counters to update during the job, or None.
+        stats: Stage timers to merge the workers' timers into, or None.
+        recipient_count: The number of recipients if already counted, or None.
+
+    Returns:
+        The job totals, as returned by ``chapar._run_job``.
+
+    Raises:
+        Exception: The first error a worker failed with, once all workers have ended.
+    """
+    if stats is None:
+        stats = chapar.DispatchStats()
+    template_name = os.path.basename(folder)
+    # Opening the suppression list here brings its index up to date before the
+    # workers open it, so they do not all rebuild it at once.
+    suppression = chapar.open_suppression_list(folder, config['Settings'])
+    if suppression is not None:
+        suppression.close()
+    journal = chapar.open_journal(folder, config['Settings'])
+    counted = progress is not None
+    if progress is None:
+        progress = chapar.DispatchProgress()
+    sections = {section: dict(config[section]) for section in config}
+    ranges = row_ranges(recipients_path, processes)
+
+    context = multiprocessing.get_context('spawn')
+    events = context.Queue()
+    workers = [context.Process(target=_run_shard, args=(sections, folder, html_content, recipients_path, ranges[shard], shard, processes, events), daemon=True)
+               for shard in range(processes)]
+    results: Dict[int, Dict] = {}
+    errors: Dict[int, Exception] = {}
+
+    stats.start()
+    if counted and recipient_count is None:
+        recipient_count = chapar.count_recipients(recipients_path)
+    progress.start(recipient_count if counted else None)
+    try:
+        for worker in workers:
+            worker.start()
+        logging.info(f"Started {processes} worker processes for template {template_name}")
+        while len(results) + len(errors) < processes:
+            try:
+                kind, shard, payload = events.get(timeout=1.0)
+            except queue.Empty:
+                for shard, worker in enumerate(workers):
+                    if worker.exitcode not in (None, 0) and shard not in results and shard not in errors:
+                        errors[shard] = RuntimeError(f"Worker process {shard} exited with code {worker.exitcode}")
+                continue
+            if kind == 'progress':
+                for status, email in payload:
+                    if journal is not None and status == chapar.SEND_OK:
+                        journal.record(email)
+                    progress.add(status, email)
+                    if status not in ('skipped', 'suppressed'):
+                        stats.count(status)
+            elif kind == 'done':
+                results[shard] = payload
+                stats.merge(payload['stats'])
+            else:
+                errors[shard] = payload
+                logging.error(f"Worker process {shard} for template {template_name} failed: {payload}")
+    finally:
+        for worker in workers:
+            if worker.pid is not None:
+                worker.join(timeout=5)
+            if worker.is_alive():
+                worker.terminate()
+        stats.finish()
+        progress.finish()
+        if journal is not None:
+            journal.close()
+
+    sent = sum(result['sent'] for result in results.values())
+    failed = sum(result['failed'] for result in results.values())
+    logging.info(f"Stage times for template {template_name} across {processes} processes: {stats.summary()}")
+    relays = merge_relay_reports([result['relays'] for result in results.values() if result['relays']])
+    if relays:
+        chapar.log_relay_report(relays, template_name)
+    if errors:
+        raise errors[min(errors)]
+
+    if journal is not None:
+        if progress.skipped:
+            logging.info(f"Skipped {progress.skipped} recipients already recorded in {journal.path}")
+        if failed == 0:
+            journal.discard()
+        else:
+            logging.info(f"Kept send journal {journal.path}; rerun to retry the {failed} failed recipients")
+    total = sum(result['total'] for result in results.values())
+    logging.info(f"Found {total} recipients in the list.")
+    if progress.suppressed:
+        logging.info(f"Suppressed {progress.suppressed} recipients on the suppression list {suppression.path}")
+    result = {'total': total, 'sent': sent, 'failed': failed, 'skipped': progress.skipped,
+              'suppressed': progress.suppressed, 'failures': list(progress.failures)}
+    if relays:
+        result['relays'] = relays
+    return result
@@ -0,0 +1,208 @@
+import csv
+import hashlib
+import json
+import os
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+
+TEMPLATE_FILES = ('email_template.html', 'recipients.csv', 'config.ini')
+RECIPIENT_CHECKPOINT_ROWS = 1000
+
+# (mtime_ns, size) of each template file, or None for a missing one.
+FileSignature = Optional[Tuple[int, int]]
+
+
+def _stat(path: str) -> FileSignature:
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return st.st_mtime_ns, st.st_size
+
+
+def _csv_rows(f, position: List[int]):
+    """Parses CSV rows from a binary file, keeping ``position[0]`` at the byte after the last row read."""
+    def lines():
+        for line in f:
+            position[0] += len(line)
+            yield line.decode('utf-8')
+    return csv.reader(lines())
+
+
+class RecipientIndex:
+    """The columns and number of rows of a recipients CSV, for reading it a page at a time.
+
+    Building it reads the file once. It keeps the byte offset of every
+    RECIPIENT_CHECKPOINT_ROWS-th row, so a page anywhere in the file is read by
+    seeking to the checkpoint before it and parsing at most that many rows to get
+    there. Blank lines are not counted as rows.
+    """
+
+    def __init__(self, path: str, checkpoint_rows: int = RECIPIENT_CHECKPOINT_ROWS):
+        self.path = path
+        self.checkpoint_rows = checkpoint_rows
+        self.total = 0
+        self.checkpoints: List[int] = []
+        position = [0]
+        with open(path, 'rb') as f:
+            reader = _csv_rows(f, position)
+            self.columns: List[str] = next(reader, [])
+            start = self.data_start = position[0]
+            for row in reader:
+                if row:
+                    if self.total % checkpoint_rows == 0:
+                        self.checkpoints.append(start)
+                    self.total += 1
+                start = position[0]
+
+    def is_row_start(self, start: int) -> bool:
+        """Tells whether byte offset ``start`` can begin a row: the first row or just after a newline.
+
+        Such an offset never falls inside a UTF-8 character.
+        """
+        if start == self.data_start:
+            return True
+        if start < self.data_start:
+            return False
+        with open(self.path, 'rb') as f:
+            f.seek(start - 1)
+            return f.read(1) == b'\n'
+
+    def page(self, offset: int, limit: int, start: Optional[int] = None) -> Tuple[List[Dict[str, str]], int]:
+        """Reads up to ``limit`` rows, starting at row ``offset``.
+
+        Args:
+            offset: The index of the first row to return.
+            limit: The most rows to return.
+            start: The byte offset of row ``offset``, as returned for the previous
+                page, or None to find it from the checkpoints.
+
+        Returns:
+            The rows as dictionaries keyed by column, and the byte offset of the
+            row after the last one returned.
+        """
+        if start is None:
+            if offset >= self.total:
+                return [], 0
+            start = self.checkpoints[offset // self.checkpoint_rows]
+            skip = offset % self.checkpoint_rows
+        else:
+            skip = 0
+        rows = []
+        position = [start]
+        end = start
+        with open(self.path, 'rb') as f:
+            f.seek(start)
+            for row in _csv_rows(f, position):
+                if len(rows) == limit:
+                    break
+                if not row:
+                    continue
+                if skip:
+                    skip -= 1
+                    continue
+                rows.append(dict(zip(self.columns, row)))
+                end = position[0]
+        return rows, end
+
+
+class TemplateInfo:
+    """What the registry knows about one template folder."""
+
+    def __init__(self, name: str, path: str, files: Tuple[FileSignature, ...], description: Optional[str]):
+        self.name = name
+        self.path = path
+        self.files = files
+        self.description = description
+        self.etag = hashlib.sha1(repr((name, files)).encode('utf-8')).hexdigest()
+        self._recipients: Optional[RecipientIndex] = None
+
+    @property
+    def complete(self) -> bool:
+        """Whether the folder has all of TEMPLATE_FILES."""
+        return all(self.files)
+
+    def file_path(self, filename: str) -> str:
+        return os.path.join(self.path, filename)
+
+    def recipients(self) -> RecipientIndex:
+        """Returns the index of the folder's recipients.csv, building it on first use.
+
+        The index belongs to this version of the folder: once the registry sees the
+        files change, it makes a new TemplateInfo and the index is built again.
+        """
+        if self._recipients is None:
+            self._recipients = RecipientIndex(self.file_path('recipients.csv'))
+        return self._recipients
+
+
+class TemplateRegistry:
+    """Caches the template folders under ``base_dir`` and their descriptions.
+
+    The folders are checked for changes at most once every ``check_interval``
+    seconds, by comparing the modification time of ``base_dir`` and the mtime and
+    size of each folder's files with the ones last seen. Only folders that changed
+    have their config.ini read again. In between, the listing and its JSON body are
+    served from memory.
+
+    Args:
+        base_dir: The folder that holds the template folders.
+        describe: Returns the description of a template folder, given its path.
+        check_interval: Seconds during which the cached state is trusted without
+            looking at the disk.
+        clock: The monotonic clock to time ``check_interval`` with.
+    """
+
+    def __init__(self, base_dir: str, describe: Callable[[str], str], check_interval: float = 1.0, clock=time.monotonic):
+        self.base_dir = base_dir
+        self.check_interval = check_interval
+        self._describe = describe
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._templates: Dict[str, TemplateInfo] = {}
+        self._base_mtime: Optional[int] = None
+        self._checked_at: Optional[float] = None
+        self._listing: bytes = b'[]'
+        self._etag = ''
+
+    def _refresh(self) -> None:
+        now = self._clock()
+        if self._checked_at is not None and now - self._checked_at < self.check_interval:
+            return
+        self._checked_at = now
+        base_mtime = os.stat(self.base_dir).st_mtime_ns
+        if base_mtime != self._base_mtime:
+            names = [name for name in os.listdir(self.base_dir) if os.path.isdir(os.path.join(self.base_dir, name))]
+            self._base_mtime = base_mtime
+        else:
+            names = list(self._templates)
+
+        templates = {}
+        for name in names:
+            path = os.path.join(self.base_dir, name)
+            files = tuple(_stat(os.path.join(path, filename)) for filename in TEMPLATE_FILES)
+            cached = self._templates.get(name)
+            if cached is not None and cached.files == files:
+                templates[name] = cached
+            elif os.path.isdir(path):
+                templates[name] = TemplateInfo(name, path, files, self._describe(path) if all(files) else None)
+
+        if templates.keys() != self._templates.keys() or any(templates[name] is not self._templates[name] for name in templates):
+            self._templates = templates
+            listing = [{'name': info.name, 'description': info.description}
+                       for info in sorted(templates.values(), key=lambda info: info.name) if info.complete]
+            self._listing = json.dumps(listing).encode('utf-8')
+            self._etag = hashlib.sha1(self._listing).hexdigest()
+
+    def listing(self) -> Tuple[bytes, str]:
+        """Returns the JSON list of complete templates, by name, and its ETag."""
+        with self._lock:
+            self._refresh()
+            return self._listing, self._etag
+
+    def get(self, name: str) -> Optional[TemplateInfo]:
+        """Returns the folder called ``name``, complete or not, or None if there is none."""
+        with self._lock:
+            self._refresh()
+            return self._templates.get(name)
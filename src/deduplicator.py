@@ -1,40 +1,241 @@
 import argparse
+import hashlib
+import mmap
+import os
 import shutil
+import struct
+import tempfile
+from typing import Optional, Tuple
 
+INDEX_MAGIC = b"CHAPIDX2"
+# magic, table capacity, number of hashes, size and mtime (ns) of the list the index
+# was built from, and the fingerprint of that list
+INDEX_HEADER = struct.Struct("=8sQQQq32s")
+SLOT_SIZE = 8
+FINGERPRINT_SAMPLES = 64
+FINGERPRINT_BLOCK = 4096
 
-def deduplicate(list1_path: str, list2_path: str) -> None:
-    """Remove emails in list2 from list1, writing the result back to list1.
 
-    A backup of list1 is created as <list1_path>.bak before overwriting.
+def normalize(line: str) -> str:
+    """Returns the form an email is compared in: stripped and lower-cased."""
+    return line.strip().lower()
+
+
+def email_hash(email: str) -> int:
+    """Returns the 64-bit hash of a normalized email. Never 0, which marks an empty slot."""
+    return int.from_bytes(hashlib.blake2b(email.encode("utf-8"), digest_size=SLOT_SIZE).digest(), "little") or 1
+
+
+def _signature(path: str) -> Tuple[int, int]:
+    st = os.stat(path)
+    return st.st_size, st.st_mtime_ns
+
+
+def fingerprint(path: str, size: int) -> bytes:
+    """Returns a digest that identifies the first ``size`` bytes of ``path``.
+
+    It covers the file's inode and FINGERPRINT_SAMPLES blocks spread evenly over
+    those bytes, from the first to the last, so it costs the same at any size. It
+    changes when the file is replaced by another one or rewritten, but not when
+    lines are appended after ``size``.
+    """
+    digest = hashlib.blake2b(digest_size=32)
+    with open(path, "rb") as f:
+        digest.update(struct.pack("=QQ", os.fstat(f.fileno()).st_ino, size))
+        if size <= FINGERPRINT_SAMPLES * FINGERPRINT_BLOCK:
+            digest.update(f.read(size))
+        else:
+            for sample in range(FINGERPRINT_SAMPLES):
+                f.seek(sample * (size - FINGERPRINT_BLOCK) // (FINGERPRINT_SAMPLES - 1))
+                digest.update(f.read(FINGERPRINT_BLOCK))
+    return digest.digest()
+
+
+def _count_emails(path: str) -> int:
+    with open(path, encoding="utf-8") as f:
+        return sum(1 for line in f if not line.isspace())
+
+
+class HashIndex:
+    """A read-only, memory-mapped set of email hashes written by ``build_index``.
+
+    The file is an open-addressing hash table of 64-bit email hashes, at most half
+    full, so a lookup reads one or two slots. Only the pages touched by lookups are
+    read into memory, however large the list it was built from.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, "rb") as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            magic, capacity, count, size, mtime_ns, source_fingerprint = INDEX_HEADER.unpack_from(self._mmap)
+            if magic != INDEX_MAGIC or len(self._mmap) != INDEX_HEADER.size + capacity * SLOT_SIZE:
+                raise ValueError(f"Not a valid email index: {path}")
+        except (struct.error, ValueError):
+            self._mmap.close()
+            raise ValueError(f"Not a valid email index: {path}")
+        self._table = memoryview(self._mmap)[INDEX_HEADER.size:].cast("Q")
+        self._mask = capacity - 1
+        self._count = count
+        self.source = (size, mtime_ns)
+        self.fingerprint = source_fingerprint
+
+    def __len__(self) -> int:
+        return self._count
+
+    def __contains__(self, email: str) -> bool:
+        return self.contains_hash(email_hash(email))
+
+    def contains_hash(self, value: int) -> bool:
+        table, mask = self._table, self._mask
+        slot = value & mask
+        while True:
+            stored = table[slot]
+            if stored == value:
+                return True
+            if stored == 0:
+                return False
+            slot = (slot + 1) & mask
+
+    def close(self) -> None:
+        if self._table is not None:
+            self._table.release()
+            self._table = None
+            self._mmap.close()
+
+    def __enter__(self) -> "HashIndex":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+
+def build_index(list_path: str, index_path: str) -> HashIndex:
+    """Builds an on-disk hash index of the emails in ``list_path`` and opens it.
+
+    The list is read twice, once to size the table and once to fill it, and the
+    table is filled through a memory map, so memory use does not grow with the list.
+    The index is written to a temporary file and renamed over ``index_path``.
     """
+    size, mtime_ns = _signature(list_path)
+    source_fingerprint = fingerprint(list_path, size)
+    capacity = 16
+    while capacity < 2 * _count_emails(list_path):
+        capacity *= 2
+
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(index_path)), suffix=".tmp")
     try:
-        with open(list2_path, encoding="utf-8") as f:
-            list2_emails = {line.strip().lower() for line in f if line.strip()}
-    except FileNotFoundError:
-        raise SystemExit(f"Error: file not found: {list2_path}")
+        with os.fdopen(fd, "w+b") as f:
+            f.truncate(INDEX_HEADER.size + capacity * SLOT_SIZE)
+            with mmap.mmap(f.fileno(), 0) as mm:
+                table = memoryview(mm)[INDEX_HEADER.size:].cast("Q")
+                mask = capacity - 1
+                count = 0
+                with open(list_path, encoding="utf-8") as emails:
+                    for line in emails:
+                        email = normalize(line)
+                        if not email:
+                            continue
+                        value = email_hash(email)
+                        slot = value & mask
+                        while table[slot] not in (0, value):
+                            slot = (slot + 1) & mask
+                        if table[slot] == 0:
+                            table[slot] = value
+                            count += 1
+                table.release()
+                INDEX_HEADER.pack_into(mm, 0, INDEX_MAGIC, capacity, count, size, mtime_ns, source_fingerprint)
+                mm.flush()
+        os.replace(tmp_path, index_path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return HashIndex(index_path)
+
+
+def open_index(list_path: str, index_path: str) -> HashIndex:
+    """Opens the index of ``list_path`` at ``index_path``, building it if it is missing or stale.
+
+    An index is reused as long as the list's size, modification time and
+    fingerprint are the ones it was built from.
+    """
+    if os.path.exists(index_path):
+        try:
+            index = HashIndex(index_path)
+        except ValueError:
+            pass
+        else:
+            if index.source == _signature(list_path) and index.fingerprint == fingerprint(list_path, index.source[0]):
+                return index
+            index.close()
+    return build_index(list_path, index_path)
+
 
+def _backup(path: str) -> str:
+    backup_path = path + ".bak"
+    if os.path.exists(backup_path):
+        os.remove(backup_path)
     try:
-        with open(list1_path, encoding="utf-8") as f:
-            lines = f.readlines()
-    except FileNotFoundError:
-        raise SystemExit(f"Error: file not found: {list1_path}")
+        os.link(path, backup_path)
+    except OSError:
+        shutil.copy2(path, backup_path)
+    return backup_path
+
 
-    filtered = [line for line in lines if line.strip() and line.strip().lower() not in list2_emails]
-    removed = len(lines) - len(filtered)
+def deduplicate(list1_path: str, list2_path: str, index_path: Optional[str] = None) -> None:
+    """Remove emails in list2 from list1, writing the result back to list1.
 
-    # Back up list1 before overwriting
-    shutil.copy2(list1_path, list1_path + ".bak")
+    list1 is streamed into a temporary file that then replaces it, so it is never
+    left half written. A backup of list1 is created as <list1_path>.bak first.
 
-    with open(list1_path, "w", encoding="utf-8") as f:
-        f.writelines(filtered)
+    With ``index_path``, list2 is looked up through a memory-mapped hash index kept
+    at that path (see ``open_index``) instead of being loaded into memory, so memory
+    use stays flat however large either list is. The index is reused by later runs
+    until list2 changes.
+    """
+    if not os.path.exists(list1_path):
+        raise SystemExit(f"Error: file not found: {list1_path}")
+    try:
+        if index_path:
+            excluded = open_index(list2_path, index_path)
+        else:
+            with open(list2_path, encoding="utf-8") as f:
+                excluded = {email for email in map(normalize, f) if email}
+    except FileNotFoundError:
+        raise SystemExit(f"Error: file not found: {list2_path}")
+
+    read = kept = 0
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(list1_path)), suffix=".tmp")
+    try:
+        with open(list1_path, encoding="utf-8") as src, os.fdopen(fd, "w", encoding="utf-8") as dst:
+            for line in src:
+                read += 1
+                email = normalize(line)
+                if email and email not in excluded:
+                    dst.write(line)
+                    kept += 1
+        shutil.copymode(list1_path, tmp_path)
+        backup_path = _backup(list1_path)
+        os.replace(tmp_path, list1_path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    finally:
+        if index_path:
+            excluded.close()
 
-    print(f"Removed {removed} duplicate(s). {len(filtered)} entries remaining in {list1_path}.")
-    print(f"Backup saved to {list1_path}.bak")
+    print(f"Removed {read - kept} duplicate(s). {kept} entries remaining in {list1_path}.")
+    print(f"Backup saved to {backup_path}")
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Remove emails in list2 from list1")
     parser.add_argument("list1", nargs="?", default="list1.txt", help="Path to the primary list (will be modified)")
     parser.add_argument("list2", nargs="?", default="list2.txt", help="Path to the exclusion list")
+    parser.add_argument("--index", help="Keep a memory-mapped hash index of list2 at this path and look emails up in it, "
+                                        "instead of loading list2 into memory. It is rebuilt when list2 changes.")
     args = parser.parse_args()
-    deduplicate(args.list1, args.list2)
\ No newline at end of file
+    deduplicate(args.list1, args.list2, args.index)
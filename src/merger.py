@@ -1,7 +1,14 @@
 import os
 import csv
+import json
+import heapq
+import hashlib
+import shutil
+import tempfile
+import itertools
 import configparser
 import argparse
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
 
 DEFAULT_CONFIG = {
@@ -11,19 +18,32 @@ DEFAULT_CONFIG = {
     'updates_column': 'subscribe',
     'survey_column': 'subscribe_survey',
     'start_index': None,
-    'end_index': None
+    'end_index': None,
+    'memory_budget': None,
+    'temp_dir': None,
+    'workers': None,
+    'state_file': None
 }
 
+# The external merge keeps at most this many sorted runs open at once.
+MAX_OPEN_RUNS = 64
+# Rough size in memory of a buffered row and of each of its fields, beyond the text.
+ROW_OVERHEAD = 200
+FIELD_OVERHEAD = 100
+# Bumped whenever the saved state of an incremental merge changes shape.
+STATE_VERSION = 1
+
 def load_merger_config(folder):
     config_path = os.path.join(folder, 'merger.ini')
     config = DEFAULT_CONFIG.copy()
     if os.path.exists(config_path):
         parser = configparser.ConfigParser()
         parser.read(config_path, encoding='utf-8')
-        if parser.has_section('Columns'):
-            for key in DEFAULT_CONFIG.keys():
-                if parser.has_option('Columns', key):
-                    config[key] = parser.get('Columns', key)
+        for section in ('Columns', 'Merge'):
+            if parser.has_section(section):
+                for key in DEFAULT_CONFIG.keys():
+                    if parser.has_option(section, key):
+                        config[key] = parser.get(section, key)
     return config
 
 def get_csv_files(subscribers_folder, start_idx, end_idx):
@@ -36,63 +56,334 @@ def get_csv_files(subscribers_folder, start_idx, end_idx):
     files.sort()
     return [fname for idx, fname in files]
 
-def merge_csv(folder, config):
+def get_csv_paths(folder, config):
     # Always look for CSVs in the 'subscribers' subfolder
     subscribers_folder = os.path.join(folder, 'subscribers')
     start_idx = int(config['start_index']) if config['start_index'] else None
     end_idx = int(config['end_index']) if config['end_index'] else None
-    output_path = os.path.join(folder, config['output_file'])
+    return [os.path.join(subscribers_folder, fname) for fname in get_csv_files(subscribers_folder, start_idx, end_idx)]
+
+def read_file(path, config):
+    """Yields (email, row) for every row of one file that has an email."""
+    with open(path, newline='', encoding='utf-8') as f:
+        reader = csv.DictReader(f)
+        for row in reader:
+            email = row.get(config['email_column'], '').strip().lower()
+            if email:
+                yield email, row
+
+def read_subscribers(folder, config):
+    """Yields (email, row) for every row with an email, in file and row order."""
+    for path in get_csv_paths(folder, config):
+        yield from read_file(path, config)
+
+def parse_timestamp(row):
+    try:
+        return datetime.fromisoformat(row.get('Timestamp', ''))
+    except (ValueError, TypeError):
+        return datetime.min
+
+def merge_row(merged, row, ts, config):
+    """Folds a later row of a subscriber into the merged row so far (None for the first one)."""
+    if merged is None or ts > merged['_ts']:
+        return {
+            **row,
+            '_ts': ts
+        }
+    # For each field, True always wins over False, regardless of timestamp
+    for col in [config['updates_column'], config['survey_column']]:
+        prev_val = merged.get(col, '').strip().lower()
+        curr_val = row.get(col, '').strip().lower()
+        if curr_val == 'true' or prev_val == '':
+            merged[col] = row.get(col, '')
+        elif curr_val == 'false' and prev_val != 'true':
+            merged[col] = row.get(col, '')
+    return merged
+
+# What a run of rows does to a flag column (updates_column or survey_column) of an
+# earlier merged row that it does not replace. merge_row treats the earlier value in
+# one of three ways: empty, 'true', or anything else. An effect holds, for each of
+# these, the value the column ends up with, or None if it is kept.
+def _flag_class(value):
+    value = value.strip().lower()
+    return 0 if value == '' else 1 if value == 'true' else 2
+
+def _row_effect(value):
+    normalized = value.strip().lower()
+    if normalized == 'true':
+        return (value, value, value)
+    return (value, None, value if normalized == 'false' else None)
+
+def _compose(first, then):
+    effect = []
+    for flag_class, value in enumerate(first):
+        after = then[flag_class if value is None else _flag_class(value)]
+        effect.append(value if after is None else after)
+    return tuple(effect)
+
+def merge_file(path, config):
+    """Merges the rows of one file on their own, for combining with merge_partial.
+
+    Returns a dict, in first-seen order, mapping each email to its merged row and the
+    effect of all its rows in the file on the flag columns of an earlier row.
+    """
+    columns = [config['updates_column'], config['survey_column']]
+    partial = {}
+    for email, row in read_file(path, config):
+        effects = tuple(_row_effect(row.get(col, '')) for col in columns)
+        entry = partial.get(email)
+        if entry is None:
+            partial[email] = [merge_row(None, row, parse_timestamp(row), config), effects]
+        else:
+            entry[0] = merge_row(entry[0], row, parse_timestamp(row), config)
+            entry[1] = tuple(_compose(before, after) for before, after in zip(entry[1], effects))
+    return partial
+
+def merge_partial(merged, partial, config):
+    """Applies the result of merge_file for one file on top of the files before it.
+
+    This gives the same rows, in the same order, as merging the file's rows one by
+    one with merge_row: a later row with a newer timestamp replaces the earlier one,
+    and otherwise only the flag columns change.
+    """
+    columns = [config['updates_column'], config['survey_column']]
+    for email, (row, effects) in partial.items():
+        prev = merged.get(email)
+        if prev is None or row['_ts'] > prev['_ts']:
+            merged[email] = row
+            continue
+        for col, effect in zip(columns, effects):
+            value = effect[_flag_class(prev.get(col, ''))]
+            if value is not None:
+                prev[col] = value
+    return merged
+
+def merge_parallel(paths, config, workers, merged=None):
+    """Merges each file in a pool of worker processes, then combines them in file order."""
+    merged = {} if merged is None else merged
+    with ProcessPoolExecutor(max_workers=max(1, min(workers, len(paths)))) as executor:
+        for partial in executor.map(merge_file, paths, itertools.repeat(config)):
+            merge_partial(merged, partial, config)
+    return merged
+
+def file_hash(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def file_signature(path):
+    stat = os.stat(path)
+    return {'name': os.path.basename(path), 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'sha256': file_hash(path)}
+
+def is_unchanged(path, entry):
+    """Checks a file against its manifest entry, hashing it only if its mtime moved."""
+    stat = os.stat(path)
+    if stat.st_size != entry['size']:
+        return False
+    if stat.st_mtime_ns == entry['mtime_ns']:
+        return True
+    if file_hash(path) != entry['sha256']:
+        return False
+    entry['mtime_ns'] = stat.st_mtime_ns
+    return True
+
+def _state_columns(config):
+    return [config['email_column'], config['updates_column'], config['survey_column']]
+
+def load_state(state_path, config):
+    """Returns the manifest and merged rows saved by save_state, or (None, None).
 
-    files = get_csv_files(subscribers_folder, start_idx, end_idx)
-    merged = {}
-
-    for fname in files:
-        path = os.path.join(subscribers_folder, fname)
-        with open(path, newline='', encoding='utf-8') as f:
-            reader = csv.DictReader(f)
-            for row in reader:
-                email = row.get(config['email_column'], '').strip().lower()
-                if not email:
-                    continue
-                timestamp = row.get('Timestamp', '')
-                try:
-                    ts = datetime.fromisoformat(timestamp)
-                except (ValueError, TypeError):
-                    ts = datetime.min
-                if email not in merged or ts > merged[email]['_ts']:
-                    merged[email] = {
-                        **row,
-                        '_ts': ts
-                    }
-                else:
-                    # For each field, True always wins over False, regardless of timestamp
-                    for col in [config['updates_column'], config['survey_column']]:
-                        prev_val = merged[email].get(col, '').strip().lower()
-                        curr_val = row.get(col, '').strip().lower()
-                        if curr_val == 'true' or prev_val == '':
-                            merged[email][col] = row.get(col, '')
-                        elif curr_val == 'false' and prev_val != 'true':
-                            merged[email][col] = row.get(col, '')
-
-    # Remove _ts before writing
-    if merged:
-        fieldnames = [k for k in next(iter(merged.values())).keys() if k != '_ts']
+    A missing or unreadable state file, or one saved for other columns, counts as no
+    state.
+    """
+    try:
+        with open(state_path, encoding='utf-8', newline='') as f:
+            header = json.loads(f.readline())
+            if header.get('version') != STATE_VERSION or header.get('columns') != _state_columns(config):
+                return None, None
+            merged = {}
+            for line in f:
+                email, row = json.loads(line)
+                row['_ts'] = datetime.fromisoformat(row['_ts'])
+                merged[email] = row
+        return header['files'], merged
+    except (OSError, ValueError, KeyError, TypeError):
+        return None, None
+
+def save_state(state_path, files, merged, config):
+    """Writes the manifest of merged files and the merged rows, replacing the old state atomically."""
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(state_path)), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8', newline='') as f:
+            f.write(json.dumps({'version': STATE_VERSION, 'columns': _state_columns(config), 'files': files}) + '\n')
+            for email, row in merged.items():
+                f.write(json.dumps([email, dict(row, _ts=row['_ts'].isoformat())], ensure_ascii=False))
+                f.write('\n')
+        os.replace(tmp_path, state_path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+def merge_incremental(folder, config, workers):
+    """Merges only the files added since the last run, on top of its saved state.
+
+    The state file holds the merged rows and a manifest with the name, size, mtime
+    and SHA-256 of every file merged into them. If those files are still the first
+    ones in the range and none of them changed, only the files after them are read.
+    Otherwise everything is merged again from scratch.
+    """
+    state_path = os.path.join(folder, config['state_file'])
+    paths = get_csv_paths(folder, config)
+    files, merged = load_state(state_path, config)
+    if files is not None and [os.path.basename(path) for path in paths[:len(files)]] == [entry['name'] for entry in files] \
+            and all(is_unchanged(path, entry) for path, entry in zip(paths, files)):
+        new_paths = paths[len(files):]
+        print(f"Merging {len(new_paths)} new files on top of {len(files)} already merged")
+    else:
+        if files is not None:
+            print("Previously merged files changed; merging all files again")
+        files, merged, new_paths = [], {}, paths
+
+    signatures = [file_signature(path) for path in new_paths]
+    if workers > 1 and len(new_paths) > 1:
+        merge_parallel(new_paths, config, workers, merged)
     else:
-        fieldnames = [config['email_column'], config['updates_column'], config['survey_column']]
+        for path in new_paths:
+            merge_partial(merged, merge_file(path, config), config)
+    save_state(state_path, files + signatures, merged, config)
+    return merged
+
+def write_merged(output_path, rows, config):
+    """Writes merged rows, taking the header from the first one. Returns the row count."""
+    count = 0
     with open(output_path, 'w', newline='', encoding='utf-8') as f:
-        writer = csv.DictWriter(f, fieldnames=fieldnames)
-        writer.writeheader()
-        for row in merged.values():
+        writer = None
+        for row in rows:
+            # Remove _ts before writing
             out_row = {k: v for k, v in row.items() if k != '_ts'}
+            if writer is None:
+                writer = csv.DictWriter(f, fieldnames=list(out_row.keys()))
+                writer.writeheader()
             writer.writerow(out_row)
+            count += 1
+        if writer is None:
+            writer = csv.DictWriter(f, fieldnames=[config['email_column'], config['updates_column'], config['survey_column']])
+            writer.writeheader()
+    return count
+
+def _record_size(record):
+    row = record[-1]
+    return ROW_OVERHEAD + sum(FIELD_OVERHEAD + len(str(k)) + (len(v) if isinstance(v, str) else 8) for k, v in row.items())
+
+def _write_run(records, temp_dir):
+    fd, path = tempfile.mkstemp(suffix='.run', dir=temp_dir)
+    with os.fdopen(fd, 'w', encoding='utf-8', newline='') as f:
+        for record in records:
+            f.write(json.dumps(record, ensure_ascii=False))
+            f.write('\n')
+    return path
+
+def _merge_runs(paths, key):
+    files = [open(path, encoding='utf-8', newline='') for path in paths]
+    try:
+        yield from heapq.merge(*((json.loads(line) for line in f) for f in files), key=key)
+    finally:
+        for f in files:
+            f.close()
+        for path in paths:
+            os.remove(path)
+
+def external_sort(records, key, memory_budget, temp_dir):
+    """Sorts JSON-serializable records by key, spilling sorted runs to temp_dir.
+
+    Records are buffered until their estimated size reaches memory_budget bytes, then
+    sorted and written out as a run. The runs are combined with a streaming k-way
+    merge, at most MAX_OPEN_RUNS at a time. If everything fits in the budget, nothing
+    is written to disk.
+    """
+    runs = []
+    chunk = []
+    size = 0
+    for record in records:
+        chunk.append(record)
+        size += _record_size(record)
+        if size >= memory_budget:
+            chunk.sort(key=key)
+            runs.append(_write_run(chunk, temp_dir))
+            chunk = []
+            size = 0
+    chunk.sort(key=key)
+    if not runs:
+        return iter(chunk)
+    if chunk:
+        runs.append(_write_run(chunk, temp_dir))
+    while len(runs) > MAX_OPEN_RUNS:
+        runs = [_write_run(_merge_runs(runs[i:i + MAX_OPEN_RUNS], key), temp_dir)
+                for i in range(0, len(runs), MAX_OPEN_RUNS)]
+    return _merge_runs(runs, key)
+
+def _fold_sorted(records, config):
+    # records are [email, seq, row] sorted by email, then by input order
+    for email, group in itertools.groupby(records, key=lambda record: record[0]):
+        merged = None
+        first_seq = None
+        for _, seq, row in group:
+            if first_seq is None:
+                first_seq = seq
+            merged = merge_row(merged, row, parse_timestamp(row), config)
+        del merged['_ts']
+        yield [first_seq, merged]
+
+def merge_external(folder, config, output_path):
+    """Merges on disk, keeping roughly memory_budget megabytes of rows in memory.
+
+    Rows are sorted by email and input position in spilled runs, folded per
+    subscriber with the same rules as the in-memory merge, then sorted back into the
+    order each subscriber was first seen, so the output is identical.
+    """
+    memory_budget = float(config['memory_budget']) * 1024 * 1024
+    temp_dir = tempfile.mkdtemp(prefix='merger-', dir=config.get('temp_dir') or None)
+    try:
+        records = ([email, seq, row] for seq, (email, row) in enumerate(read_subscribers(folder, config)))
+        by_email = external_sort(records, lambda record: (record[0], record[1]), memory_budget, temp_dir)
+        by_first_seen = external_sort(_fold_sorted(by_email, config), lambda record: record[0], memory_budget, temp_dir)
+        return write_merged(output_path, (row for _, row in by_first_seen), config)
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+
+def merge_csv(folder, config):
+    output_path = os.path.join(folder, config['output_file'])
+
+    workers = int(config['workers']) if config.get('workers') else 1
+    if workers == 0:
+        workers = os.cpu_count() or 1
+    if config.get('state_file'):
+        if config.get('memory_budget'):
+            raise ValueError("state_file cannot be combined with memory_budget")
+        count = write_merged(output_path, merge_incremental(folder, config, workers).values(), config)
+    elif config.get('memory_budget'):
+        count = merge_external(folder, config, output_path)
+    elif workers > 1:
+        count = write_merged(output_path, merge_parallel(get_csv_paths(folder, config), config, workers).values(), config)
+    else:
+        merged = {}
+        for email, row in read_subscribers(folder, config):
+            merged[email] = merge_row(merged.get(email), row, parse_timestamp(row), config)
+        count = write_merged(output_path, merged.values(), config)
 
-    print(f"Merged {len(merged)} unique subscribers to {output_path}")
+    print(f"Merged {count} unique subscribers to {output_path}")
 
 def main():
     parser = argparse.ArgumentParser(description="Merge and deduplicate subscribers CSV")
     parser.add_argument('folder', nargs='?', default='.', help='Folder containing merger.ini and the subscribers subfolder')
     parser.add_argument('--start', type=int, help='Start index (e.g. 2 for 002)')
     parser.add_argument('--end', type=int, help='End index (e.g. 4 for 004)')
+    parser.add_argument('--memory-budget', type=float, metavar='MB', help='Merge on disk, keeping about this many megabytes of rows in memory')
+    parser.add_argument('--temp-dir', help='Folder for the sorted runs of an on-disk merge (default: the system temp folder)')
+    parser.add_argument('--workers', type=int, help='Parse the files in this many processes (0 for one per CPU)')
+    parser.add_argument('--state', help='Keep the merged state in this file and only merge files added since the last run')
     args = parser.parse_args()
 
     config = load_merger_config(args.folder)
@@ -100,6 +391,16 @@ def main():
         config['start_index'] = str(args.start).zfill(3)
     if args.end is not None:
         config['end_index'] = str(args.end).zfill(3)
+    if args.memory_budget is not None:
+        config['memory_budget'] = str(args.memory_budget)
+    if args.temp_dir:
+        config['temp_dir'] = args.temp_dir
+    if args.workers is not None:
+        config['workers'] = str(args.workers)
+    if args.state:
+        config['state_file'] = args.state
+    if config.get('state_file') and config.get('memory_budget'):
+        parser.error("--state cannot be combined with a memory budget")
     merge_csv(args.folder, config)
 
 if __name__ == '__main__':
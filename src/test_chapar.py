@@ -1,19 +1,57 @@
 import unittest
+import asyncio
 import os
 import sys
 import configparser
+import csv
 from unittest.mock import patch, MagicMock
 import logging
+import random
+import tempfile
+import json
+import gzip
+import pickle
+import shutil
 sys.modules.setdefault('magic', MagicMock())
 import chapar_api
+import chapar_async
+import chapar_bench
+import chapar_metrics
+import chapar_relays
+import chapar_shards
+import chapar_templates
+import deduplicator
+import merger
+import chapar
 from chapar import (
     load_config,
     read_html,
     read_csv,
     _create_smtp_server,
     send_email,
+    _dispatch,
+    parse_rate,
+    RateLimiter,
+    create_rate_limiter,
+    AdaptiveThrottle,
+    classify_send_error,
+    compile_template,
+    build_message,
+    MessageBuilder,
+    open_recipients,
+    SendJournal,
+    SMTPSessionCache,
+    DispatchStats,
+    LatencyHistogram,
+    SEND_OK,
+    SEND_DEFERRED,
+    SEND_FAILED,
     main
 )
+import smtplib
+import ssl
+import email
+from email.header import decode_header, make_header
 from io import BytesIO, StringIO
 
 class TestEmailDispatcher(unittest.TestCase):
@@ -88,6 +126,229 @@ class TestEmailDispatcher(unittest.TestCase):
         mock_smtp.assert_called_once_with('host', 587, timeout=10)
         mock_smtp.return_value.starttls.assert_called_once()
 
+    def test_open_recipients_streams_rows(self):
+        with open(os.path.join(self.test_folder, "recipients.csv"), 'w') as f:
+            f.write("email,name,city\na@b.com,A,X\nc@d.com,C,Y\n")
+        with open_recipients(os.path.join(self.test_folder, "recipients.csv")) as recipients:
+            self.assertEqual(recipients.fieldnames, ['email', 'name', 'city'])
+            self.assertEqual(recipients.count, 0)
+            rows = iter(recipients)
+            self.assertEqual(next(rows)['email'], 'a@b.com')
+            self.assertEqual(recipients.count, 1)
+            list(rows)
+        self.assertEqual(recipients.count, 2)
+
+    def test_count_recipients_skips_blank_lines(self):
+        path = os.path.join(self.test_folder, "recipients.csv")
+        with open(path, 'w') as f:
+            f.write("email,name\n\na@b.com,A\n\nc@d.com,C\n\n")
+        self.assertEqual(chapar.count_recipients(path), 2)
+        with open_recipients(path) as recipients:
+            self.assertEqual(len(list(recipients)), 2)
+        with open(path, 'w') as f:
+            f.write("")
+        self.assertEqual(chapar.count_recipients(path), 0)
+
+    def test_open_recipients_missing_columns(self):
+        with open(os.path.join(self.test_folder, "recipients.csv"), 'w') as f:
+            f.write("email\njohn@doe.com")
+        with self.assertRaises(ValueError):
+            open_recipients(os.path.join(self.test_folder, "recipients.csv"))
+
+    def test_send_journal_records_and_filters(self):
+        path = os.path.join(self.test_folder, "sent.journal")
+        with open(path, 'w') as f:
+            f.write("a@b.com\nc@d.co")  # torn final line from a crash
+        journal = SendJournal(path, sync_every=2)
+        self.assertIn('A@B.com', journal)
+        self.assertNotIn('c@d.co', journal)
+        recipients = [{'email': e} for e in ('a@b.com', 'c@d.com', 'e@f.com')]
+        self.assertEqual([r['email'] for r in journal.filter(recipients)], ['c@d.com', 'e@f.com'])
+        self.assertEqual(journal.skipped, 1)
+        journal.record('E@f.com')
+        journal.close()
+        reopened = SendJournal(path)
+        self.assertIn('e@f.com', reopened)
+        self.assertEqual(len(reopened), 2)
+        reopened.close()
+        journal.discard()
+        self.assertFalse(os.path.exists(path))
+
+    @patch('chapar.deliver_email')
+    @patch('chapar._create_smtp_server')
+    def test_main_resumes_interrupted_fresh_run(self, mock_smtp_server, mock_send):
+        self.create_config({
+            'SMTP': {'Host': 'host', 'Port': '587', 'Email': 'user', 'Password': 'pass', 'Subject': 'Subj'},
+            'Settings': {'LogLevel': 'none', 'Journal': 'true'}
+        })
+        with open(os.path.join(self.test_folder, "email_template.html"), 'w') as f:
+            f.write("<html>{{name}}</html>")
+        with open(os.path.join(self.test_folder, "recipients.csv"), 'w') as f:
+            f.write("email,name\na@b.com,A\nc@d.com,C\ne@f.com,E\n")
+
+        def interrupted(settings, server, email, *args):
+            if email == 'e@f.com':
+                raise KeyboardInterrupt
+            return SEND_OK
+
+        mock_send.side_effect = interrupted
+        with self.assertRaises(KeyboardInterrupt):
+            main(self.test_folder)
+        mock_send.reset_mock(side_effect=True)
+        mock_send.return_value = SEND_OK
+
+        main(self.test_folder)
+
+        self.assertEqual([c.args[2] for c in mock_send.call_args_list], ['e@f.com'])
+        self.assertFalse(os.path.exists(os.path.join(self.test_folder, "sent.journal")))
+
+    @patch('chapar.deliver_email')
+    @patch('chapar._create_smtp_server')
+    def test_main_resumes_from_journal(self, mock_smtp_server, mock_send):
+        self.create_config({
+            'SMTP': {'Host': 'host', 'Port': '587', 'Email': 'user', 'Password': 'pass', 'Subject': 'Subj'},
+            'Settings': {'LogLevel': 'none', 'Journal': 'true'}
+        })
+        with open(os.path.join(self.test_folder, "email_template.html"), 'w') as f:
+            f.write("<html>{{name}}</html>")
+        with open(os.path.join(self.test_folder, "recipients.csv"), 'w') as f:
+            f.write("email,name\na@b.com,A\nc@d.com,C\ne@f.com,E\n")
+        with open(os.path.join(self.test_folder, "sent.journal"), 'w') as f:
+            f.write("a@b.com\n")
+        mock_send.return_value = SEND_OK
+
+        main(self.test_folder)
+
+        self.assertEqual([c.args[2] for c in mock_send.call_args_list], ['c@d.com', 'e@f.com'])
+        self.assertFalse(os.path.exists(os.path.join(self.test_folder, "sent.journal")))
+
+    def test_suppression_list_index_and_appends(self):
+        path = os.path.join(self.test_folder, "suppressed.txt")
+        with open(path, 'w') as f:
+            f.write("a@b.com\nC@D.com")
+        suppression = chapar.SuppressionList(path)
+        self.assertIn(' A@B.COM', suppression)
+        self.assertIn('c@d.com', suppression)
+        recipients = [{'email': e} for e in ('a@b.com', 'e@f.com')]
+        self.assertEqual([r['email'] for r in suppression.filter(recipients)], ['e@f.com'])
+        self.assertEqual(suppression.suppressed, 1)
+        suppression.close()
+        with open(path, 'a') as f:
+            f.write("\nE@f.com\n")
+
+        with patch('deduplicator.build_index') as build:
+            reopened = chapar.SuppressionList(path)
+        build.assert_not_called()
+        self.assertIn('e@f.com', reopened)
+        self.assertNotIn('g@h.com', reopened)
+        reopened.close()
+
+        with open(path + '.new', 'w') as f:
+            f.write("carol@b.com\nc@d.com\ndave@f.com\n\u00e9@x.com\n")
+        os.replace(path + '.new', path)
+        replaced = chapar.SuppressionList(path)
+        self.assertNotIn('a@b.com', replaced)
+        self.assertIn('carol@b.com', replaced)
+        self.assertIn('dave@f.com', replaced)
+        replaced.close()
+        with open(path, 'w') as f:
+            # Longer than before, with a character split at the old indexed size.
+            f.write("zed@b.com\nalice@b.com\nbob@yyyyyyyyy.com\u00e9\ncarol@b.com\n")
+        rewritten = chapar.SuppressionList(path)
+        self.assertIn('zed@b.com', rewritten)
+        self.assertIn('carol@b.com', rewritten)
+        self.assertNotIn('dave@f.com', rewritten)
+        rewritten.close()
+
+        missing = chapar.SuppressionList(os.path.join(self.test_folder, "missing.txt"))
+        self.assertNotIn('a@b.com', missing)
+        missing.close()
+        self.assertFalse(os.path.exists(os.path.join(self.test_folder, "missing.txt")))
+        self.assertFalse(os.path.exists(os.path.join(self.test_folder, "missing.txt.idx")))
+
+    def test_job_suppression_list_must_stay_in_folder(self):
+        for path in ('../outside.txt', os.path.join(tempfile.gettempdir(), 'outside.txt')):
+            self.create_config({
+                'SMTP': {'Host': 'host', 'Port': '587', 'Email': 'user', 'Password': 'pass', 'Subject': 'Subj'},
+                'Settings': {'LogLevel': 'none', 'SuppressionList': path}
+            })
+            with self.assertRaisesRegex(ValueError, 'SuppressionList'):
+                load_config(self.test_folder)
+            with self.assertRaises(ValueError):
+                chapar.open_suppression_list(self.test_folder, {'SuppressionList': path})
+            self.create_config({
+                'SMTP': {'Host': 'host', 'Port': '587', 'Email': 'user', 'Password': 'pass', 'Subject': 'Subj', 'CAFile': path},
+                'Settings': {'LogLevel': 'none'}
+            })
+            with self.assertRaisesRegex(ValueError, 'CAFile'):
+                load_config(self.test_folder)
+        self.assertFalse(os.path.exists(os.path.join(os.path.dirname(self.test_folder), 'outside.txt')))
+
+    @patch('chapar.deliver_email')
+    @patch('chapar._create_smtp_server')
+    def test_dispatch_folder_skips_suppressed_recipients(self, mock_smtp_server, mock_send):
+        self.create_config({
+            'SMTP': {'Host': 'host', 'Port': '587', 'Email': 'user', 'Password': 'pass', 'Subject': 'Subj'},
+            'Settings': {'LogLevel': 'none', 'SuppressionList': 'suppressed.txt'}
+        })
+        with open(os.path.join(self.test_folder, "email_template.html"), 'w') as f:
+            f.write("<html>{{name}}</html>")
+        with open(os.path.join(self.test_folder, "recipients.csv"), 'w') as f:
+            f.write("email,name\na@b.com,A\nc@d.com,C\ne@f.com,E\n")
+        with open(os.path.join(self.test_folder, "suppressed.txt"), 'w') as f:
+            f.write("C@d.com\n")
+        mock_send.return_value = SEND_OK
+        progress = chapar.DispatchProgress()
+
+        result = chapar.dispatch_folder(self.test_folder, progress)
+
+        self.assertEqual([c.args[2] for c in mock_send.call_args_list], ['a@b.com', 'e@f.com'])
+        self.assertEqual((result['sent'], result['suppressed']), (2, 1))
+        self.assertEqual(progress.snapshot()['remaining'], 0)
+
+    @patch('chapar.deliver_email')
+    @patch('chapar._create_smtp_server')
+    def test_job_suppression_list_adds_to_global_list(self, mock_smtp_server, mock_send):
+        self.create_config({
+            'SMTP': {'Host': 'host', 'Port': '587', 'Email': 'user', 'Password': 'pass', 'Subject': 'Subj'},
+            'Settings': {'LogLevel': 'none', 'SuppressionList': 'suppressed.txt'}
+        })
+        with open(os.path.join(self.test_folder, "email_template.html"), 'w') as f:
+            f.write("<html>{{name}}</html>")
+        with open(os.path.join(self.test_folder, "recipients.csv"), 'w') as f:
+            f.write("email,name\na@b.com,A\nc@d.com,C\ne@f.com,E\n")
+        with open(os.path.join(self.test_folder, "suppressed.txt"), 'w') as f:
+            f.write("c@d.com\n")
+        with tempfile.TemporaryDirectory() as global_dir:
+            global_list = os.path.join(global_dir, 'global.txt')
+            with open(global_list, 'w') as f:
+                f.write("A@b.com\n")
+            mock_send.return_value = SEND_OK
+            with patch('chapar.GLOBAL_SUPPRESSION_LIST', global_list):
+                result = chapar.dispatch_folder(self.test_folder)
+
+        self.assertEqual([c.args[2] for c in mock_send.call_args_list], ['e@f.com'])
+        self.assertEqual(result['suppressed'], 2)
+
+    @patch('chapar.deliver_email')
+    @patch('chapar._create_smtp_server')
+    def test_dispatch_folder_journals_fresh_run(self, mock_smtp_server, mock_send):
+        self.create_config({
+            'SMTP': {'Host': 'host', 'Port': '587', 'Email': 'user', 'Password': 'pass', 'Subject': 'Subj'},
+            'Settings': {'LogLevel': 'none', 'Journal': 'true', 'MaxRetries': '0'}
+        })
+        with open(os.path.join(self.test_folder, "email_template.html"), 'w') as f:
+            f.write("<html>{{name}}</html>")
+        with open(os.path.join(self.test_folder, "recipients.csv"), 'w') as f:
+            f.write("email,name\na@b.com,A\nc@d.com,C\n")
+        mock_send.side_effect = lambda settings, server, email, *args: SEND_OK if email == 'a@b.com' else SEND_FAILED
+
+        result = chapar.dispatch_folder(self.test_folder)
+
+        self.assertEqual(result['failures'], ['c@d.com'])
+        with open(os.path.join(self.test_folder, "sent.journal")) as f:
+            self.assertEqual(f.read(), "a@b.com\n")
+
     @patch('chapar._create_smtp_server')
     def test_send_email_success(self, mock_smtp):
         mock_server = MagicMock()
@@ -114,19 +375,19 @@ class TestEmailDispatcher(unittest.TestCase):
 
     @patch('chapar.load_config')
     @patch('chapar.read_html')
-    @patch('chapar.read_csv')
-    @patch('chapar.send_email')
+    @patch('chapar.deliver_email')
     @patch('chapar._create_smtp_server')
     @patch('time.sleep')
-    def test_main_success(self, mock_sleep, mock_smtp_server, mock_send, mock_csv, mock_html, mock_config):
+    def test_main_success(self, mock_sleep, mock_smtp_server, mock_send, mock_html, mock_config):
         mock_config.return_value = {
             'SMTP': {'Host': 'host', 'Port': '587', 'Email': 'user', 
                     'Password': 'pass', 'Subject': 'Subj'},
             'Settings': {'Interval': '0', 'LogLevel': 'detailed'}
         }
         mock_html.return_value = "<html></html>"
-        mock_csv.return_value = [{'email': 'a@b.com', 'name': 'Alice'}]
-        mock_send.return_value = True
+        with open(os.path.join(self.test_folder, "recipients.csv"), 'w') as f:
+            f.write("email,name\na@b.com,Alice\n")
+        mock_send.return_value = SEND_OK
         mock_server = MagicMock()
         mock_smtp_server.return_value.__enter__ = MagicMock(return_value=mock_server)
         mock_smtp_server.return_value.__exit__ = MagicMock(return_value=False)
@@ -134,6 +395,310 @@ class TestEmailDispatcher(unittest.TestCase):
         main(self.test_folder)
         self.assertEqual(mock_send.call_count, 1)
 
+    def test_load_config_invalid_concurrency(self):
+        self.create_config({
+            'SMTP': {'Host': 'smtp.example.com', 'Port': '587', 'Email': 'user@example.com',
+                     'Password': 'pass', 'Subject': 'Hello'},
+            'Settings': {'Interval': '0', 'Concurrency': '0'}
+        })
+        with self.assertRaises(ValueError):
+            load_config(self.test_folder)
+
+    def test_load_config_relay_sections(self):
+        self.create_config({
+            'SMTP:primary': {'Host': 'smtp.example.com', 'Port': '587', 'Email': 'user@example.com',
+                             'Password': 'pass', 'Subject': 'Hello', 'Security': 'STARTTLS'},
+            'Settings': {'Interval': '0'}
+        })
+        config = load_config(self.test_folder)
+        self.assertEqual(config['SMTP:primary']['Security'], 'starttls')
+        for setting in ({'Weight': '0'}, {'Rate': 'fast'}):
+            self.create_config({
+                'SMTP:primary': {'Host': 'smtp.example.com', 'Port': '587', 'Email': 'user@example.com',
+                                 'Password': 'pass', 'Subject': 'Hello', **setting},
+                'Settings': {'Interval': '0'}
+            })
+            with self.assertRaises(ValueError):
+                load_config(self.test_folder)
+
+    @patch('chapar.deliver_email')
+    @patch('chapar._create_smtp_server')
+    @patch('time.sleep')
+    def test_dispatch_concurrent(self, mock_sleep, mock_smtp_server, mock_send):
+        mock_send.side_effect = lambda settings, server, email, *args: SEND_FAILED if email == 'bad@b.com' else SEND_OK
+        recipients = [{'email': f'user{i}@b.com', 'name': f'User {i}'} for i in range(20)]
+        recipients.append({'email': 'bad@b.com', 'name': 'Bad'})
+        smtp_settings = {'host': 'host', 'port': '587', 'email': 'user', 'password': 'pass', 'subject': 'Subj'}
+
+        result = _dispatch(smtp_settings, recipients, '<html></html>', None, 'none', 'test', concurrency=4)
+
+        self.assertEqual(result, (20, 1))
+        self.assertEqual(mock_smtp_server.call_count, 4)
+        self.assertEqual(mock_send.call_count, 21)
+
+    @patch('chapar._create_smtp_server')
+    def test_dispatch_records_stage_times(self, mock_smtp_server):
+        recipients = [{'email': f'user{i}@b.com', 'name': f'User {i}'} for i in range(5)]
+        smtp_settings = {'host': 'host', 'port': '587', 'email': 'user', 'password': 'pass', 'subject': 'Subj'}
+        stats = DispatchStats()
+
+        _dispatch(smtp_settings, stats.timed('csv', recipients), '<html>{{name}}</html>', RateLimiter(1000), 'none', 'test', stats=stats)
+
+        self.assertEqual(stats.calls['csv'], 6)
+        for stage in ('render', 'mime', 'throttle', 'smtp'):
+            self.assertEqual(stats.calls[stage], 5)
+        self.assertEqual(stats.send_latency.count, 5)
+        self.assertEqual(stats.outcomes, {SEND_OK: 5, SEND_FAILED: 0})
+        self.assertIn('smtp', stats.format_report())
+
+    @patch('chapar._create_smtp_server')
+    def test_dispatch_batches_placeholder_free_template(self, mock_smtp_server):
+        server = mock_smtp_server.return_value
+        server.sendmail.side_effect = lambda sender, to_addrs, message: {
+            address: (550, b'No such user') for address in to_addrs if address.startswith('bad')
+        }
+        recipients = [{'email': f'user{i}@b.com', 'name': f'User {i}'} for i in range(5)]
+        recipients.insert(2, {'email': 'bad@b.com', 'name': 'Bad'})
+        smtp_settings = {'host': 'host', 'port': '587', 'email': 'user', 'password': 'pass', 'subject': 'Subj'}
+
+        result = _dispatch(smtp_settings, recipients, '<html>News</html>', None, 'none', 'test', batch_size=4)
+
+        self.assertEqual(result, (5, 1))
+        self.assertEqual([len(c.args[1]) for c in server.sendmail.call_args_list], [4, 2])
+        message = email.message_from_bytes(server.sendmail.call_args_list[0].args[2])
+        self.assertEqual(message['To'], 'undisclosed-recipients:;')
+
+    @patch('chapar._create_smtp_server')
+    def test_dispatch_does_not_batch_personalized_template(self, mock_smtp_server):
+        server = mock_smtp_server.return_value
+        server.sendmail.return_value = {}
+        recipients = [{'email': f'user{i}@b.com', 'name': f'User {i}'} for i in range(3)]
+        smtp_settings = {'host': 'host', 'port': '587', 'email': 'user', 'password': 'pass', 'subject': 'Subj'}
+
+        result = _dispatch(smtp_settings, recipients, '<html>{{name}}</html>', None, 'none', 'test', batch_size=4)
+
+        self.assertEqual(result, (3, 0))
+        self.assertEqual(server.sendmail.call_count, 3)
+
+    @patch('chapar._create_smtp_server')
+    def test_session_cache_reuses_live_sessions(self, mock_smtp_server):
+        first, second = MagicMock(), MagicMock()
+        first.noop.return_value = (250, b'OK')
+        mock_smtp_server.side_effect = [first, second]
+        now = [0.0]
+        cache = SMTPSessionCache(max_size=1, idle_timeout=30, clock=lambda: now[0])
+        settings = {'host': 'host', 'port': '587', 'email': 'user', 'password': 'pass'}
+
+        with cache.session(settings) as server:
+            self.assertIs(server, first)
+        with cache.session(settings) as server:
+            self.assertIs(server, first)
+        self.assertEqual(mock_smtp_server.call_count, 1)
+
+        self.assertIs(cache.acquire(dict(settings, password='other')), second)
+        cache.release(second, settings)
+        second.quit.assert_called_once()
+        self.assertEqual(len(cache), 1)
+
+        now[0] = 31
+        cache.prune()
+        first.quit.assert_called_once()
+        self.assertEqual(len(cache), 0)
+
+    @patch('chapar._create_smtp_server')
+    def test_session_cache_replaces_dead_session(self, mock_smtp_server):
+        dead, fresh = MagicMock(), MagicMock()
+        dead.noop.side_effect = smtplib.SMTPServerDisconnected('gone')
+        mock_smtp_server.return_value = fresh
+        cache = SMTPSessionCache()
+        settings = {'host': 'host', 'port': '587', 'email': 'user', 'password': 'pass'}
+        cache.release(dead, settings)
+
+        self.assertIs(cache.acquire(settings), fresh)
+        dead.quit.assert_called_once()
+
+    def test_latency_histogram_quantiles(self):
+        histogram = LatencyHistogram((0.01, 0.1, 1.0))
+        for seconds in [0.005] * 90 + [0.05] * 9 + [5.0]:
+            histogram.observe(seconds)
+
+        self.assertEqual(histogram.quantile(0.5), 0.01)
+        self.assertEqual(histogram.quantile(0.99), 0.1)
+        self.assertEqual(histogram.quantile(1.0), 1.0)
+        self.assertEqual(histogram.cumulative()[-1], (float('inf'), 100))
+
+    def test_parse_rate(self):
+        self.assertEqual(parse_rate('10/s'), 10)
+        self.assertEqual(parse_rate('30/m'), 0.5)
+        self.assertEqual(parse_rate('0.5'), 0.5)
+        with self.assertRaises(ValueError):
+            parse_rate('10/d')
+
+    def test_rate_limiter_token_bucket(self):
+        now = [0.0]
+        limiter = RateLimiter(2, burst=2, clock=lambda: now[0])
+        self.assertEqual([limiter.reserve() for _ in range(4)], [0.0, 0.0, 0.5, 1.0])
+        now[0] = 2.5  # time spent sending refills the bucket
+        self.assertEqual(limiter.reserve(), 0.0)
+
+    def test_rate_limiter_per_domain(self):
+        now = [0.0]
+        limiter = RateLimiter(None, domain_rate=1, clock=lambda: now[0])
+        self.assertEqual(limiter.reserve('a@one.com'), 0.0)
+        self.assertEqual(limiter.reserve('b@two.com'), 0.0)
+        self.assertEqual(limiter.reserve('c@ONE.com'), 1.0)
+
+    def test_create_rate_limiter_from_interval(self):
+        self.assertIsNone(create_rate_limiter({'Interval': '0'}))
+        limiter = create_rate_limiter({'Interval': '2'})
+        self.assertEqual(limiter._global.rate, 0.5)
+        self.assertEqual(limiter._global.capacity, 1)
+
+    def test_classify_send_error(self):
+        self.assertEqual(classify_send_error(smtplib.SMTPDataError(451, b'slow down')), SEND_DEFERRED)
+        self.assertEqual(classify_send_error(smtplib.SMTPRecipientsRefused({'a@b.com': (421, b'busy')})), SEND_DEFERRED)
+        self.assertEqual(classify_send_error(smtplib.SMTPRecipientsRefused({'a@b.com': (550, b'unknown')})), SEND_FAILED)
+        self.assertEqual(classify_send_error(OSError('reset')), chapar.SEND_DISCONNECTED)
+        self.assertEqual(classify_send_error(smtplib.SMTPServerDisconnected('gone')), chapar.SEND_DISCONNECTED)
+        self.assertEqual(classify_send_error(smtplib.SMTPDataError(554, b'rejected')), SEND_FAILED)
+
+    def test_adaptive_throttle_aimd(self):
+        now = [0.0]
+        limiter = RateLimiter(10, clock=lambda: now[0])
+        throttle = AdaptiveThrottle(limiter, min_rate=1, max_rate=12, increase=5, decrease=0.5, max_deferrals=2, clock=lambda: now[0])
+        throttle.record(SEND_OK)
+        self.assertAlmostEqual(limiter.rate, 10.5)
+        throttle.record(SEND_DEFERRED)
+        self.assertAlmostEqual(limiter.rate, 5.25)
+        throttle.record(SEND_DEFERRED)  # same congestion event
+        self.assertAlmostEqual(limiter.rate, 5.25)
+        now[0] = 2.0
+        for _ in range(3):
+            throttle.record(SEND_DEFERRED)
+        self.assertEqual(limiter.rate, 2.625)
+        for _ in range(100):
+            throttle.record(SEND_OK)
+        self.assertEqual(limiter.rate, 12)
+
+    @patch('chapar.deliver_email')
+    @patch('chapar._create_smtp_server')
+    def test_dispatch_requeues_deferred(self, mock_smtp_server, mock_send):
+        attempts = {}
+
+        def deliver(settings, server, email, *args):
+            attempts[email] = attempts.get(email, 0) + 1
+            if email == 'slow@b.com' and attempts[email] < 2:
+                return SEND_DEFERRED
+            if email == 'busy@b.com':
+                return SEND_DEFERRED
+            return SEND_OK
+
+        mock_send.side_effect = deliver
+        limiter = RateLimiter(1000)
+        throttle = AdaptiveThrottle(limiter, 1, 1000, 1, 0.5, max_deferrals=2)
+        recipients = [{'email': e, 'name': 'X'} for e in ('a@b.com', 'slow@b.com', 'busy@b.com')]
+        smtp_settings = {'host': 'host', 'port': '587', 'email': 'user', 'password': 'pass', 'subject': 'Subj'}
+
+        result = _dispatch(smtp_settings, recipients, '<html></html>', limiter, 'none', 'test', throttle=throttle)
+
+        self.assertEqual(result, (2, 1))
+        self.assertEqual(attempts, {'a@b.com': 1, 'slow@b.com': 2, 'busy@b.com': 3})
+
+    def test_max_deferrals_overrides_max_retries(self):
+        retry = chapar.RetryPolicy(max_retries=3)
+        limiter = RateLimiter(1000)
+        throttle = chapar.create_adaptive_throttle({'Adaptive': 'true', 'MaxDeferrals': '0'}, limiter)
+        self.assertEqual(chapar.max_send_attempts(retry, throttle), 1)
+        throttle = chapar.create_adaptive_throttle({'Adaptive': 'true', 'MaxDeferrals': '5'}, limiter)
+        self.assertEqual(chapar.max_send_attempts(retry, throttle), 6)
+        throttle = chapar.create_adaptive_throttle({'Adaptive': 'true'}, limiter)
+        self.assertIsNone(throttle.max_deferrals)
+        self.assertEqual(chapar.max_send_attempts(retry, throttle), 4)
+        self.assertEqual(chapar.max_send_attempts(None, None), 1)
+
+    @patch('chapar._create_smtp_server')
+    def test_dispatch_fails_deferral_with_max_deferrals_zero(self, mock_smtp_server):
+        server = MagicMock()
+        server.sendmail.side_effect = smtplib.SMTPRecipientsRefused({'a@b.com': (451, b'try later')})
+        mock_smtp_server.return_value = server
+        limiter = RateLimiter(1000)
+        throttle = AdaptiveThrottle(limiter, 1, 1000, 1, 0.5, max_deferrals=0)
+        retry = chapar.RetryPolicy(max_retries=3, sleep=lambda delay: None)
+        smtp_settings = {'host': 'host', 'port': '587', 'email': 'user', 'password': 'pass', 'subject': 'Subj'}
+
+        result = _dispatch(smtp_settings, [{'email': 'a@b.com', 'name': 'X'}], '<html></html>', limiter, 'none', 'test', throttle=throttle, retry=retry)
+
+        self.assertEqual(result, (0, 1))
+        self.assertEqual(server.sendmail.call_count, 1)
+
+    @patch('chapar._create_smtp_server')
+    def test_dispatch_reconnects_dropped_session(self, mock_smtp_server):
+        dropped, fresh = MagicMock(), MagicMock()
+        dropped.sendmail.side_effect = [None, smtplib.SMTPServerDisconnected('gone')]
+        mock_smtp_server.side_effect = [dropped, OSError('refused'), fresh]
+        delays = []
+        retry = chapar.RetryPolicy(max_retries=2, backoff=0.5, sleep=delays.append)
+        recipients = [{'email': f'user{i}@b.com', 'name': 'X'} for i in range(4)]
+        smtp_settings = {'host': 'host', 'port': '587', 'email': 'user', 'password': 'pass', 'subject': 'Subj'}
+
+        result = _dispatch(smtp_settings, recipients, '<html></html>', None, 'none', 'test', retry=retry)
+
+        self.assertEqual(result, (4, 0))
+        self.assertEqual(mock_smtp_server.call_count, 3)
+        self.assertEqual(delays, [0.5, 1.0, 0.5])
+        sent_to = [c.args[1] for c in fresh.sendmail.call_args_list]
+        self.assertEqual(sent_to, ['user2@b.com', 'user3@b.com', 'user1@b.com'])
+
+    @patch('chapar._create_smtp_server')
+    def test_dispatch_gives_up_when_reconnect_fails(self, mock_smtp_server):
+        dropped = MagicMock()
+        dropped.sendmail.side_effect = smtplib.SMTPServerDisconnected('gone')
+        mock_smtp_server.side_effect = [dropped, OSError('refused'), OSError('refused')]
+        retry = chapar.RetryPolicy(max_reconnects=2, sleep=lambda seconds: None)
+        recipients = [{'email': f'user{i}@b.com', 'name': 'X'} for i in range(3)]
+        smtp_settings = {'host': 'host', 'port': '587', 'email': 'user', 'password': 'pass', 'subject': 'Subj'}
+
+        with self.assertRaises(OSError):
+            _dispatch(smtp_settings, recipients, '<html></html>', None, 'none', 'test', retry=retry)
+        self.assertEqual(dropped.sendmail.call_count, 1)
+
+    def test_retry_policy_backoff(self):
+        retry = chapar.RetryPolicy(backoff=2, max_backoff=10)
+        self.assertEqual([retry.delay(n) for n in range(1, 5)], [2, 4, 8, 10])
+        self.assertEqual(chapar.create_retry_policy({'MaxRetries': '0'}).max_retries, 0)
+
+    def test_compile_template_fills_columns(self):
+        template = compile_template('<p>{{name}} from {{ city }}</p>{{unknown}}{{name}}', ['email', 'name', 'city'])
+        self.assertEqual(template.placeholders, ['name', 'city', 'name'])
+        rendered = template.render({'email': 'a@b.com', 'name': 'A & B', 'city': '<Tehran>'})
+        self.assertEqual(rendered, '<p>A &amp; B from &lt;Tehran&gt;</p>{{unknown}}A &amp; B')
+
+    def test_build_message_compiled_matches_plain(self):
+        smtp_settings = {'email': 'from@example.com', 'subject': 'Hi', 'DisplayName': 'Test'}
+        html_content = '<html>{{name}}</html>'
+        plain = build_message(smtp_settings, 'to@example.com', 'Jo <3', html_content)
+        compiled = build_message(smtp_settings, 'to@example.com', 'Jo <3', compile_template(html_content, ['email', 'name']))
+        strip_boundary = lambda m: [line for line in m.splitlines() if '=====' not in line]
+        self.assertEqual(strip_boundary(plain), strip_boundary(compiled))
+
+    def test_message_builder_matches_build_message(self):
+        smtp_settings = {'email': 'from@example.com', 'subject': 'سلام ' * 20, 'DisplayName': 'چاپار'}
+        html_content = '<html dir="rtl">' + 'متن ' * 500 + '{{name}}</html>'
+        recipient = {'email': 'to@example.com', 'name': 'Jo & Ann'}
+        built = MessageBuilder(smtp_settings, compile_template(html_content, ['email', 'name'])).build('to@example.com', recipient)
+        expected = email.message_from_string(build_message(smtp_settings, 'to@example.com', 'Jo & Ann', html_content))
+
+        self.assertIsInstance(built, bytes)
+        self.assertNotIn(b'\n', built.replace(b'\r\n', b''))
+        actual = email.message_from_bytes(built)
+        decoded = lambda value: str(make_header(decode_header(value)))
+        for header in ('From', 'To', 'Subject', 'MIME-Version'):
+            self.assertEqual(decoded(actual[header]), decoded(expected[header]))
+        self.assertEqual(actual.get_content_type(), 'multipart/alternative')
+        [actual_part], [expected_part] = actual.get_payload(), expected.get_payload()
+        self.assertEqual(actual_part.get_content_type(), expected_part.get_content_type())
+        self.assertEqual(actual_part.get_payload(decode=True), expected_part.get_payload(decode=True))
+
     @patch('chapar.load_config')
     def test_main_config_error(self, mock_config):
         mock_config.side_effect = ValueError("Config error")
@@ -144,6 +709,264 @@ class TestEmailDispatcher(unittest.TestCase):
         self.assertIn("Config error", log.output[0])
 
 
+class TestAsyncEngine(unittest.TestCase):
+
+    def setUp(self):
+        logging.disable(logging.CRITICAL)
+
+    def tearDown(self):
+        logging.disable(logging.NOTSET)
+
+    def test_dispatch_async_counts(self):
+        received = []
+
+        async def handle(reader, writer):
+            writer.write(b'220 sink ready\r\n')
+            while True:
+                line = (await reader.readline()).decode().rstrip('\r\n')
+                if not line:
+                    break
+                verb = line.split(' ')[0].upper()
+                if verb == 'EHLO':
+                    writer.write(b'250-sink\r\n250 AUTH PLAIN LOGIN\r\n')
+                elif verb == 'AUTH':
+                    writer.write(b'235 ok\r\n')
+                elif verb == 'RCPT' and 'bad@' in line:
+                    writer.write(b'550 no such user\r\n')
+                elif verb == 'DATA':
+                    writer.write(b'354 go ahead\r\n')
+                    await writer.drain()
+                    data = await reader.readuntil(b'\r\n.\r\n')
+                    received.append(data)
+                    writer.write(b'250 queued\r\n')
+                elif verb == 'QUIT':
+                    writer.write(b'221 bye\r\n')
+                    await writer.drain()
+                    break
+                else:
+                    writer.write(b'250 ok\r\n')
+                await writer.drain()
+            writer.close()
+
+        async def run():
+            server = await asyncio.start_server(handle, '127.0.0.1', 0)
+            sink_port = server.sockets[0].getsockname()[1]
+            open_connection = asyncio.open_connection
+
+            async def fake_open_connection(host, port, ssl=None):
+                return await open_connection('127.0.0.1', sink_port)
+
+            smtp_settings = {'host': 'localhost', 'port': '465', 'email': 'from@example.com',
+                             'password': 'pass', 'subject': 'Test', 'DisplayName': 'Test'}
+            recipients = [{'email': f'user{i}@example.com', 'name': f'User {i}'} for i in range(5)]
+            recipients.append({'email': 'bad@example.com', 'name': 'Bad'})
+            with patch('chapar_async.asyncio.open_connection', fake_open_connection):
+                result = await chapar_async.dispatch_async(
+                    smtp_settings, recipients, chapar.MessageBuilder(smtp_settings, '<html>{{name}}</html>'), None, 'none', 'test', 3)
+            server.close()
+            await server.wait_closed()
+            return result
+
+        self.assertEqual(asyncio.run(run()), (5, 1))
+        self.assertEqual(len(received), 5)
+
+
+class TestRelays(unittest.TestCase):
+
+    def setUp(self):
+        logging.disable(logging.CRITICAL)
+
+    def tearDown(self):
+        logging.disable(logging.NOTSET)
+
+    def make_pool(self, **weights):
+        relays = [chapar_relays.Relay(name, {'host': name, 'port': '587', 'email': f'{name}@example.com',
+                                             'password': 'pass', 'subject': 'Subj'}, weight)
+                  for name, weight in weights.items()]
+        return chapar_relays.RelayPool(relays)
+
+    def test_pool_spreads_by_weight(self):
+        pool = self.make_pool(primary=3, backup=1)
+        primary, backup = pool.relays
+        picks = [pool.choose().name for _ in range(8)]
+        self.assertEqual(picks.count('primary'), 6)
+        self.assertNotEqual(picks[:3], ['primary'] * 3)
+        self.assertIs(pool.choose(exclude=primary), backup)
+        pool.mark_down(backup, OSError('refused'))
+        self.assertIs(pool.choose(exclude=primary), primary)
+        pool.mark_down(primary, OSError('refused'))
+        self.assertIsNone(pool.choose())
+
+    def test_load_relays_inherits_smtp_section(self):
+        config = configparser.ConfigParser()
+        config.read_string("""
+[SMTP]
+Subject = Hello
+DisplayName = News
+[SMTP:primary]
+Host = smtp1.example.com
+Port = 465
+Email = a@example.com
+Password = one
+Weight = 3
+Rate = 10/s
+[SMTP:backup]
+Host = smtp2.example.com
+Port = 587
+Email = b@example.com
+Password = two
+[Settings]
+Concurrency = 2
+""")
+        pool = chapar_relays.load_relays(config)
+        primary, backup = pool.relays
+        self.assertEqual((primary.name, primary.weight, primary.concurrency), ('primary', 3, 2))
+        self.assertEqual(primary.smtp_settings['subject'], 'Hello')
+        self.assertEqual(backup.smtp_settings['email'], 'b@example.com')
+        self.assertEqual(primary.limiter.rate, 10)
+        self.assertIsNone(backup.limiter)
+
+    @patch('chapar._create_smtp_server')
+    def test_dispatch_fails_over(self, mock_smtp_server):
+        servers = {'backup': MagicMock()}
+        deferred = []
+
+        def primary_send(sender, to, message):
+            deferred.append(to)
+            raise smtplib.SMTPDataError(451, b'busy')
+
+        servers['primary'] = MagicMock()
+        servers['primary'].sendmail.side_effect = primary_send
+        mock_smtp_server.side_effect = lambda host, *args: servers[host]
+        pool = self.make_pool(primary=1, backup=1)
+        recipients = [{'email': f'user{i}@b.com', 'name': 'X'} for i in range(6)]
+        retry = chapar.RetryPolicy(max_retries=1, sleep=lambda seconds: None)
+
+        result = chapar_relays.dispatch(pool, recipients, compile_template('<html></html>'), None, 'none', 'test', retry=retry)
+
+        self.assertEqual(result, (6, 0))
+        self.assertEqual(len(deferred), 3)
+        self.assertEqual(servers['backup'].sendmail.call_count, 6)
+        report = {relay['name']: relay for relay in pool.report()}
+        self.assertEqual((report['primary']['deferred'], report['backup']['sent']), (3, 6))
+
+    @patch('chapar._create_smtp_server')
+    def test_dispatch_skips_unreachable_relay(self, mock_smtp_server):
+        backup = MagicMock()
+
+        def connect(host, *args):
+            if host == 'primary':
+                raise smtplib.SMTPAuthenticationError(535, b'bad credentials')
+            return backup
+
+        mock_smtp_server.side_effect = connect
+        pool = self.make_pool(primary=5, backup=1)
+        recipients = [{'email': f'user{i}@b.com', 'name': 'X'} for i in range(4)]
+
+        self.assertEqual(chapar_relays.dispatch(pool, recipients, compile_template('<html></html>'), None, 'none', 'test'), (4, 0))
+        self.assertEqual(backup.sendmail.call_count, 4)
+        self.assertIn('bad credentials', pool.report()[0]['error'])
+
+        pool = self.make_pool(primary=1)
+        with self.assertRaises(smtplib.SMTPAuthenticationError):
+            chapar_relays.dispatch(pool, recipients, compile_template('<html></html>'), None, 'none', 'test')
+
+
+class TestChaparBench(unittest.TestCase):
+
+    def test_resolve_security(self):
+        self.assertEqual(chapar.resolve_security(465), 'ssl')
+        self.assertEqual(chapar.resolve_security(587), 'starttls')
+        self.assertEqual(chapar.resolve_security(2525, 'starttls'), 'starttls')
+        with self.assertRaises(ValueError):
+            chapar.resolve_security(2525)
+        with self.assertRaises(ValueError):
+            chapar.resolve_security(2525, 'none')
+
+    def test_sink_requires_verified_starttls(self):
+        with chapar_bench.SMTPSink() as sink:
+            server = _create_smtp_server(sink.host, sink.port, 'user', 'pass', 'starttls', ca_file=chapar_bench.CERT_FILE)
+            self.assertIsNotNone(server.sock.version())
+            server.quit()
+            with self.assertRaises(ssl.SSLCertVerificationError):
+                asyncio.run(chapar_async._open_session(dict(sink.smtp_settings(), ca_file='')))
+            plain = smtplib.SMTP(sink.host, sink.port, timeout=10)
+            self.assertEqual(plain.mail('a@b.com')[0], 530)
+            plain.quit()
+
+    def test_send_case_against_sink(self):
+        for engine in ('threads', 'asyncio'):
+            result = chapar_bench.run_case('send_files', 40, failure_rate=0.25, concurrency=2, engine=engine)
+            self.assertEqual(result['sent'] + result['failed'], 40)
+            self.assertGreater(result['failed'], 0)
+            self.assertIsNotNone(result['p99_ms'])
+            self.assertGreater(result['messages_per_sec'], 0)
+
+    def test_row_ranges_split_at_row_boundaries(self):
+        rows = [{'email': f'user{i}@b.com', 'name': f'User "{i}"\nJr' if i % 3 == 0 else f'User {i}'} for i in range(40)]
+        with tempfile.TemporaryDirectory() as temp_dir:
+            path = os.path.join(temp_dir, 'recipients.csv')
+            with open(path, 'w', encoding='utf-8', newline='') as f:
+                writer = csv.DictWriter(f, fieldnames=['email', 'name'])
+                writer.writeheader()
+                writer.writerows(rows)
+                f.write('\n')
+            for parts in (1, 3, 7, 60):
+                ranges = chapar_shards.row_ranges(path, parts)
+                self.assertEqual(len(ranges), parts)
+                read = []
+                for start, end in ranges:
+                    with chapar.open_recipients(path, start, end) as recipients:
+                        read.extend(recipients)
+                self.assertEqual(read, rows)
+
+    def test_sharded_dispatch_against_sink(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            folder = os.path.join(temp_dir, 'shards')
+            with chapar_bench.SMTPSink(failure_rate=0.2) as sink:
+                chapar_bench.write_job_folder(folder, 30, sink, concurrency=2, processes=3)
+                with open(os.path.join(folder, 'config.ini'), 'a', encoding='utf-8') as f:
+                    f.write("Journal = true\nMaxRetries = 0\nSuppressionList = suppressed.txt\n")
+                with open(os.path.join(folder, 'suppressed.txt'), 'w', encoding='utf-8') as f:
+                    f.write("user3@example3.com\nUSER7@example7.com\n")
+                progress = chapar.DispatchProgress()
+                result = chapar.dispatch_folder(folder, progress)
+
+            self.assertEqual(result['total'], 30)
+            self.assertEqual(result['suppressed'], 2)
+            self.assertEqual(result['sent'] + result['failed'], 28)
+            self.assertEqual(result['sent'], sink.accepted)
+            self.assertEqual(len(result['failures']), result['failed'])
+            self.assertEqual(progress.snapshot()['sent'], result['sent'])
+            journalled, _ = chapar.read_journal(os.path.join(folder, chapar.JOURNAL_FILE))
+            self.assertEqual(len(journalled), result['sent'])
+
+    def test_async_batches_against_sink(self):
+        recipients = [{'email': f'user{i}@b.com', 'name': f'User {i}'} for i in range(10)]
+        with chapar_bench.SMTPSink() as sink:
+            result = _dispatch(sink.smtp_settings(), recipients, '<html>News</html>', None, 'none', 'test',
+                               concurrency=2, engine='asyncio', batch_size=4)
+
+        self.assertEqual(result, (10, 0))
+        self.assertEqual(sink.accepted, 3)
+
+    def test_async_rejects_line_breaks_in_addresses(self):
+        injected = 'a@x.com>\r\nRCPT TO:<injected@evil.com'
+        for batch_size, recipients in ((1, [injected, 'b@x.com']), (3, ['c@x.com', injected, 'd@x.com'])):
+            with chapar_bench.SMTPSink() as sink:
+                result = _dispatch(sink.smtp_settings(), [{'email': email, 'name': 'X'} for email in recipients],
+                                   '<html>News</html>', None, 'none', 'test', engine='asyncio', batch_size=batch_size)
+
+            self.assertEqual(result, (len(recipients) - 1, 1))
+            self.assertEqual(sink.recipients, len(recipients) - 1)
+
+    def test_compare_flags_throughput_drop(self):
+        baseline = [{'case': 'main', 'rows': 1000, 'engine': 'threads', 'concurrency': 1, 'messages_per_sec': 1000}]
+        results = [dict(baseline[0], messages_per_sec=850)]
+        self.assertEqual(len(chapar_bench.compare(results, baseline, 0.10)), 1)
+        self.assertEqual(chapar_bench.compare(results, baseline, 0.20), [])
+
+
 class TestChaparApi(unittest.TestCase):
 
     def setUp(self):
@@ -157,17 +980,34 @@ class TestChaparApi(unittest.TestCase):
             'config': (BytesIO(b'[SMTP]\nHost=smtp.example.com\n'), 'config.ini')
         }
 
+    @patch('chapar_api.chapar.send_emails_from_files')
+    def test_send_caps_concurrency_and_processes(self, mock_send):
+        configs = [
+            (b'[SMTP]\nHost=smtp.example.com\n[Settings]\nConcurrency=11\n', 400),
+            (b'[SMTP:a]\nHost=smtp.example.com\nConcurrency=11\n[Settings]\nConcurrency=2\n', 400),
+            (b'[SMTP]\nHost=smtp.example.com\n[Settings]\nProcesses=3\n', 400),
+            (b'[SMTP]\nHost=smtp.example.com\n[Settings]\nConcurrency=10\nProcesses=2\n', 202),
+        ]
+        with tempfile.TemporaryDirectory() as upload_folder, patch.dict(chapar_api.app.config, UPLOAD_FOLDER=upload_folder), \
+                patch('chapar_api.MAX_JOB_CONCURRENCY', 10), patch('chapar_api.MAX_JOB_PROCESSES', 2):
+            for config, status in configs:
+                payload = self._upload_payload()
+                payload['config'] = (BytesIO(config), 'config.ini')
+                with patch('chapar_api.sniff_mime_type', side_effect=['text/html', 'text/csv', 'text/plain']):
+                    response = self.client.post('/api/send', data=payload, content_type='multipart/form-data')
+                self.assertEqual(response.status_code, status)
+                if status == 400:
+                    self.assertRegex(response.get_json()['error'], 'Concurrency|Processes')
+                else:
+                    self.assertTrue(chapar_api.JOBS.get_job(response.get_json()['job_id']).wait(5))
+            self.assertEqual(os.listdir(upload_folder), [])
+        self.assertEqual(mock_send.call_count, 1)
+
     @patch('chapar_api.shutil.rmtree')
     @patch('chapar_api.tempfile.mkdtemp', return_value='api-test-temp')
     @patch('chapar_api.save_uploaded_files')
-    @patch('chapar_api.validate_recipients_file')
-    def test_send_masks_recipient_validation_error(self, mock_validate, mock_save, _mock_mkdtemp, _mock_rmtree):
-        mock_save.return_value = {
-            'template': 'email_template.html',
-            'recipients': 'recipients.csv',
-            'config': 'config.ini'
-        }
-        mock_validate.side_effect = ValueError('secret recipient details')
+    def test_send_masks_recipient_validation_error(self, mock_save, _mock_mkdtemp, _mock_rmtree):
+        mock_save.side_effect = chapar_api.RecipientsError('secret recipient details')
 
         response = self.client.post('/api/send', data=self._upload_payload(), content_type='multipart/form-data')
 
@@ -177,24 +1017,244 @@ class TestChaparApi(unittest.TestCase):
     @patch('chapar_api.shutil.rmtree')
     @patch('chapar_api.tempfile.mkdtemp', return_value='api-test-temp')
     @patch('chapar_api.chapar.send_emails_from_files')
-    @patch('chapar_api.validate_recipients_file')
     @patch('chapar_api.save_uploaded_files')
-    def test_send_masks_dispatch_exception(self, mock_save, mock_validate, mock_send, _mock_mkdtemp, _mock_rmtree):
-        mock_save.return_value = {
+    def test_send_masks_dispatch_exception(self, mock_save, mock_send, _mock_mkdtemp, _mock_rmtree):
+        mock_save.return_value = ({
             'template': 'email_template.html',
             'recipients': 'recipients.csv',
             'config': 'config.ini'
-        }
-        mock_validate.return_value = None
+        }, 1)
         mock_send.side_effect = Exception('smtp credential leak')
 
         response = self.client.post('/api/send', data=self._upload_payload(), content_type='multipart/form-data')
 
-        self.assertEqual(response.status_code, 500)
-        self.assertEqual(response.get_json(), {
-            'status': 'error',
-            'message': chapar_api.GENERIC_EMAIL_DISPATCH_ERROR
-        })
+        self.assertEqual(response.status_code, 202)
+        job_id = response.get_json()['job_id']
+        self.assertTrue(chapar_api.JOBS.get_job(job_id).wait(5))
+
+        response = self.client.get(f'/api/jobs/{job_id}')
+        self.assertEqual(response.status_code, 200)
+        job = response.get_json()
+        self.assertEqual(job['status'], 'failed')
+        self.assertEqual(job['error'], chapar_api.GENERIC_EMAIL_DISPATCH_ERROR)
+        self.assertNotIn('smtp credential leak', response.get_data(as_text=True))
+
+    @patch('chapar_api.chapar.send_emails_from_files')
+    def test_send_reads_uploads_once(self, mock_send):
+        saved = {}
+
+        def send(config_path, recipients_path, *args):
+            with open(recipients_path, 'rb') as f:
+                saved['recipients'] = f.read()
+
+        mock_send.side_effect = send
+        payload = self._upload_payload()
+        payload['recipients'] = (BytesIO(b'email,name\n' + b'user@example.com,User\n' * 5000), 'recipients.csv')
+        with tempfile.TemporaryDirectory() as upload_folder, patch.dict(chapar_api.app.config, UPLOAD_FOLDER=upload_folder), \
+                patch('chapar_api.sniff_mime_type', side_effect=['text/html', 'text/csv', 'text/plain']) as sniff, \
+                patch('chapar.count_recipients') as count_recipients:
+            response = self.client.post('/api/send', data=payload, content_type='multipart/form-data')
+            self.assertEqual(response.status_code, 202)
+            self.assertTrue(chapar_api.JOBS.get_job(response.get_json()['job_id']).wait(5))
+            self.assertEqual(mock_send.call_args.args[-1], 5000)
+            self.assertEqual(saved['recipients'], b'email,name\n' + b'user@example.com,User\n' * 5000)
+        count_recipients.assert_not_called()
+        self.assertEqual([len(c.args[0]) for c in sniff.call_args_list], [13, chapar_api.MAGIC_SNIFF_BYTES, 29])
+
+        self.assertEqual(chapar_api.check_recipients(iter([['email'], [], ['a@b.com'], [], ['c@d.com'], []])), 2)
+
+        payload = self._upload_payload()
+        payload['recipients'] = (BytesIO(b'email,name\nnot-an-email,User\n'), 'recipients.csv')
+        response = self.client.post('/api/send', data=payload, content_type='multipart/form-data')
+        self.assertEqual(response.get_json(), {'error': chapar_api.GENERIC_RECIPIENTS_ERROR})
+
+        payload = self._upload_payload()
+        payload['template'] = (BytesIO(b'<html>' + b' ' * 100 + b'</html>'), 'email_template.html')
+        with patch('chapar_api.MAX_FILE_SIZE', 100):
+            response = self.client.post('/api/send', data=payload, content_type='multipart/form-data')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.get_json(), {'error': chapar_api.GENERIC_FILE_UPLOAD_ERROR})
+
+    @patch('chapar_api.chapar.dispatch_folder')
+    def test_run_template_reports_job_progress(self, mock_dispatch):
+        def dispatch(folder, progress, *args):
+            progress.start(3)
+            for status in ('sent', 'sent', 'failed'):
+                progress.add(status)
+            progress.finish()
+
+        mock_dispatch.side_effect = dispatch
+        with patch('chapar_api.os.path.isdir', return_value=True), patch('chapar_api.os.path.exists', return_value=True):
+            response = self.client.post('/api/run-template', json={'template': 'welcome'})
+
+        self.assertEqual(response.status_code, 202)
+        job_id = response.get_json()['job_id']
+        self.assertTrue(chapar_api.JOBS.get_job(job_id).wait(5))
+
+        job = self.client.get(f'/api/jobs/{job_id}').get_json()
+        self.assertEqual(job['status'], 'completed')
+        self.assertEqual(job['progress']['sent'], 2)
+        self.assertEqual(job['progress']['failed'], 1)
+        self.assertEqual(job['progress']['remaining'], 0)
+
+    def test_metrics_endpoint(self):
+        stats = chapar_api.METRICS.job_stats('metrics-test')
+        stats.record('connect', 0.02)
+        stats.record('smtp', 0.003)
+        stats.count(SEND_OK)
+        stats.count(SEND_FAILED)
+
+        response = self.client.get('/metrics')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.content_type.startswith('text/plain'))
+        body = response.get_data(as_text=True)
+        self.assertIn('chapar_messages_sent_total{template="metrics-test"} 1', body)
+        self.assertIn('chapar_messages_failed_total{template="metrics-test"} 1', body)
+        self.assertIn('chapar_send_seconds_bucket{le="0.005"}', body)
+        self.assertIn('chapar_smtp_connect_seconds_count', body)
+        self.assertIn('chapar_jobs_active', body)
+        self.assertIn('chapar_jobs_queued', body)
+
+    def test_metrics_merge_shard_histograms(self):
+        registry = chapar_metrics.MetricsRegistry()
+        stats = registry.job_stats('shards')
+        for connect in (0.02, 0.3):
+            shard = DispatchStats()
+            shard.record('connect', connect)
+            shard.record('login', 0.01)
+            shard.record('smtp', 0.003)
+            stats.merge(pickle.loads(pickle.dumps(shard)))
+
+        self.assertEqual(stats.connect_latency.count, 2)
+        for histogram in (registry.connect_latency, registry.login_latency, registry.send_latency):
+            self.assertEqual(histogram.count, 2)
+        self.assertAlmostEqual(registry.connect_latency.sum, 0.32)
+        self.assertAlmostEqual(registry.stage_seconds['connect'], 0.32)
+        body = registry.render()
+        self.assertIn('chapar_smtp_connect_seconds_count 2', body)
+        self.assertIn('chapar_smtp_login_seconds_count 2', body)
+
+    def test_template_registry_detects_changes(self):
+        now = [0.0]
+        with tempfile.TemporaryDirectory() as base_dir:
+            for name in ('welcome', 'partial'):
+                os.makedirs(os.path.join(base_dir, name))
+                for filename in chapar_templates.TEMPLATE_FILES[:2 if name == 'partial' else 3]:
+                    with open(os.path.join(base_dir, name, filename), 'w') as f:
+                        f.write('[SMTP]\nSubject = Hello\n' if filename == 'config.ini' else 'x')
+            describe = MagicMock(side_effect=chapar_api.get_template_description)
+            registry = chapar_templates.TemplateRegistry(base_dir, describe, check_interval=1.0, clock=lambda: now[0])
+
+            body, etag = registry.listing()
+            self.assertEqual(json.loads(body), [{'name': 'welcome', 'description': 'Hello'}])
+            self.assertFalse(registry.get('partial').complete)
+            self.assertIsNone(registry.get('missing'))
+
+            with open(os.path.join(base_dir, 'welcome', 'config.ini'), 'w') as f:
+                f.write('[Settings]\nDescription = Welcome series\n')
+            self.assertEqual(registry.listing(), (body, etag))
+            now[0] = 1.0
+            body, new_etag = registry.listing()
+            self.assertEqual(json.loads(body), [{'name': 'welcome', 'description': 'Welcome series'}])
+            self.assertNotEqual(new_etag, etag)
+            now[0] = 2.0
+            self.assertEqual(registry.listing(), (body, new_etag))
+            self.assertEqual(describe.call_count, 2)
+
+            shutil.rmtree(os.path.join(base_dir, 'welcome'))
+            now[0] = 3.0
+            self.assertEqual(json.loads(registry.listing()[0]), [])
+
+    def test_templates_endpoints_send_etags(self):
+        response = self.client.get('/api/templates')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('newsletter0-ltr', [template['name'] for template in response.get_json()])
+        etag = response.headers['ETag']
+        response = self.client.get('/api/templates', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+
+        response = self.client.get('/templates/newsletter0-ltr')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.get_json()['name'], 'newsletter0-ltr')
+        response = self.client.get('/templates/newsletter0-ltr', headers={'If-None-Match': response.headers['ETag']})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(self.client.get('/templates/static').status_code, 404)
+        self.assertEqual(self.client.get('/templates/missing').status_code, 404)
+
+    def test_recipient_index_pages(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            path = os.path.join(temp_dir, 'recipients.csv')
+            with open(path, 'w', encoding='utf-8', newline='') as f:
+                f.write('email,name\r\n')
+                for i in range(25):
+                    f.write(f'user{i}@example.com,"Line one\nline {i}"\r\n' if i % 4 == 0 else f'user{i}@example.com,Ünïcode {i}\r\n')
+                    if i == 10:
+                        f.write('\r\n')
+            with open(path, encoding='utf-8', newline='') as f:
+                expected = list(csv.DictReader(f))
+
+            index = chapar_templates.RecipientIndex(path, checkpoint_rows=4)
+            self.assertEqual((index.columns, index.total, len(index.checkpoints)), (['email', 'name'], 25, 7))
+            for offset in range(26):
+                self.assertEqual(index.page(offset, 3)[0], expected[offset:offset + 3])
+            rows, start = [], None
+            while len(rows) < index.total:
+                page, start = index.page(len(rows), 7, start)
+                rows.extend(page)
+            self.assertEqual(rows, expected)
+
+    def test_template_recipients_are_paged_and_compressed(self):
+        with tempfile.TemporaryDirectory() as base_dir:
+            folder = os.path.join(base_dir, 'big')
+            os.makedirs(folder)
+            with open(os.path.join(folder, 'email_template.html'), 'w') as f:
+                f.write('<html>' + 'x' * 300 + '</html>')
+            with open(os.path.join(folder, 'config.ini'), 'w') as f:
+                f.write('[SMTP]\nSubject = Big\nPassword = secret\n')
+            with open(os.path.join(folder, 'recipients.csv'), 'w', encoding='utf-8') as f:
+                f.write('email,name\n' + ''.join(f'user{i}@example.com,Usér {i}\n' for i in range(250)))
+            registry = chapar_templates.TemplateRegistry(base_dir, chapar_api.get_template_description)
+            with patch('chapar_api.TEMPLATES', registry), patch('chapar_api.TEMPLATE_PREVIEW_CHARS', 100):
+                preview = self.client.get('/templates/big').get_json()
+                self.assertEqual(len(preview['html']), 100)
+                self.assertTrue(preview['html_truncated'])
+                self.assertNotIn('secret', preview['config'])
+                self.assertEqual(preview['recipients'], {'columns': ['email', 'name'], 'total': 250, 'url': '/templates/big/recipients'})
+
+                page = self.client.get('/templates/big/recipients?offset=240&limit=20').get_json()
+                self.assertEqual([row['email'] for row in page['rows']], [f'user{i}@example.com' for i in range(240, 250)])
+                self.assertIsNone(page['next_cursor'])
+
+                emails = []
+                url = '/templates/big/recipients?limit=100'
+                while url:
+                    response = self.client.get(url, headers={'Accept-Encoding': 'gzip'})
+                    self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+                    page = json.loads(gzip.decompress(response.get_data()))
+                    self.assertEqual(page['total'], 250)
+                    emails.extend(row['email'] for row in page['rows'])
+                    url = page['next_cursor'] and f"/templates/big/recipients?limit=100&cursor={page['next_cursor']}"
+                self.assertEqual(emails, [f'user{i}@example.com' for i in range(250)])
+
+                response = self.client.get('/templates/big/recipients?limit=100', headers={'Accept-Encoding': 'gzip'})
+                etag = response.headers['ETag']
+                self.assertTrue(etag.endswith('-gzip"'))
+                response = self.client.get('/templates/big/recipients?limit=100', headers={'Accept-Encoding': 'gzip', 'If-None-Match': etag})
+                self.assertEqual(response.status_code, 304)
+
+                for query in ('limit=0', 'limit=5000', 'offset=-1', 'cursor=1.2.stale', 'cursor=junk'):
+                    self.assertEqual(self.client.get(f'/templates/big/recipients?{query}').status_code, 400)
+
+                version = self.client.get('/templates/big/recipients?limit=1').get_json()['next_cursor'].split('.')[2]
+                mid_character = len('email,name\nuser0@example.com,Us'.encode('utf-8')) + 1
+                for start in (0, 3, mid_character):
+                    response = self.client.get(f'/templates/big/recipients?cursor=1.{start}.{version}')
+                    self.assertEqual(response.status_code, 400)
+
+    def test_unknown_job_is_not_found(self):
+        response = self.client.get('/api/jobs/0123abcd')
+        self.assertEqual(response.status_code, 404)
 
     @patch('chapar_api.shutil.rmtree')
     @patch('chapar_api.tempfile.mkdtemp', return_value='api-test-temp')
@@ -207,5 +1267,156 @@ class TestChaparApi(unittest.TestCase):
         self.assertEqual(response.status_code, 500)
         self.assertEqual(response.get_json(), {'error': chapar_api.GENERIC_FILE_UPLOAD_ERROR})
 
+class TestMerger(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.folder = self.temp_dir.name
+        os.makedirs(os.path.join(self.folder, 'subscribers'))
+        flags = ['true', 'false', '', 'TRUE ', 'no']
+        for index in range(3):
+            with open(os.path.join(self.folder, 'subscribers', f'00{index}_export.csv'), 'w', newline='', encoding='utf-8') as f:
+                f.write('Email,Name,subscribe,subscribe_survey,Timestamp\n')
+                for row in range(40):
+                    number = (row * 7 + index * 3) % 25
+                    email = f' User{number}@Example.com' if row % 3 else f'user{number}@example.com'
+                    timestamp = f'2024-01-{(row * 5 + index) % 28 + 1:02d}T10:00:00' if row % 4 else 'not a date'
+                    f.write(f'{email},Name {index}-{row},{flags[(row + index) % 5]},{flags[(row * 3) % 5]},{timestamp}\n')
+        self.config = dict(merger.DEFAULT_CONFIG)
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def merge(self, **options):
+        config = dict(self.config, **options)
+        with patch('builtins.print'):
+            merger.merge_csv(self.folder, config)
+        with open(os.path.join(self.folder, config['output_file']), 'rb') as f:
+            return f.read()
+
+    def test_merge_rules(self):
+        subscribers = os.path.join(self.folder, 'subscribers')
+        for fname in os.listdir(subscribers):
+            os.remove(os.path.join(subscribers, fname))
+        with open(os.path.join(subscribers, '000_a.csv'), 'w', encoding='utf-8') as f:
+            f.write('Email,Name,subscribe,subscribe_survey,Timestamp\n'
+                    'A@x.com,Old,true,false,2024-01-01\n'
+                    'b@x.com,Bee,false,,2024-01-01\n')
+        with open(os.path.join(subscribers, '001_b.csv'), 'w', encoding='utf-8') as f:
+            f.write('Email,Name,subscribe,subscribe_survey,Timestamp\n'
+                    'a@x.com ,New,false,false,2024-02-01\n'
+                    'B@X.com,Older,,true,2023-12-01\n')
+        for options in ({}, {'memory_budget': '0.0001'}):
+            rows = list(csv.DictReader(StringIO(self.merge(**options).decode('utf-8'))))
+            self.assertEqual([(r['Name'], r['subscribe'], r['subscribe_survey']) for r in rows],
+                             [('New', 'false', 'false'), ('Bee', 'false', 'true')])
+
+    def test_external_merge_matches_in_memory(self):
+        expected = self.merge()
+        spill = os.path.join(self.folder, 'spill')
+        os.makedirs(spill)
+        with patch('merger.MAX_OPEN_RUNS', 2):
+            self.assertEqual(self.merge(memory_budget='0.002', temp_dir=spill), expected)
+        self.assertEqual(self.merge(memory_budget='64', temp_dir=spill), expected)
+        self.assertEqual(os.listdir(spill), [])
+
+    def test_parallel_merge_matches_serial(self):
+        self.assertEqual(self.merge(workers='3'), self.merge())
+
+    def test_incremental_merge_applies_only_new_files(self):
+        subscribers = os.path.join(self.folder, 'subscribers')
+        extra = os.path.join(self.folder, '003_new.csv')
+        with open(os.path.join(subscribers, '000_export.csv'), encoding='utf-8') as f:
+            content = f.read()
+        with open(extra, 'w', encoding='utf-8') as f:
+            f.write(content.replace('Name 0-', 'Name 3-').replace('2024-01-', '2024-03-'))
+
+        self.merge(state_file='merged.state')
+        os.rename(extra, os.path.join(subscribers, '003_new.csv'))
+        with patch('merger.merge_file', wraps=merger.merge_file) as merge_file:
+            incremental = self.merge(state_file='merged.state')
+        self.assertEqual([os.path.basename(c.args[0]) for c in merge_file.call_args_list], ['003_new.csv'])
+        self.assertEqual(incremental, self.merge())
+
+        with open(os.path.join(subscribers, '001_export.csv'), 'a', encoding='utf-8') as f:
+            f.write('late@example.com,Late,true,true,2024-05-01\n')
+        with patch('merger.merge_file', wraps=merger.merge_file) as merge_file:
+            rebuilt = self.merge(state_file='merged.state')
+        self.assertEqual(merge_file.call_count, 4)
+        self.assertEqual(rebuilt, self.merge())
+
+    def test_merge_partial_matches_row_by_row(self):
+        rng = random.Random(7)
+        values = ['true', 'false', '', ' True', 'FALSE ', 'maybe']
+        config = self.config
+        for _ in range(200):
+            files = [[{'Email': f'u{rng.randrange(3)}@x.com', 'subscribe': rng.choice(values),
+                       'subscribe_survey': rng.choice(values), 'Timestamp': f'2024-01-0{rng.randrange(1, 4)}'}
+                      for _ in range(rng.randrange(1, 5))] for _ in range(3)]
+            serial = {}
+            combined = {}
+            for rows in files:
+                for row in rows:
+                    serial[row['Email']] = merger.merge_row(serial.get(row['Email']), dict(row), merger.parse_timestamp(row), config)
+                with patch('merger.read_file', return_value=[(row['Email'], dict(row)) for row in rows]):
+                    merger.merge_partial(combined, merger.merge_file('unused.csv', config), config)
+            self.assertEqual(list(combined.items()), list(serial.items()))
+
+class TestDeduplicator(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.list1 = os.path.join(self.temp_dir.name, 'list1.txt')
+        self.list2 = os.path.join(self.temp_dir.name, 'list2.txt')
+        with open(self.list1, 'w', encoding='utf-8') as f:
+            f.write('a@example.com\n B@Example.com\n\nc@example.com\nd@example.com')
+        with open(self.list2, 'w', encoding='utf-8') as f:
+            f.write('b@example.com\n\nD@EXAMPLE.COM \nz@example.com\n')
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def deduplicate(self, index_path=None):
+        with patch('builtins.print'):
+            deduplicator.deduplicate(self.list1, self.list2, index_path)
+        with open(self.list1, encoding='utf-8') as f:
+            return f.read()
+
+    def test_deduplicate_in_memory_and_with_index(self):
+        with open(self.list1, encoding='utf-8') as f:
+            original = f.read()
+        self.assertEqual(self.deduplicate(), 'a@example.com\nc@example.com\n')
+        with open(self.list1 + '.bak', encoding='utf-8') as f:
+            self.assertEqual(f.read(), original)
+
+        with open(self.list1, 'w', encoding='utf-8') as f:
+            f.write(original)
+        index_path = os.path.join(self.temp_dir.name, 'list2.idx')
+        self.assertEqual(self.deduplicate(index_path), 'a@example.com\nc@example.com\n')
+        self.assertEqual(sorted(os.listdir(self.temp_dir.name)), ['list1.txt', 'list1.txt.bak', 'list2.idx', 'list2.txt'])
+
+    def test_index_lookups_and_rebuild(self):
+        index_path = os.path.join(self.temp_dir.name, 'list2.idx')
+        with deduplicator.open_index(self.list2, index_path) as index:
+            self.assertEqual(len(index), 3)
+            self.assertIn('d@example.com', index)
+            self.assertNotIn('a@example.com', index)
+
+        with patch('deduplicator.build_index', wraps=deduplicator.build_index) as build:
+            deduplicator.open_index(self.list2, index_path).close()
+            self.assertEqual(build.call_count, 0)
+            with open(self.list2, 'a', encoding='utf-8') as f:
+                f.write('a@example.com\n')
+            with deduplicator.open_index(self.list2, index_path) as index:
+                self.assertIn('a@example.com', index)
+            self.assertEqual(build.call_count, 1)
+
+        emails = [f'user{n}@example.com' for n in range(5000)]
+        with open(self.list2, 'w', encoding='utf-8') as f:
+            f.write('\n'.join(emails[::2]))
+        with deduplicator.open_index(self.list2, index_path) as index:
+            self.assertEqual(len(index), 2500)
+            self.assertEqual([email for email in emails if email in index], emails[::2])
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file